@@ -10,6 +10,7 @@ from argparse import ArgumentParser
 from wsgiref.simple_server import make_server
 from cart.cart_orm import database_setup
 from cart.cart_interface import CartGenerator
+from cart.cart_wsgi import ThreadingWSGIServer, SendfileRequestHandler
 
 # pylint: disable=unused-argument
 def exit_handler(signum, frame):
@@ -32,19 +33,20 @@ def main():
                         help='address to listen on')
 
     args = parser.parse_args()
-    generator = CartGenerator()
     #make sure the database is up
     database_setup()
     srv = make_server(args.address, args.port,
-                      generator.pacifica_cartinterface)
+                      application,
+                      server_class=ThreadingWSGIServer,
+                      handler_class=SendfileRequestHandler)
 
     srv.serve_forever()
 
 
-# pylint doesn't realize that application is actually a callable
-# pylint: disable=invalid-name
-application = CartGenerator().pacifica_cartinterface
-# pylint: enable=invalid-name
+def application(env, start_response):
+    """Handle a request with its own generator, the generator keeps the
+    response of the request it is handling"""
+    return CartGenerator().pacifica_cartinterface(env, start_response)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,4 @@
+#!/usr/bin/python
+"""
+Benchmarks for the cart.  Run each module with python -m benchmarks.<name>
+"""
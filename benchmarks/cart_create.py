@@ -0,0 +1,49 @@
+#!/usr/bin/python
+"""
+Benchmark how long creating the File rows of a cart takes as the number
+of files in the cart grows.
+
+python -m benchmarks.cart_create --sizes 1000 10000 100000 1000000
+"""
+from __future__ import print_function
+import os
+import time
+from argparse import ArgumentParser
+from tempfile import mkstemp
+from playhouse.test_utils import test_database
+from peewee import SqliteDatabase
+from cart.cart_orm import Cart, File
+from cart.cart_utils import Cartutils
+
+
+def create_cart(size):
+    """Create a cart of size files returning the seconds it took"""
+    file_ids = ({'id': 'file.' + str(index), 'path': 'a/b/file.' + str(index)}
+                for index in range(size))
+    mycart = Cart.create(cart_uid=str(size), status='staging')
+    start = time.time()
+    Cartutils().update_cart_files(mycart, file_ids)
+    return time.time() - start
+
+
+def main():
+    """Main function when running from the command line."""
+    parser = ArgumentParser(description='Benchmark cart creation.')
+    parser.add_argument('--sizes', metavar='FILES', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000], dest='sizes',
+                        help='number of files in each cart')
+    args = parser.parse_args()
+    db_path = mkstemp(suffix='.sqlite3')[1]
+    try:
+        with test_database(SqliteDatabase(db_path), (Cart, File)):
+            print('{0:>10} {1:>12} {2:>14}'.format('files', 'seconds', 'usec/file'))
+            for size in args.sizes:
+                seconds = create_cart(size)
+                print('{0:>10} {1:>12.3f} {2:>14.2f}'.format(
+                    size, seconds, seconds * 1000000 / size))
+    finally:
+        os.unlink(db_path)
+
+
+if __name__ == '__main__':
+    main()
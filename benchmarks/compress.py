@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""
+Benchmark the throughput of each bundle format.  The cart is half text
+that compresses and half random data that doesnt, to show the stored
+incompressible files.
+
+python -m benchmarks.compress --files 16 --size 8388608 --workers 1 4
+"""
+from __future__ import print_function
+import os
+import time
+import random
+from argparse import ArgumentParser
+from shutil import rmtree
+from tempfile import mkdtemp
+from cart.cart_bundle import TarStream, CompressedStream, compression_available
+
+
+def make_cart(files, size):
+    """Make a cart directory of text and random files"""
+    cart_path = mkdtemp()
+    line = ''.join('{0} INFO sample {1} value={2}\n'.format(index, index % 7, random.random())
+                   for index in range(2000))
+    for index in range(files):
+        with open(os.path.join(cart_path, 'file.' + str(index)), 'wb') as cart_file:
+            written = 0
+            while written < size:
+                block = line if index % 2 else os.urandom(len(line))
+                cart_file.write(block[:size - written])
+                written += len(block[:size - written])
+    return cart_path
+
+
+def run(cart_path, bundle_format, workers):
+    """Returns the tar MB/s and the bundle size as a fraction of the tar"""
+    stream = TarStream(cart_path, 'bench')
+    tar_size = stream.size()
+    if bundle_format != 'tar':
+        stream = CompressedStream(stream, bundle_format, workers=workers)
+    start = time.time()
+    sent = sum(len(buf) for buf in stream)
+    seconds = time.time() - start
+    return tar_size / seconds / (1 << 20), float(sent) / tar_size
+
+
+def main():
+    """Main function when running from the command line."""
+    parser = ArgumentParser(description='Benchmark bundle formats.')
+    parser.add_argument('--files', type=int, default=16, dest='files',
+                        help='number of files in the cart')
+    parser.add_argument('--size', type=int, default=1 << 23, dest='size',
+                        help='bytes in each file')
+    parser.add_argument('--workers', metavar='WORKERS', type=int, nargs='+',
+                        default=[1, 4], dest='workers',
+                        help='compression threads for each measurement')
+    args = parser.parse_args()
+    cart_path = make_cart(args.files, args.size)
+    try:
+        print('{0:>8} {1:>8} {2:>12} {3:>8}'.format('format', 'workers', 'tar MB/s', 'ratio'))
+        rate, ratio = run(cart_path, 'tar', 1)
+        print('{0:>8} {1:>8} {2:>12.1f} {3:>8.3f}'.format('tar', '-', rate, ratio))
+        for bundle_format in ['gz', 'zstd']:
+            if not compression_available(bundle_format):
+                print('{0:>8} not available'.format(bundle_format))
+                continue
+            for workers in args.workers:
+                rate, ratio = run(cart_path, bundle_format, workers)
+                print('{0:>8} {1:>8} {2:>12.1f} {3:>8.3f}'.format(bundle_format, workers, rate, ratio))
+    finally:
+        rmtree(cart_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+"""
+Benchmark concurrent cart downloads through the interface, comparing the
+in process tar stream with the fork per download mode.  Reports the
+throughput and the peak resident memory of the server process and its
+children.
+
+python -m benchmarks.download --files 64 --size 4194304 --clients 1 8 32
+"""
+from __future__ import print_function
+import os
+import time
+import threading
+from argparse import ArgumentParser
+from shutil import rmtree
+from tempfile import mkstemp, mkdtemp
+import mock
+import psutil
+from playhouse.test_utils import test_database
+from peewee import SqliteDatabase
+from cart.cart_orm import Cart, File
+from cart.cart_interface import CartGenerator
+
+
+def make_cart(files, size):
+    """Make a ready cart of files files of size bytes"""
+    cart_path = mkdtemp()
+    block = os.urandom(min(size, 1 << 20))
+    for index in range(files):
+        with open(os.path.join(cart_path, 'file.' + str(index)), 'wb') as cart_file:
+            written = 0
+            while written < size:
+                cart_file.write(block[:size - written])
+                written += len(block[:size - written])
+    Cart.create(cart_uid='bench', bundle_path=cart_path, status='ready')
+    return cart_path
+
+
+class MemorySampler(threading.Thread):
+    """Sample the resident memory of this process and its children"""
+    def __init__(self):
+        super(MemorySampler, self).__init__()
+        self.daemon = True
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        process = psutil.Process()
+        while self.running:
+            rss = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak = max(self.peak, rss)
+            time.sleep(0.02)
+
+
+def download(totals):
+    """Download the cart once adding the bytes read to totals"""
+    def start_response(status, headers):
+        """the benchmark only wants the body"""
+        assert status == '200 OK', (status, headers)
+    env = {'PATH_INFO': '/bench', 'QUERY_STRING': ''}
+    read = 0
+    for buf in CartGenerator().get(env, start_response):
+        read += len(buf)
+    totals.append(read)
+
+
+def run(mode, clients):
+    """Run clients concurrent downloads returning MB/s and peak RSS MB"""
+    totals = []
+    sampler = MemorySampler()
+    sampler.start()
+    with mock.patch('cart.cart_interface.CART_DOWNLOAD_MODE', mode):
+        threads = [threading.Thread(target=download, args=(totals,)) for _ in range(clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.time() - start
+    sampler.running = False
+    sampler.join()
+    return sum(totals) / seconds / (1 << 20), sampler.peak / float(1 << 20)
+
+
+def main():
+    """Main function when running from the command line."""
+    parser = ArgumentParser(description='Benchmark concurrent cart downloads.')
+    parser.add_argument('--files', type=int, default=64, dest='files',
+                        help='number of files in the cart')
+    parser.add_argument('--size', type=int, default=1 << 22, dest='size',
+                        help='bytes in each file')
+    parser.add_argument('--clients', metavar='CLIENTS', type=int, nargs='+',
+                        default=[1, 8, 32], dest='clients',
+                        help='number of concurrent downloads for each measurement')
+    parser.add_argument('--modes', metavar='MODE', nargs='+',
+                        default=['stream', 'fork'], dest='modes',
+                        help='download modes to compare')
+    args = parser.parse_args()
+    db_path = mkstemp(suffix='.sqlite3')[1]
+    try:
+        with test_database(SqliteDatabase(db_path), (Cart, File)):
+            cart_path = make_cart(args.files, args.size)
+            try:
+                print('{0:>8} {1:>8} {2:>12} {3:>14}'.format('mode', 'clients', 'MB/s', 'peak RSS MB'))
+                for mode in args.modes:
+                    for clients in args.clients:
+                        rate, peak = run(mode, clients)
+                        print('{0:>8} {1:>8} {2:>12.1f} {3:>14.1f}'.format(mode, clients, rate, peak))
+            finally:
+                rmtree(cart_path)
+    finally:
+        os.unlink(db_path)
+
+
+if __name__ == '__main__':
+    main()
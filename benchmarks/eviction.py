@@ -0,0 +1,119 @@
+#!/usr/bin/python
+"""
+Simulate cart eviction on a synthetic trace of cart requests.  Cart
+popularity follows a zipf distribution whose hot carts change every phase
+of the trace.  A request for a cart on the volume is a hit, a miss creates
+the cart and evicts others to make room.  Compares the eviction planner,
+least recently accessed first in one decision, with deleting the oldest
+created cart one at a time.
+
+python -m benchmarks.eviction --carts 2000 --requests 200000 --capacity 0.1 0.25
+"""
+from __future__ import print_function
+import random
+from argparse import ArgumentParser
+from collections import OrderedDict
+from cart.cart_space import plan_eviction
+
+
+def make_trace(carts, requests, alpha, phase, seed):
+    """Returns the cart sizes and the trace of requested carts"""
+    rand = random.Random(seed)
+    sizes = [int(rand.lognormvariate(20, 1.5)) for _ in range(carts)]
+    weights = [1.0 / (rank + 1) ** alpha for rank in range(carts)]
+    total = sum(weights)
+    cumulative = []
+    running = 0.0
+    for weight in weights:
+        running += weight / total
+        cumulative.append(running)
+    ranking = list(range(carts))
+    trace = []
+    for index in range(requests):
+        if index % phase == 0:
+            rand.shuffle(ranking)
+        point = rand.random()
+        low, high = 0, carts - 1
+        while low < high:
+            middle = (low + high) // 2
+            if cumulative[middle] < point:
+                low = middle + 1
+            else:
+                high = middle
+        trace.append(ranking[low])
+    return sizes, trace
+
+
+def creation_order(volume, free, size):
+    """Delete the oldest created carts one at a time until size fits"""
+    evicted = []
+    while free < size and volume:
+        _, cart_size = volume.popitem(last=False)
+        free += cart_size
+        evicted.append(cart_size)
+    return evicted if free >= size else None
+
+
+def planner(volume, free, size):
+    """Evict the carts plan_eviction picks from the access order"""
+    keys = plan_eviction(volume.items(), size - free)
+    if keys is None:
+        return None
+    return [volume.pop(key) for key in keys]
+
+
+def run(policy, sizes, trace, capacity):
+    """Returns the hit rate, bytes evicted and carts evicted"""
+    volume = OrderedDict()
+    used = hits = evicted_bytes = evicted_carts = 0
+    for cart in trace:
+        if cart in volume:
+            hits += 1
+            if policy is planner:
+                volume[cart] = volume.pop(cart)
+            continue
+        size = sizes[cart]
+        if size > capacity:
+            continue
+        if capacity - used < size:
+            evicted = policy(volume, capacity - used, size)
+            if evicted is None:
+                continue
+            used -= sum(evicted)
+            evicted_bytes += sum(evicted)
+            evicted_carts += len(evicted)
+        volume[cart] = size
+        used += size
+    return float(hits) / len(trace), evicted_bytes, evicted_carts
+
+
+def main():
+    """Main function when running from the command line."""
+    parser = ArgumentParser(description='Simulate cart eviction.')
+    parser.add_argument('--carts', type=int, default=2000, dest='carts',
+                        help='number of distinct carts requested')
+    parser.add_argument('--requests', type=int, default=200000, dest='requests',
+                        help='length of the trace')
+    parser.add_argument('--alpha', type=float, default=0.9, dest='alpha',
+                        help='zipf exponent of cart popularity')
+    parser.add_argument('--phase', type=int, default=20000, dest='phase',
+                        help='requests before the popular carts change')
+    parser.add_argument('--capacity', metavar='FRACTION', type=float, nargs='+',
+                        default=[0.1, 0.25], dest='capacity',
+                        help='volume size as a fraction of all the carts')
+    parser.add_argument('--seed', type=int, default=0, dest='seed',
+                        help='seed of the synthetic trace')
+    args = parser.parse_args()
+    sizes, trace = make_trace(args.carts, args.requests, args.alpha, args.phase, args.seed)
+    print('{0:>10} {1:>16} {2:>10} {3:>14} {4:>10}'.format(
+        'capacity', 'policy', 'hit rate', 'GB evicted', 'evicted'))
+    for fraction in args.capacity:
+        capacity = int(sum(sizes) * fraction)
+        for name, policy in [('creation order', creation_order), ('planner', planner)]:
+            hit_rate, evicted_bytes, evicted_carts = run(policy, sizes, trace, capacity)
+            print('{0:>10} {1:>16} {2:>10.3f} {3:>14.1f} {4:>10}'.format(
+                fraction, name, hit_rate, evicted_bytes / float(1 << 30), evicted_carts))
+
+
+if __name__ == '__main__':
+    main()
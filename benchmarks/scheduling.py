@@ -0,0 +1,112 @@
+#!/usr/bin/python
+"""
+Simulate the queueing of the files of carts on the workers.  One large
+cart is made first and small carts keep arriving while it is pulled.
+Every file takes an exponentially distributed time on a worker.  Compares
+queueing every file of a cart when it is made, first in first out, with
+the dispatch window of cart_scheduler, which queues more of a carts files
+as the workers start on them.
+
+python -m benchmarks.scheduling --workers 32 --large 20000 --small-carts 200 --window 0 100
+"""
+from __future__ import print_function
+import heapq
+import random
+from argparse import ArgumentParser
+from collections import deque
+from cart.cart_scheduler import cart_window
+
+
+def make_carts(large, small_carts, small_files, interval, seed):
+    """Returns the arrival time and number of files of every cart, the
+    large cart first"""
+    rand = random.Random(seed)
+    carts = [(0.0, large)]
+    now = 0.0
+    for _ in range(small_carts):
+        now += rand.expovariate(1.0 / interval)
+        carts.append((now, small_files))
+    return carts
+
+
+def simulate(carts, workers, service, window, seed):
+    """Returns the time each cart finished, queueing a window of files of
+    each cart at a time.  A window of 0 queues every file on arrival"""
+    rand = random.Random(seed)
+    waiting = [files for _, files in carts]
+    queued = [0] * len(carts)
+    left = list(waiting)
+    finished = [None] * len(carts)
+    queue = deque()
+    events = [(arrival, index, 'arrive') for index, (arrival, _) in enumerate(carts)]
+    heapq.heapify(events)
+    idle = workers
+
+    def dispatch(cart):
+        """queue the next of the carts files, like dispatch_files"""
+        count = waiting[cart]
+        if window > 0:
+            size = cart_window(0, 1, window)
+            if queued[cart] > size // 2:
+                return
+            count = min(count, size - queued[cart])
+        waiting[cart] -= count
+        queued[cart] += count
+        queue.extend([cart] * count)
+
+    while events:
+        now, cart, kind = heapq.heappop(events)
+        if kind == 'arrive':
+            dispatch(cart)
+        else:
+            idle += 1
+            left[cart] -= 1
+            if not left[cart]:
+                finished[cart] = now
+        while idle and queue:
+            started = queue.popleft()
+            idle -= 1
+            queued[started] -= 1
+            dispatch(started)
+            heapq.heappush(events, (now + rand.expovariate(1.0 / service), started, 'done'))
+    return finished
+
+
+def percentile(values, fraction):
+    """Returns the value fraction of the way through the sorted values"""
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    """Main function when running from the command line."""
+    parser = ArgumentParser(description='Simulate the queueing of cart files.')
+    parser.add_argument('--workers', type=int, default=32, dest='workers',
+                        help='files pulled at once')
+    parser.add_argument('--service', type=float, default=1.0, dest='service',
+                        help='mean seconds to pull a file')
+    parser.add_argument('--large', type=int, default=20000, dest='large',
+                        help='files of the large cart')
+    parser.add_argument('--small-carts', type=int, default=200, dest='small_carts',
+                        help='number of small carts')
+    parser.add_argument('--small-files', type=int, default=10, dest='small_files',
+                        help='files of each small cart')
+    parser.add_argument('--interval', type=float, default=2.0, dest='interval',
+                        help='mean seconds between small carts')
+    parser.add_argument('--window', type=int, nargs='+', default=[0, 100], dest='window',
+                        help='dispatch windows to compare, 0 queues every file')
+    parser.add_argument('--seed', type=int, default=0, dest='seed',
+                        help='seed of the simulation')
+    args = parser.parse_args()
+    carts = make_carts(args.large, args.small_carts, args.small_files, args.interval, args.seed)
+    print('{0:>8} {1:>14} {2:>14} {3:>14}'.format(
+        'window', 'small mean s', 'small p95 s', 'large s'))
+    for window in args.window:
+        finished = simulate(carts, args.workers, args.service, window, args.seed)
+        small = [finish - arrival for (arrival, _), finish in zip(carts[1:], finished[1:])]
+        print('{0:>8} {1:>14.1f} {2:>14.1f} {3:>14.1f}'.format(
+            window, sum(small) / len(small), percentile(small, 0.95), finished[0]))
+
+
+if __name__ == '__main__':
+    main()
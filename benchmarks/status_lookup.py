@@ -0,0 +1,95 @@
+#!/usr/bin/python
+"""
+Benchmark the cart status lookup as the cart table grows, with and without
+the indexes on the hot query columns.
+
+python -m benchmarks.status_lookup --sizes 1000 10000 100000 1000000
+"""
+from __future__ import print_function
+import os
+import time
+import datetime
+import itertools
+from argparse import ArgumentParser
+from tempfile import mkstemp
+from playhouse.test_utils import test_database
+from peewee import SqliteDatabase
+from cart.cart_orm import Cart, File
+from cart.cart_utils import Cartutils
+
+
+def add_carts(start, stop, uids):
+    """Add historical carts start to stop spread over uids.  Every cart but
+    the newest for a uid is deleted, like the table of a long running cart.
+    """
+    now = datetime.datetime.now()
+    rows = ({'cart_uid': str(index % uids),
+             'creation_date': now + datetime.timedelta(seconds=index),
+             'updated_date': now + datetime.timedelta(seconds=index),
+             'deleted_date': None if index + uids >= stop else now,
+             'status': 'ready'}
+            for index in range(start, stop))
+    with Cart.atomic():
+        while True:
+            chunk = list(itertools.islice(rows, 500))
+            if not chunk:
+                break
+            Cart.insert_many(chunk).execute()
+    if start:
+        #the previous newest carts of the uids just added are history now
+        added = [str(index % uids) for index in range(max(start, stop - uids), stop)]
+        (Cart.update(deleted_date=now)
+         .where((Cart.id <= start) & Cart.deleted_date.is_null(True) &
+                (Cart.cart_uid << added))
+         .execute())
+
+
+def time_lookups(lookups, uids):
+    """Return the average microseconds of a cart_status call"""
+    start = time.time()
+    for index in range(lookups):
+        Cartutils.cart_status(str(index % uids))
+    return (time.time() - start) * 1000000 / lookups
+
+
+def drop_indexes(database):
+    """Drop the indexes on the hot query columns"""
+    for table in ['cart', 'file']:
+        for index in database.get_indexes(table):
+            database.execute_sql('DROP INDEX "%s"' % index.name)
+
+
+def main():
+    """Main function when running from the command line."""
+    parser = ArgumentParser(description='Benchmark cart status lookups.')
+    parser.add_argument('--sizes', metavar='CARTS', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000], dest='sizes',
+                        help='number of carts in the table for each measurement')
+    parser.add_argument('--uids', type=int, default=100, dest='uids',
+                        help='number of distinct cart uids')
+    parser.add_argument('--lookups', type=int, default=200, dest='lookups',
+                        help='number of status lookups timed at each size')
+    args = parser.parse_args()
+    print('{0:>10} {1:>16} {2:>16}'.format('carts', 'indexed usec', 'unindexed usec'))
+    results = {}
+    for indexed in [True, False]:
+        db_path = mkstemp(suffix='.sqlite3')[1]
+        database = SqliteDatabase(db_path)
+        try:
+            with test_database(database, (Cart, File)):
+                if not indexed:
+                    drop_indexes(database)
+                carts = 0
+                for size in sorted(args.sizes):
+                    add_carts(carts, size, args.uids)
+                    carts = size
+                    results[(indexed, size)] = time_lookups(args.lookups, args.uids)
+        finally:
+            os.unlink(db_path)
+    for size in sorted(args.sizes):
+        print('{0:>10} {1:>16.2f} {2:>16.2f}'.format(
+            size, results[(True, size)], results[(False, size)]))
+
+
+if __name__ == '__main__':
+    main()
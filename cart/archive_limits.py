@@ -0,0 +1,195 @@
+#!/usr/bin/python
+"""Limits on the requests every worker together has in flight against the
+archive interface.  Each request holds a lease row in the database for
+its operation, stage, status or pull, while it runs.  A lease is only
+taken while fewer than the limit are held, so however many workers there
+are the archive never has more requests than it is configured to take.
+
+Files recalled from a media other than disk, the file_storage_media the
+archive reports for them, hold a lease on that media from before they
+are staged until they are on disk.  The lease is kept by the file across
+the tasks checking on it, so a tape limit is the number of recalls the
+tape library works on at once.
+
+ARCHIVE_LIMITS sets them, a comma separated list of key=limit with keys
+stage, status, pull or a media such as tape.  Keys without a limit are
+unlimited.  Leases are renewed while they are held and expire
+ARCHIVE_LEASE_TIME seconds after a worker that died stops renewing them.
+"""
+import time
+import random
+import datetime
+import threading
+from contextlib import contextmanager
+from peewee import IntegrityError
+from cart.cart_orm import Cart, ArchiveLimit, ArchiveLease
+from cart.cart_env_globals import ARCHIVE_LIMITS, ARCHIVE_LEASE_TIME, ARCHIVE_LIMIT_POLL
+
+#requests that hold a lease while they run, the other keys are media
+OPERATIONS = ('stage', 'status', 'pull')
+
+
+def parse_limits(spec):
+    """Returns the limit of each key in a key=limit,... spec"""
+    limits = {}
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        key, _, limit = entry.partition('=')
+        key = key.strip()
+        if not key:
+            raise ValueError('Archive limit without a key ' + entry)
+        #files on disk arent recalled, their reads are limited with pull
+        if key == 'disk':
+            raise ValueError('Archive limit disk is never held, limit pull instead')
+        limits[key] = int(limit)
+    return limits
+
+LIMITS = parse_limits(ARCHIVE_LIMITS)
+
+
+def media_limited(media):
+    """Check if recalls from media are limited"""
+    return media in LIMITS and media not in OPERATIONS
+
+
+def any_media_limited():
+    """Check if any media is limited"""
+    return any(media_limited(key) for key in LIMITS)
+
+
+def _lease_expires(seconds=None):
+    """Expiry of a lease taken or renewed now, lasting seconds, by
+    default ARCHIVE_LEASE_TIME"""
+    if seconds is None:
+        seconds = ARCHIVE_LEASE_TIME
+    return datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+
+
+@contextmanager
+def _connection():
+    """Use the database connection of the thread, or one just for the
+    block when the thread isnt connected, as in the threads of a batch"""
+    # pylint: disable=no-member,protected-access
+    opened = Cart._meta.database.is_closed()
+    # pylint: enable=no-member,protected-access
+    Cart.database_connect()
+    try:
+        yield
+    finally:
+        if opened:
+            Cart.database_close()
+
+
+def _acquire(key, limit, owner=None, seconds=None):
+    """Take a lease on key for owner, lasting seconds, if fewer than limit
+    are held.  Returns the lease id, None if there are limit already"""
+    if not ArchiveLimit.select().where(ArchiveLimit.key == key).exists():
+        try:
+            ArchiveLimit.create(key=key)
+        except IntegrityError:
+            pass
+    with Cart.atomic():
+        #acquirers of key wait on each other where the database can lock
+        Cart.locking(ArchiveLimit.select().where(ArchiveLimit.key == key)).get()
+        ArchiveLease.delete().where(
+            (ArchiveLease.key == key) &
+            (ArchiveLease.expires < datetime.datetime.now())).execute()
+        if ArchiveLease.select().where(ArchiveLease.key == key).count() >= limit:
+            return None
+        return ArchiveLease.create(key=key, owner=owner, expires=_lease_expires(seconds)).id
+
+
+def acquire_all(keys):
+    """Take a lease on every limited key or none of them.  Returns the
+    lease ids, None if a key was at its limit"""
+    leases = []
+    with _connection():
+        for key in sorted(keys):
+            if key not in LIMITS:
+                continue
+            lease = _acquire(key, LIMITS[key])
+            if lease is None:
+                release(leases)
+                return None
+            leases.append(lease)
+    return leases
+
+
+def release(leases):
+    """Give back the leases"""
+    if leases:
+        with _connection():
+            ArchiveLease.delete().where(ArchiveLease.id << leases).execute()
+
+
+def renew(leases):
+    """Push back the expiry of leases still held"""
+    if leases:
+        with _connection():
+            ArchiveLease.update(expires=_lease_expires()).where(
+                ArchiveLease.id << leases).execute()
+
+
+def hold_media(owner, media, seconds=None):
+    """Take a lease on media for owner, the id of a file about to be
+    recalled from it, lasting seconds unless renewed.  An owner already
+    holding one keeps it.  Returns False if media is at its limit"""
+    if not media_limited(media):
+        return True
+    with _connection():
+        if renew_media(owner, seconds):
+            return True
+        return _acquire(media, LIMITS[media], str(owner), seconds) is not None
+
+
+def renew_media(owner, seconds=None):
+    """Push back the expiry of the media lease of owner to seconds from
+    now, call when checking on the file again later.  Returns False if
+    owner holds none"""
+    if not any_media_limited():
+        return False
+    with _connection():
+        return ArchiveLease.update(expires=_lease_expires(seconds)).where(
+            ArchiveLease.owner == str(owner)).execute() > 0
+
+
+def release_media(owner):
+    """Give back the media lease of owner, once the file is on disk or
+    failed"""
+    if not any_media_limited():
+        return
+    with _connection():
+        ArchiveLease.delete().where(ArchiveLease.owner == str(owner)).execute()
+
+
+def _keep_renewed(leases, done):
+    """Renew leases until done is set"""
+    while not done.wait(ARCHIVE_LEASE_TIME / 3.0):
+        renew(leases)
+
+
+@contextmanager
+def archive_slot(operation):
+    """Hold the lease of operation while the block runs, waiting for
+    it if the archive has all it is allowed of them in flight"""
+    if operation not in LIMITS:
+        yield
+        return
+    wait = ARCHIVE_LIMIT_POLL
+    leases = acquire_all([operation])
+    while leases is None:
+        #spread out the workers waiting on the same limit
+        time.sleep(random.uniform(0, wait))
+        wait = min(wait * 2, 30 * ARCHIVE_LIMIT_POLL)
+        leases = acquire_all([operation])
+    done = threading.Event()
+    renewer = threading.Thread(target=_keep_renewed, args=(leases, done))
+    renewer.daemon = True
+    renewer.start()
+    try:
+        yield
+    finally:
+        done.set()
+        renewer.join()
+        release(leases)
@@ -3,36 +3,377 @@ archive interface
 """
 
 from __future__ import absolute_import
-from json import dumps
+import io
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+import threading
+from json import dumps, loads
+from multiprocessing.pool import ThreadPool
 import requests
-from cart.cart_env_globals import  ARCHIVE_INTERFACE_URL
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import HTTPError as Urllib3Error
+from cart.cart_env_globals import ARCHIVE_INTERFACE_URL, ARCHIVE_POOL_CONNECTIONS
+from cart.cart_env_globals import ARCHIVE_POOL_MAXSIZE, ARCHIVE_POOL_BLOCK
+from cart.cart_env_globals import ARCHIVE_CONNECT_TIMEOUT, ARCHIVE_READ_TIMEOUT
+from cart.cart_env_globals import ARCHIVE_CHUNK_SIZE, ARCHIVE_PREALLOCATE
+from cart.cart_env_globals import ARCHIVE_BATCH_WORKERS
+from cart.cart_env_globals import ARCHIVE_RANGE_THRESHOLD, ARCHIVE_RANGE_SIZE, ARCHIVE_RANGE_WORKERS
+from cart.cart_env_globals import ARCHIVE_RESUME_CHECKPOINT
+from cart.archive_limits import archive_slot
+
+#a file is pulled to its path with PARTIAL_SUFFIX, and how far the pull
+#got is kept next to it with PARTIAL_STATE_SUFFIX added
+PARTIAL_SUFFIX = '.partial'
+PARTIAL_STATE_SUFFIX = '.json'
+
+
+def _libc_fallocate():
+    """Returns posix_fallocate(fd, offset, len) from libc, or None where
+    it isnt available.  Python 2 has no os.posix_fallocate."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_fallocate = getattr(libc, 'posix_fallocate64', None) or libc.posix_fallocate
+    except (OSError, AttributeError):
+        return None
+    libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    libc_fallocate.restype = ctypes.c_int
+
+    def fallocate(fileno, offset, length):
+        """Allocate the blocks of fileno from offset for length bytes"""
+        #the error is returned rather than set in errno
+        err = libc_fallocate(fileno, offset, length)
+        if err:
+            raise OSError(err, os.strerror(err))
+    return fallocate
+
+FALLOCATE = getattr(os, 'posix_fallocate', None) or _libc_fallocate()
+
+
+def _pwrite(fileno, data, offset):
+    """Write all of data at offset.  Without os.pwrite, as in Python 2,
+    the file offset is moved, so fileno must not be shared by threads"""
+    pwrite = getattr(os, 'pwrite', None)
+    while len(data):
+        if pwrite is not None:
+            written = pwrite(fileno, data, offset)
+        else:
+            os.lseek(fileno, offset, os.SEEK_SET)
+            written = os.write(fileno, data)
+        data = data[written:]
+        offset += written
+
+
+def _check_range(resp, start, end):
+    """Raise unless resp is the archive sending the bytes from start to end"""
+    content_range = resp.headers.get('content-range', '')
+    if resp.status_code != 206 or not content_range.startswith(
+            'bytes {0}-{1}/'.format(start, end)):
+        raise requests.exceptions.RequestException(
+            'Archive sent {0} {1} for bytes {2}-{3}'.format(
+                resp.status_code, content_range, start, end))
+
+
+def _save_partial(partial, mtime, offset):
+    """Record the bytes of partial pulled in order, for a file of mtime.
+    Nothing is recorded without an mtime to check the file against"""
+    if mtime is None or not offset:
+        return
+    state_path = partial + PARTIAL_STATE_SUFFIX
+    with open(state_path + '.tmp', 'w') as state_file:
+        state_file.write(dumps({'mtime': str(mtime), 'offset': offset}))
+    os.rename(state_path + '.tmp', state_path)
+
+
+def _remove(path):
+    """Remove path if it is there"""
+    try:
+        os.unlink(path)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
 
 
 class ArchiveRequests(object):
     """class that supports all the requests to the archive
     interface
     """
+    #pooled session shared by every instance in this process
+    _session = None
+    _session_pid = None
+    _session_lock = threading.Lock()
+    #per thread copy buffer, allocated once and reused for every pull
+    _buffers = threading.local()
 
     def __init__(self):
         self._url = ARCHIVE_INTERFACE_URL
+        self._timeout = (ARCHIVE_CONNECT_TIMEOUT, ARCHIVE_READ_TIMEOUT)
+
+    @classmethod
+    def session(cls):
+        """Return the pooled session for this process.  Celery forks its
+        workers so a session inherited from the parent is replaced, the
+        sockets in its pool belong to the parent process.
+        """
+        with cls._session_lock:
+            if cls._session is None or cls._session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=ARCHIVE_POOL_CONNECTIONS,
+                                      pool_maxsize=ARCHIVE_POOL_MAXSIZE,
+                                      pool_block=ARCHIVE_POOL_BLOCK)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                cls._session = session
+                cls._session_pid = os.getpid()
+            return cls._session
 
-    def pull_file(self, archive_filename, cart_filepath):
+    @classmethod
+    def _buffer(cls):
+        """Return the preallocated copy buffer for this thread"""
+        buf = getattr(cls._buffers, 'buf', None)
+        if buf is None or len(buf) != ARCHIVE_CHUNK_SIZE:
+            buf = bytearray(ARCHIVE_CHUNK_SIZE)
+            cls._buffers.buf = buf
+        return buf
+
+    @staticmethod
+    def _preallocate(fileno, filesize):
+        """Reserve the blocks for the file up front when the platform
+        supports it.  Failing to preallocate is not an error, the file
+        just grows as it is written.
+        """
+        if not ARCHIVE_PREALLOCATE or FALLOCATE is None or filesize <= 0:
+            return
+        try:
+            FALLOCATE(fileno, 0, filesize)
+        except OSError:
+            pass
+
+    def pull_file(self, archive_filename, cart_filepath, filesize=None, hasher=None,
+                  mtime=None):
         """Performs a request that will attempt to write
         the contents of a file from the archive interface
-        to the specified cart filepath
+        to the specified cart filepath.  Returns the number
+        of bytes written.  Files of ARCHIVE_RANGE_THRESHOLD bytes
+        or more are pulled in ranges over several connections when
+        the archive supports it.  hasher, a hashlib object, is
+        updated with the bytes as they are written.
+
+        The file is written to a .partial file that is renamed into
+        place once complete.  When mtime is given, a pull that fails
+        part way records how far it got and the next pull of the file
+        with the same mtime resumes from there.  The pull waits for
+        room under the archive pull limits, see archive_limits
         """
-        resp = requests.get(str(self._url + archive_filename), stream=True)
-        myfile = open(cart_filepath, 'wb+')
-        buf = resp.raw.read(1024)
-        while len(buf):
-            myfile.write(buf)
-            buf = resp.raw.read(1024)
-        myfile.close()
+        with archive_slot('pull'):
+            return self._pull(archive_filename, cart_filepath, filesize, hasher, mtime)
+
+    def _pull(self, archive_filename, cart_filepath, filesize, hasher, mtime):
+        """Pull the file as pull_file describes"""
+        url = str(self._url + archive_filename)
+        partial = cart_filepath + PARTIAL_SUFFIX
+        offset = self._partial_offset(partial, mtime, filesize)
+        if filesize and 0 < ARCHIVE_RANGE_THRESHOLD <= int(filesize):
+            resp = self._get_range(
+                url, offset, min(offset + ARCHIVE_RANGE_SIZE, int(filesize)) - 1)
+            if resp.status_code == 206:
+                written = self._pull_ranges(url, resp, partial, int(filesize), hasher,
+                                            offset, mtime)
+                self._finish_partial(partial, cart_filepath)
+                return written
+        elif offset:
+            resp = self._get_range(url, offset, int(filesize) - 1)
+        else:
+            resp = self.session().get(url, stream=True, timeout=self._timeout)
+        if resp.status_code != 206:
+            #the archive ignored the range and is sending the whole file
+            offset = 0
+        written = self._pull_stream(resp, partial, filesize, hasher, offset, mtime)
+        self._finish_partial(partial, cart_filepath)
+        return written
+
+    def _pull_stream(self, resp, partial, filesize, hasher, offset, mtime):
+        """Write the body of resp into partial from offset, saving how far
+        it got every ARCHIVE_RESUME_CHECKPOINT bytes and when it fails"""
+        try:
+            if offset:
+                _check_range(resp, offset, int(filesize) - 1)
+                self._hash_range(partial, 0, offset - 1, hasher)
+        except requests.exceptions.RequestException:
+            resp.close()
+            raise
+        buf = self._buffer()
+        view = memoryview(buf)
+        written = offset
+        checkpoint = written + ARCHIVE_RESUME_CHECKPOINT
+        try:
+            with io.open(partial, 'r+b' if offset else 'wb') as myfile:
+                if offset:
+                    myfile.seek(offset)
+                elif filesize:
+                    self._preallocate(myfile.fileno(), int(filesize))
+                nread = resp.raw.readinto(buf)
+                while nread:
+                    myfile.write(view[:nread])
+                    if hasher is not None:
+                        hasher.update(view[:nread])
+                    written += nread
+                    if written >= checkpoint:
+                        myfile.flush()
+                        _save_partial(partial, mtime, written)
+                        checkpoint = written + ARCHIVE_RESUME_CHECKPOINT
+                    nread = resp.raw.readinto(buf)
+                #drop any preallocated space past what was actually received
+                if filesize and written < int(filesize):
+                    myfile.truncate(written)
+        except (IOError, Urllib3Error) as ex:
+            _save_partial(partial, mtime, written)
+            resp.close()
+            if isinstance(ex, requests.exceptions.RequestException):
+                raise
+            raise requests.exceptions.RequestException(
+                'Pull failed after {0} bytes with error: {1}'.format(written, ex))
+        #return the connection to the pool for the next request
+        resp.close()
+        if filesize and written < int(filesize):
+            #the archive stopped early, resume from what did arrive
+            _save_partial(partial, mtime, written)
+            raise requests.exceptions.RequestException(
+                'Archive sent {0} of {1} bytes'.format(written, filesize))
+        return written
+
+    @staticmethod
+    def _partial_offset(partial, mtime, filesize):
+        """Returns the offset to resume the pull into partial from, 0 to
+        start over.  What is left of a pull that cant be resumed, as the
+        file changed in the archive, is removed"""
+        try:
+            with open(partial + PARTIAL_STATE_SUFFIX, 'r') as state_file:
+                state = loads(state_file.read())
+            offset = int(state['offset'])
+            if (mtime is not None and filesize and state['mtime'] == str(mtime) and
+                    0 < offset < int(filesize) and os.path.getsize(partial) >= offset):
+                return offset
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+        ArchiveRequests.discard_partial(partial[:-len(PARTIAL_SUFFIX)])
+        return 0
+
+    @staticmethod
+    def _finish_partial(partial, cart_filepath):
+        """Move the completed partial file into place"""
+        os.rename(partial, cart_filepath)
+        _remove(partial + PARTIAL_STATE_SUFFIX)
+
+    @staticmethod
+    def discard_partial(cart_filepath):
+        """Remove what is left of a failed pull of cart_filepath"""
+        _remove(cart_filepath + PARTIAL_SUFFIX)
+        _remove(cart_filepath + PARTIAL_SUFFIX + PARTIAL_STATE_SUFFIX)
+
+    def _get_range(self, url, start, end):
+        """Request the bytes from start to end, inclusive, of url"""
+        return self.session().get(url, stream=True, timeout=self._timeout,
+                                  headers={'Range': 'bytes={0}-{1}'.format(start, end)})
+
+    def _pull_ranges(self, url, first, partial, filesize, hasher=None, offset=0, mtime=None):
+        """Pull the file from offset in ARCHIVE_RANGE_SIZE ranges,
+        ARCHIVE_RANGE_WORKERS at a time, each written in place into the
+        preallocated file.  first is the response to the request for the
+        first range.  Ranges are hashed in order as they finish, while
+        still in the page cache, and how far the pull got in order is saved
+        after each so a failed pull resumes from there"""
+        if offset:
+            self._hash_range(partial, 0, offset - 1, hasher)
+        else:
+            with io.open(partial, 'wb') as myfile:
+                self._preallocate(myfile.fileno(), filesize)
+                myfile.truncate(filesize)
+        first_end = min(offset + ARCHIVE_RANGE_SIZE, filesize) - 1
+        ranges = [(start, min(start + ARCHIVE_RANGE_SIZE, filesize) - 1)
+                  for start in range(first_end + 1, filesize, ARCHIVE_RANGE_SIZE)]
+        done = offset
+        pool = ThreadPool(max(1, min(ARCHIVE_RANGE_WORKERS, len(ranges))))
+        try:
+            results = [pool.apply_async(self._pull_range, (url, None, partial, start, end))
+                       for start, end in ranges]
+            self._pull_range(url, first, partial, offset, first_end)
+            self._hash_range(partial, offset, first_end, hasher)
+            done = first_end + 1
+            _save_partial(partial, mtime, done)
+            for (start, end), result in zip(ranges, results):
+                result.get()
+                self._hash_range(partial, start, end, hasher)
+                done = end + 1
+                _save_partial(partial, mtime, done)
+        except (IOError, Urllib3Error) as ex:
+            #dont pull the rest of a file that has already failed
+            pool.terminate()
+            _save_partial(partial, mtime, done)
+            if isinstance(ex, requests.exceptions.RequestException):
+                raise
+            raise requests.exceptions.RequestException(
+                'Pull failed after {0} bytes with error: {1}'.format(done, ex))
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        return filesize
+
+    def _pull_range(self, url, resp, cart_filepath, start, end):
+        """Write the bytes from start to end of url into cart_filepath,
+        requesting them unless resp is already the response for them"""
+        if resp is None:
+            resp = self._get_range(url, start, end)
+        try:
+            _check_range(resp, start, end)
+            buf = self._buffer()
+            view = memoryview(buf)
+            offset = start
+            fileno = os.open(cart_filepath, os.O_WRONLY)
+            try:
+                nread = resp.raw.readinto(buf)
+                while nread and offset <= end:
+                    nread = min(nread, end + 1 - offset)
+                    _pwrite(fileno, view[:nread], offset)
+                    offset += nread
+                    nread = resp.raw.readinto(buf)
+            finally:
+                os.close(fileno)
+        finally:
+            resp.close()
+        if offset != end + 1:
+            raise requests.exceptions.RequestException(
+                'Archive sent {0} of bytes {1}-{2}'.format(offset - start, start, end))
+
+    def _hash_range(self, cart_filepath, start, end, hasher):
+        """Update hasher with the bytes from start to end of cart_filepath"""
+        if hasher is None:
+            return
+        buf = self._buffer()
+        view = memoryview(buf)
+        with io.open(cart_filepath, 'rb') as myfile:
+            myfile.seek(start)
+            remaining = end + 1 - start
+            while remaining > 0:
+                nread = myfile.readinto(buf)
+                if not nread:
+                    break
+                nread = min(nread, remaining)
+                hasher.update(view[:nread])
+                remaining -= nread
 
     def stage_file(self, file_name):
         """Sends a post to the archive interface telling it to stage the file
         """
-        resp = requests.post(str(self._url + file_name))
+        with archive_slot('stage'):
+            resp = self.session().post(str(self._url + file_name), timeout=self._timeout)
         if str(resp.status_code) == '500':
             raise requests.exceptions.RequestException(str(dumps(resp.text)))
 
@@ -54,5 +395,42 @@ class ArchiveRequests(object):
         """Gets a status from the  archive interface via Head and
         returns response """
 
-        resp = requests.head(str(self._url + file_name))
+        with archive_slot('status'):
+            resp = self.session().head(str(self._url + file_name), timeout=self._timeout)
         return dumps(self._status_dict(resp.headers, file_name))
+
+    @staticmethod
+    def _batch(method, file_names):
+        """Run method against every file name concurrently.  Returns a
+        dictionary of file name to the method return, or to the request
+        exception raised for that file
+        """
+        def capture(file_name):
+            """keep a failure from cancelling the rest of the batch"""
+            try:
+                return method(file_name)
+            except requests.exceptions.RequestException as ex:
+                return ex
+
+        file_names = list(set(file_names))
+        if not file_names:
+            return {}
+        pool = ThreadPool(max(1, min(ARCHIVE_BATCH_WORKERS, len(file_names))))
+        try:
+            results = pool.map(capture, file_names)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(file_names, results))
+
+    def stage_files(self, file_names):
+        """Stage a group of files.  Returns a dictionary of file name to
+        None on success or the request exception on failure
+        """
+        return self._batch(self.stage_file, file_names)
+
+    def status_files(self, file_names):
+        """Status a group of files.  Returns a dictionary of file name to
+        the status_file response or the request exception on failure
+        """
+        return self._batch(self.status_file, file_names)
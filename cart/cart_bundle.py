@@ -0,0 +1,504 @@
+#!/usr/bin/python
+"""Streams a cart directory out as a bundle without forking.  The bundle
+is generated as the WSGI server iterates over it, holding at most one
+block of file data in memory.
+
+The layout of the bundle only depends on the names, sizes and metadata
+of the files, so its length and where each member starts are known
+before any data is read.  That lets a download be resumed part way.
+
+Compressed bundles are compressed in independent blocks on a pool of
+threads, zlib and zstd release the GIL while they work.
+
+Zip bundles are streamed too, each member is followed by a data
+descriptor and the central directory is spooled to a temporary file
+until the end.
+"""
+import os
+import stat
+import time
+import zlib
+import struct
+import hashlib
+import tarfile
+import tempfile
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from cart.cart_env_globals import CART_GZIP_LEVEL, CART_ZSTD_LEVEL
+from cart.cart_env_globals import CART_COMPRESS_WORKERS, CART_COMPRESS_BLOCK
+from cart.cart_env_globals import CART_INCOMPRESSIBLE_RATIO
+try:
+    import zstandard
+except ImportError: # pragma: no cover
+    zstandard = None
+
+
+BLOCK_SIZE = 1<<20
+
+#file name suffix of each pre-built bundle format
+PREBUILT_SUFFIXES = {'tar': '.tar', 'gz': '.tar.gz', 'zstd': '.tar.zst'}
+
+#pax header keywords of the checksums of members
+PAX_HASHTYPE = 'PACIFICA.hashtype'
+PAX_HASHSUM = 'PACIFICA.hashsum'
+
+#bytes of a file compressed to decide if the file is worth compressing
+COMPRESS_SAMPLE = 1<<16
+
+def read_segment(path, offset, size, block_size=BLOCK_SIZE):
+    """Yields size bytes of path from offset.  A file that shrank since it
+    was statted is padded with NULs so an archive of it stays readable."""
+    with open(path, 'rb') as member_file:
+        member_file.seek(offset)
+        while size > 0:
+            buf = member_file.read(min(block_size, size))
+            if not buf:
+                break
+            size -= len(buf)
+            yield buf
+    while size > 0:
+        fill = min(block_size, size)
+        size -= fill
+        yield tarfile.NUL * fill
+
+def prebuilt_path(bundle_path, bundle_format='tar'):
+    """Path of the pre-built bundle of the cart directory bundle_path"""
+    return bundle_path + PREBUILT_SUFFIXES[bundle_format]
+
+def write_bundle(stream, path, bundle_format='tar'):
+    """Write stream out to path in bundle_format.  The bundle is written
+    to a temporary file first so a partly written bundle is never served"""
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    if bundle_format != 'tar':
+        stream = CompressedStream(stream, bundle_format)
+    try:
+        with open(tmp_path, 'wb') as bundle_file:
+            for buf in stream:
+                bundle_file.write(buf)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class TarStream(object):
+    """Iterable of the blocks of a tar file of the cart directory.  The
+    members are added in sorted order, directories before their contents,
+    like TarFile.add would add them.  Members named in checksums, a dict
+    of member name to hashtype and hashsum, carry them in a pax header.
+    """
+    def __init__(self, cart_path, arcname, block_size=BLOCK_SIZE, checksums=None):
+        self._cart_path = cart_path
+        self._arcname = arcname
+        self._block_size = block_size
+        self._checksums = checksums or {}
+        self._size = None
+        self._etag = None
+        self._start = 0
+        self._stop = None
+
+    def members(self):
+        """Yields the TarInfo and path on disk of every member"""
+        return self._walk(self._cart_path, self._arcname)
+
+    def _walk(self, path, arcname):
+        """Walk path depth first in a fixed order"""
+        tarinfo = self.tarinfo(path, arcname)
+        if tarinfo is None:
+            return
+        yield tarinfo, path
+        if tarinfo.isdir():
+            for name in sorted(os.listdir(path)):
+                for member in self._walk(os.path.join(path, name), arcname + '/' + name):
+                    yield member
+
+    @staticmethod
+    def tarinfo(path, arcname):
+        """Build the TarInfo for path, None for things tar cant store"""
+        statres = os.lstat(path)
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.mode = stat.S_IMODE(statres.st_mode)
+        tarinfo.mtime = int(statres.st_mtime)
+        if stat.S_ISREG(statres.st_mode):
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = statres.st_size
+        elif stat.S_ISDIR(statres.st_mode):
+            tarinfo.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(statres.st_mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(path)
+        else:
+            return None
+        return tarinfo
+
+    @staticmethod
+    def header(tarinfo, checksum=None):
+        """Return the header blocks of a member, with a pax header of its
+        hashtype and hashsum when checksum is given"""
+        if checksum is None:
+            return tarinfo.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING, 'strict')
+        tarinfo.pax_headers = {PAX_HASHTYPE: checksum[0], PAX_HASHSUM: checksum[1]}
+        return tarinfo.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, 'strict')
+
+    @staticmethod
+    def padding(size):
+        """Return the NULs that fill the last block of a member of size"""
+        return tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+
+    @staticmethod
+    def trailer(offset):
+        """Return the end of archive blocks for a tar ending at offset"""
+        size = offset + 2 * tarfile.BLOCKSIZE
+        return tarfile.NUL * (2 * tarfile.BLOCKSIZE + (-size % tarfile.RECORDSIZE))
+
+    def _layout(self):
+        """Yields every piece of the tar in order.  Headers and padding are
+        strings, the data of a file is a (path, offset, size) tuple"""
+        offset = 0
+        for tarinfo, path in self.members():
+            header = self.header(tarinfo, self._checksums.get(tarinfo.name))
+            offset += len(header)
+            yield header
+            if tarinfo.isreg() and tarinfo.size:
+                yield (path, 0, tarinfo.size)
+                padding = self.padding(tarinfo.size)
+                offset += tarinfo.size + len(padding)
+                if padding:
+                    yield padding
+        yield self.trailer(offset)
+
+    def size(self):
+        """Return the length of the whole tar.  Only stats the files"""
+        if self._size is None:
+            self._measure()
+        return self._size
+
+    def etag(self):
+        """Return the strong entity tag of the tar, a digest of the member
+        headers that hold the name, size and mtime of every file"""
+        if self._etag is None:
+            self._measure()
+        return self._etag
+
+    def _measure(self):
+        """Work out the length and entity tag of the tar in one walk"""
+        digest = hashlib.sha1()
+        size = 0
+        for segment in self._layout():
+            if isinstance(segment, tuple):
+                size += segment[2]
+            else:
+                size += len(segment)
+                digest.update(segment)
+        self._size = size
+        self._etag = '"{0}"'.format(digest.hexdigest())
+
+    def select(self, start, stop):
+        """Only send the bytes from start up to, not including, stop"""
+        self._start = start
+        self._stop = stop
+
+    def segments(self):
+        """Yields the pieces of the selected bytes of the tar.  File data
+        is a (path, offset, size) tuple so it can be sent without reading
+        it into python.  Members before the selection are skipped without
+        reading them"""
+        offset = 0
+        for segment in self._layout():
+            length = segment[2] if isinstance(segment, tuple) else len(segment)
+            start = max(self._start - offset, 0)
+            stop = length if self._stop is None else min(self._stop - offset, length)
+            offset += length
+            if start >= stop:
+                if self._stop is not None and offset >= self._stop:
+                    return
+                continue
+            if isinstance(segment, tuple):
+                yield (segment[0], segment[1] + start, stop - start)
+            else:
+                yield segment[start:stop]
+
+    def __iter__(self):
+        for segment in self.segments():
+            if isinstance(segment, tuple):
+                for buf in read_segment(*segment, block_size=self._block_size):
+                    yield buf
+            else:
+                yield segment
+
+
+class FileStream(object):
+    """Iterable of the blocks of a file on disk, like a pre-built bundle.
+    Has the size, select and segments of TarStream so it is sent the
+    same way."""
+    def __init__(self, path, block_size=BLOCK_SIZE):
+        self._path = path
+        self._block_size = block_size
+        self._stat = os.stat(path)
+        self._size = self._stat.st_size
+        self._start = 0
+        self._stop = self._size
+
+    def size(self):
+        """Return the length of the file"""
+        return self._size
+
+    def etag(self):
+        """Return the strong entity tag of the file.  Bundles are replaced
+        by renaming a new file over them, which changes the inode"""
+        return '"{0:x}-{1:x}-{2:x}"'.format(self._stat.st_ino, self._size,
+                                             int(self._stat.st_mtime * 1000000))
+
+    def select(self, start, stop):
+        """Only send the bytes from start up to, not including, stop"""
+        self._start = start
+        self._stop = stop
+
+    def segments(self):
+        """Yields the selected bytes as a (path, offset, size) tuple"""
+        if self._stop > self._start:
+            yield (self._path, self._start, self._stop - self._start)
+
+    def __iter__(self):
+        for segment in self.segments():
+            for buf in read_segment(*segment, block_size=self._block_size):
+                yield buf
+
+
+def compression_available(bundle_format):
+    """Check bundle_format can be compressed here"""
+    if bundle_format == 'zstd':
+        return zstandard is not None
+    return bundle_format == 'gz'
+
+def compress_block(bundle_format, data, compressible):
+    """Compress data into a complete gzip member or zstd frame.  Members
+    and frames can be concatenated, so blocks are compressed independently
+    and joined in order.  Incompressible data is stored as it is."""
+    if bundle_format == 'zstd':
+        level = CART_ZSTD_LEVEL if compressible else 1
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    level = CART_GZIP_LEVEL if compressible else 0
+    #wbits of 31 writes the gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def is_compressible(sample):
+    """Check the sample gets smaller than CART_INCOMPRESSIBLE_RATIO of its
+    size when compressed quickly"""
+    if not sample:
+        return True
+    return len(zlib.compress(sample, 1)) < len(sample) * CART_INCOMPRESSIBLE_RATIO
+
+
+class CompressedStream(object):
+    """Iterable of the compressed blocks of a bundle stream.  The stream
+    is cut into blocks of CART_COMPRESS_BLOCK bytes that are compressed
+    on the shared pool, at most two blocks per worker are in memory.
+    Files that dont compress are detected from their first bytes and
+    stored.
+    """
+    _pool = None
+    _pool_pid = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self, stream, bundle_format, workers=CART_COMPRESS_WORKERS,
+                 block_size=CART_COMPRESS_BLOCK):
+        self._stream = stream
+        self._format = bundle_format
+        self._workers = max(1, workers)
+        self._block_size = block_size
+
+    @classmethod
+    def pool(cls, workers):
+        """Return the compression pool for this process"""
+        with cls._pool_lock:
+            if cls._pool is None or cls._pool_pid != os.getpid():
+                cls._pool = ThreadPool(workers)
+                cls._pool_pid = os.getpid()
+            return cls._pool
+
+    def _chunks(self):
+        """Yields the data of the stream and whether it is compressible"""
+        for segment in self._stream.segments():
+            if not isinstance(segment, tuple):
+                yield segment, True
+                continue
+            compressible = None
+            for buf in read_segment(*segment, block_size=self._block_size):
+                if compressible is None:
+                    compressible = is_compressible(buf[:COMPRESS_SAMPLE])
+                yield buf, compressible
+
+    def _blocks(self):
+        """Yields blocks of up to block_size bytes of the stream that are
+        all compressible or all not"""
+        pending = []
+        pending_size = 0
+        pending_flag = True
+        for data, compressible in self._chunks():
+            if pending and compressible != pending_flag:
+                yield ''.join(pending), pending_flag
+                pending, pending_size = [], 0
+            pending_flag = compressible
+            while data:
+                take = data[:self._block_size - pending_size]
+                data = data[len(take):]
+                pending.append(take)
+                pending_size += len(take)
+                if pending_size >= self._block_size:
+                    yield ''.join(pending), pending_flag
+                    pending, pending_size = [], 0
+        if pending:
+            yield ''.join(pending), pending_flag
+
+    def __iter__(self):
+        if self._workers == 1:
+            for data, compressible in self._blocks():
+                yield compress_block(self._format, data, compressible)
+            return
+        pool = self.pool(self._workers)
+        window = deque()
+        for data, compressible in self._blocks():
+            window.append(pool.apply_async(compress_block, (self._format, data, compressible)))
+            if len(window) >= 2 * self._workers:
+                yield window.popleft().get()
+        while window:
+            yield window.popleft().get()
+
+
+#sizes, offsets and counts past these need the zip64 records, where the
+#zip32 fields are set to all ones
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_ENTRIES_LIMIT = 0xFFFF
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+#general purpose flag for names encoded as utf-8
+ZIP_UTF8 = 0x800
+
+class ZipStream(object):
+    """Iterable of the blocks of a zip file of the cart directory, with
+    the members of the TarStream of the directory in the same order.
+    Files that compress are deflated, the rest are stored.  Every file
+    gets a zip64 local header as its sizes arent known until it is sent,
+    the central directory only uses zip64 where it is needed.
+    """
+    def __init__(self, cart_path, arcname, block_size=BLOCK_SIZE):
+        self._tar = TarStream(cart_path, arcname, block_size)
+        self._block_size = block_size
+
+    @staticmethod
+    def _dos_time(mtime):
+        """Return the dos time and date of mtime"""
+        mtime = time.localtime(max(mtime, 315532800))
+        return (mtime.tm_hour << 11 | mtime.tm_min << 5 | mtime.tm_sec // 2,
+                (mtime.tm_year - 1980) << 9 | mtime.tm_mon << 5 | mtime.tm_mday)
+
+    def _file_data(self, tarinfo, path):
+        """Yields the data of a member, the file contents for files and the
+        target for symlinks"""
+        if tarinfo.issym():
+            yield tarinfo.linkname
+        elif tarinfo.isreg() and tarinfo.size:
+            for buf in read_segment(path, 0, tarinfo.size, self._block_size):
+                yield buf
+
+    def _entry(self, tarinfo, path, offset, central):
+        """Yields the local header, data and descriptor of a member at
+        offset and writes its central directory record to central"""
+        name = tarinfo.name + '/' if tarinfo.isdir() else tarinfo.name
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        dos_time, dos_date = self._dos_time(tarinfo.mtime)
+        data = self._file_data(tarinfo, path)
+        first = next(data, '')
+        method = ZIP_STORED
+        if tarinfo.isreg() and is_compressible(first[:COMPRESS_SAMPLE]):
+            method = ZIP_DEFLATED
+        if tarinfo.isdir():
+            #directories have no data so need no descriptor
+            yield struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, ZIP_UTF8, 0, dos_time, dos_date,
+                              0, 0, 0, len(name), 0) + name
+            crc = size = compressed = 0
+        else:
+            yield struct.pack('<IHHHHHIIIHH', 0x04034b50, 45, ZIP_UTF8 | 0x08, method, dos_time,
+                              dos_date, 0, 0xFFFFFFFF, 0xFFFFFFFF, len(name), 20) + \
+                name + struct.pack('<HHQQ', 1, 16, 0, 0)
+            crc = size = compressed = 0
+            compressor = None
+            if method == ZIP_DEFLATED:
+                compressor = zlib.compressobj(CART_GZIP_LEVEL, zlib.DEFLATED, -15)
+            buf = first
+            while buf:
+                crc = zlib.crc32(buf, crc)
+                size += len(buf)
+                if compressor:
+                    buf = compressor.compress(buf)
+                compressed += len(buf)
+                if buf:
+                    yield buf
+                buf = next(data, '')
+            if compressor:
+                buf = compressor.flush()
+                compressed += len(buf)
+                yield buf
+            crc &= 0xFFFFFFFF
+            yield struct.pack('<IIQQ', 0x08074b50, crc, compressed, size)
+        central.write(self._central_record(tarinfo, name, method, dos_time, dos_date,
+                                           crc, compressed, size, offset))
+
+    @staticmethod
+    def _central_record(tarinfo, name, method, dos_time, dos_date, crc, compressed, size,
+                        offset):
+        """Return the central directory record of a member"""
+        extra = []
+        if size >= ZIP64_LIMIT or compressed >= ZIP64_LIMIT:
+            extra.extend([size, compressed])
+            size = compressed = 0xFFFFFFFF
+        if offset >= ZIP64_LIMIT:
+            extra.append(offset)
+            offset = 0xFFFFFFFF
+        extra = struct.pack('<HH' + 'Q' * len(extra), 1, 8 * len(extra), *extra) if extra else ''
+        mode = tarinfo.mode | {tarfile.DIRTYPE: stat.S_IFDIR,
+                               tarfile.SYMTYPE: stat.S_IFLNK}.get(tarinfo.type, stat.S_IFREG)
+        external = (mode << 16) | (0x10 if tarinfo.isdir() else 0)
+        flags = ZIP_UTF8 if tarinfo.isdir() else ZIP_UTF8 | 0x08
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | 45, 45, flags, method,
+                           dos_time, dos_date, crc, compressed, size, len(name), len(extra),
+                           0, 0, 0, external, offset) + name + extra
+
+    @staticmethod
+    def _end(entries, central_offset, central_size):
+        """Return the end of central directory records"""
+        end = ''
+        if (entries >= ZIP_ENTRIES_LIMIT or central_offset >= ZIP64_LIMIT or
+                central_size >= ZIP64_LIMIT):
+            zip64_offset = central_offset + central_size
+            end = struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 3 << 8 | 45, 45, 0, 0,
+                              entries, entries, central_size, central_offset)
+            end += struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1)
+            entries = 0xFFFF if entries >= ZIP_ENTRIES_LIMIT else entries
+            central_offset = 0xFFFFFFFF if central_offset >= ZIP64_LIMIT else central_offset
+            central_size = 0xFFFFFFFF if central_size >= ZIP64_LIMIT else central_size
+        return end + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, entries, entries,
+                                 central_size, central_offset, 0)
+
+    def __iter__(self):
+        offset = 0
+        entries = 0
+        central = tempfile.TemporaryFile()
+        try:
+            for tarinfo, path in self._tar.members():
+                entries += 1
+                start = offset
+                for buf in self._entry(tarinfo, path, start, central):
+                    offset += len(buf)
+                    yield buf
+            central_size = central.tell()
+            central.seek(0)
+            for buf in iter(lambda: central.read(self._block_size), ''):
+                yield buf
+            yield self._end(entries, offset, central_size)
+        finally:
+            central.close()
@@ -6,6 +6,7 @@ unit test environment
 """
 import os
 import logging
+import multiprocessing
 
 
 VOLUME_PATH = os.getenv('VOLUME_PATH', '/tmp/')
@@ -18,8 +19,141 @@ ARCHIVE_INTERFACE_URL = ('http://' + ARCHIVE_INTERFACE_ADDR +
                          ':' + ARCHIVE_INTERFACE_PORT + '/')
 ARCHIVE_INTERFACE_URL = os.getenv('ARCHIVE_INTERFACE_URL', ARCHIVE_INTERFACE_URL)
 
+#http connection pool used for the archive interface requests.
+#Number of host pools to cache and max connections kept per host
+ARCHIVE_POOL_CONNECTIONS = int(os.getenv('ARCHIVE_POOL_CONNECTIONS', 4))
+ARCHIVE_POOL_MAXSIZE = int(os.getenv('ARCHIVE_POOL_MAXSIZE', 16))
+#block instead of opening extra connections when the pool is exhausted
+ARCHIVE_POOL_BLOCK = os.getenv('ARCHIVE_POOL_BLOCK', 'False') == 'True'
+
+#timeouts (seconds) for connecting to and reading from the archive interface
+ARCHIVE_CONNECT_TIMEOUT = float(os.getenv('ARCHIVE_CONNECT_TIMEOUT', 10))
+ARCHIVE_READ_TIMEOUT = float(os.getenv('ARCHIVE_READ_TIMEOUT', 300))
+
+#size of the buffer (bytes) used when streaming files out of the archive.
+#Default 4 MiB
+ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', 1 << 22))
+#preallocate the cart file from the archive reported size before writing
+ARCHIVE_PREALLOCATE = os.getenv('ARCHIVE_PREALLOCATE', 'True') == 'True'
+
+#files of at least ARCHIVE_RANGE_THRESHOLD bytes are pulled as ranges of
+#ARCHIVE_RANGE_SIZE bytes, ARCHIVE_RANGE_WORKERS at a time, when the archive
+#supports ranges.  0 pulls every file over one connection
+ARCHIVE_RANGE_THRESHOLD = int(os.getenv('ARCHIVE_RANGE_THRESHOLD', 0))
+ARCHIVE_RANGE_SIZE = int(os.getenv('ARCHIVE_RANGE_SIZE', 1 << 26))
+ARCHIVE_RANGE_WORKERS = int(os.getenv('ARCHIVE_RANGE_WORKERS', 8))
+
+#bytes pulled between recording how far a pull got, so a failed pull can
+#be resumed from there.  Pulls cut off by an error record it as well
+ARCHIVE_RESUME_CHECKPOINT = int(os.getenv('ARCHIVE_RESUME_CHECKPOINT', 1 << 26))
+#number of times a failed pull is tried again before the file is an error
+ARCHIVE_PULL_RETRIES = int(os.getenv('ARCHIVE_PULL_RETRIES', 1))
+
+#requests every worker together may have in flight against the archive,
+#a comma separated list of key=limit with keys stage, status, pull or a
+#media files are recalled from, like tape.  Empty leaves them unlimited,
+#see archive_limits
+ARCHIVE_LIMITS = os.getenv('ARCHIVE_LIMITS', '')
+#seconds a limit lease outlives a worker that stopped renewing it
+ARCHIVE_LEASE_TIME = float(os.getenv('ARCHIVE_LEASE_TIME', 300))
+#first wait (seconds) between tries for a lease, doubling up to 30 times it
+ARCHIVE_LIMIT_POLL = float(os.getenv('ARCHIVE_LIMIT_POLL', 0.5))
+
+#number of files statused/staged together by one batch task.
+#0 disables batching and every file gets its own pull task
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 0))
+#number of concurrent archive requests made by a batch
+ARCHIVE_BATCH_WORKERS = int(os.getenv('ARCHIVE_BATCH_WORKERS', 8))
+
+#backoff (seconds) between checks on files that are not on disk yet.
+#The wait doubles every check up to the max, with up to JITTER
+#(fraction of the wait) added at random
+STAGE_BACKOFF_BASE = float(os.getenv('STAGE_BACKOFF_BASE', 2))
+STAGE_BACKOFF_MAX = float(os.getenv('STAGE_BACKOFF_MAX', 600))
+STAGE_BACKOFF_JITTER = float(os.getenv('STAGE_BACKOFF_JITTER', 0.25))
+#number of checks on a file before giving up on it being staged
+STAGE_BACKOFF_ATTEMPTS = int(os.getenv('STAGE_BACKOFF_ATTEMPTS', 40))
+
+#number of file rows written per insert when a cart is created
+CART_INSERT_CHUNK = int(os.getenv('CART_INSERT_CHUNK', 1000))
+
+#number of cart statuses cached by the interface process.  0 disables it
+STATUS_CACHE_SIZE = int(os.getenv('STATUS_CACHE_SIZE', 10000))
+#seconds the status of a cart still being worked on is cached
+STATUS_CACHE_TTL = float(os.getenv('STATUS_CACHE_TTL', 2))
+#seconds a ready or errored cart status is cached.  0 caches it until a
+#DELETE or POST for the cart comes in to this process.  Either way no
+#status is cached longer than CART_ACCESS_RESOLUTION
+STATUS_CACHE_TERMINAL_TTL = float(os.getenv('STATUS_CACHE_TERMINAL_TTL', 0))
+
+#how workers tell the interface a carts status changed.  file uses files
+#under CART_NOTIFY_PATH, which must be on a volume the workers and the
+#interface share.  local only works when they run in the same process
+CART_NOTIFY = os.getenv('CART_NOTIFY', 'file')
+CART_NOTIFY_PATH = os.getenv('CART_NOTIFY_PATH', os.path.join(VOLUME_PATH, '.notify'))
+#seconds between checks of the notification file by a waiting request
+CART_NOTIFY_INTERVAL = float(os.getenv('CART_NOTIFY_INTERVAL', 0.5))
+#longest wait (seconds) a client can ask a status request to be held for
+STATUS_WAIT_MAX = float(os.getenv('STATUS_WAIT_MAX', 60))
+
+#how the interface builds the tar of a download.  stream generates it in
+#the request thread, fork writes it from a child process through a pipe
+CART_DOWNLOAD_MODE = os.getenv('CART_DOWNLOAD_MODE', 'stream')
+#send the file data of streamed downloads with sendfile when CartServer.py
+#runs the interface and the platform supports it
+CART_SENDFILE = os.getenv('CART_SENDFILE', 'True') == 'True'
+
+#write the bundle of a cart out before it becomes ready and serve downloads
+#from it.  tar writes the tar, tar+gz and tar+zstd also write a compressed
+#copy.  Empty builds the tar for every download
+CART_PREBUILD = os.getenv('CART_PREBUILD', '')
+#compression levels of gzip and zstd bundles
+CART_GZIP_LEVEL = int(os.getenv('CART_GZIP_LEVEL', 6))
+CART_ZSTD_LEVEL = int(os.getenv('CART_ZSTD_LEVEL', 3))
+#threads compressing bundles, shared by the downloads of a process.
+#Default the number of cpus
+CART_COMPRESS_WORKERS = int(os.getenv('CART_COMPRESS_WORKERS', multiprocessing.cpu_count()))
+#bytes of the bundle compressed together.  Default 1 MiB
+CART_COMPRESS_BLOCK = int(os.getenv('CART_COMPRESS_BLOCK', 1 << 20))
+#files whose first 64 KiB dont compress to less than this fraction of
+#their size are stored without compression
+CART_INCOMPRESSIBLE_RATIO = float(os.getenv('CART_INCOMPRESSIBLE_RATIO', 0.95))
+
+#lock file held while space on the volume is reserved for a cart.  It must
+#be on the volume so every worker using the volume shares it
+CART_SPACE_LOCK = os.getenv('CART_SPACE_LOCK', os.path.join(VOLUME_PATH, '.space.lock'))
+
+#keep the files pulled from the archive in a store under CART_STORE_PATH,
+#keyed by the archive file, mtime and size, and hardlink them into every
+#cart that asks for them.  CART_STORE_PATH must be on the same filesystem
+#as VOLUME_PATH
+CART_STORE = os.getenv('CART_STORE', 'False') == 'True'
+CART_STORE_PATH = os.getenv('CART_STORE_PATH', os.path.join(VOLUME_PATH, '.store'))
+
+#hashlib algorithm of the checksums taken of files as they are pulled
+CART_CHECKSUM = os.getenv('CART_CHECKSUM', 'sha1')
+
+#threads unlinking the files of deleted carts and the most files they
+#unlink a second together, 0 is unlimited.  Only one reaper runs on the
+#volume at a time, holding CART_REAPER_LOCK
+CART_REAPER_WORKERS = int(os.getenv('CART_REAPER_WORKERS', 4))
+CART_REAPER_RATE = float(os.getenv('CART_REAPER_RATE', 2000))
+CART_REAPER_LOCK = os.getenv('CART_REAPER_LOCK', os.path.join(VOLUME_PATH, '.reaper.lock'))
+
+#files of a cart on the celery queue at once, more are queued as the
+#workers start on them.  The carts of an owner, the start of their uid up
+#to CART_SHARE_SEPARATOR, share the window.  0 queues every file at once
+CART_DISPATCH_WINDOW = int(os.getenv('CART_DISPATCH_WINDOW', 100))
+CART_SHARE_SEPARATOR = os.getenv('CART_SHARE_SEPARATOR', '')
+#highest priority a cart can be made with, its window is multiplied by
+#its priority plus one
+CART_MAX_PRIORITY = int(os.getenv('CART_MAX_PRIORITY', 9))
+
 #buffer used for least recently used delete
 LRU_BUFFER_TIME = os.getenv('LRU_BUFFER_TIME', 0)
+#seconds between recording accesses of a cart.  Carts are evicted least
+#recently accessed first so this is how fine grained that order is
+CART_ACCESS_RESOLUTION = float(os.getenv('CART_ACCESS_RESOLUTION', 60))
 
 #database logging for query tracking
 DATABASE_LOGGING = os.getenv('DATABASE_LOGGING', False)
@@ -34,6 +168,16 @@ DATABASE_CONNECT_ATTEMPTS = os.getenv('DATABASE_CONNECT_ATTEMPTS', 3)
 #time between trying to reconnect to database.  Default 10 seconds
 DATABASE_WAIT = os.getenv('DATABASE_WAIT', 10)
 
+#size of the database connection pool shared by the threads of a process.
+#0 opens and closes a connection around every use instead
+DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 16))
+#seconds before a pooled connection is retired.  Pooled connections are
+#also pinged and replaced if the server has dropped them
+DATABASE_POOL_MAX_AGE = int(os.getenv('DATABASE_POOL_MAX_AGE', 300))
+#seconds a thread waits for a pooled connection when they are all in use
+#before giving up.  0 waits as long as it takes
+DATABASE_POOL_TIMEOUT = float(os.getenv('DATABASE_POOL_TIMEOUT', 30))
+
 #amqp addr and port variables
 AMQP_USER = os.getenv('AMQP_USER', 'guest')
 AMQP_PASS = os.getenv('AMQP_PASS', 'guest')
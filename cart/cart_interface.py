@@ -10,9 +10,16 @@ from urlparse import parse_qs
 import cart.cart_interface_responses as cart_interface_responses
 from cart.tasks import create_cart
 from cart.cart_utils import Cartutils
+from cart.cart_bundle import TarStream, FileStream, CompressedStream, ZipStream, BLOCK_SIZE
+from cart.cart_bundle import PREBUILT_SUFFIXES, prebuilt_path, compression_available
+from cart.status_cache import STATUS_CACHE, TERMINAL_STATES
+from cart.cart_notify import NOTIFIER
+from cart.cart_env_globals import STATUS_WAIT_MAX, CART_DOWNLOAD_MODE, CART_MAX_PRIORITY
 
-
-BLOCK_SIZE = 1<<20
+#names accepted by the format query parameter
+FORMAT_ALIASES = {'tar': 'tar', 'gz': 'gz', 'gzip': 'gz', 'tgz': 'gz',
+                  'zstd': 'zstd', 'zst': 'zstd', 'zip': 'zip'}
+COMPRESSED_TYPES = {'gz': 'application/gzip', 'zstd': 'application/zstd'}
 
 class CartInterfaceError(Exception):
     """
@@ -27,6 +34,65 @@ def fix_cart_uid(uid):
         uid = uid[1:]
     return uid
 
+def status_wait(env):
+    """Returns the seconds a status request asked to be held for with the
+    wait query parameter, capped at STATUS_WAIT_MAX"""
+    try:
+        wait = float(parse_qs(env.get('QUERY_STRING', ''))['wait'][0])
+    except (KeyError, ValueError):
+        return 0
+    return max(0, min(wait, STATUS_WAIT_MAX))
+
+def requested_format(env):
+    """Returns the bundle format asked for with the format query parameter,
+    tar when there isnt one and None when it cant be made"""
+    bundle_format = parse_qs(env.get('QUERY_STRING', '')).get('format', ['tar'])[0]
+    bundle_format = FORMAT_ALIASES.get(bundle_format.lower())
+    if bundle_format in ('tar', 'zip') or compression_available(bundle_format):
+        return bundle_format
+    return None
+
+def requested_flag(env, name):
+    """Returns True when the query parameter name is set to true"""
+    return parse_qs(env.get('QUERY_STRING', '')).get(name, [''])[0].lower() == 'true'
+
+def byte_range(env, length):
+    """Returns the (start, stop) of the Range requested for a response of
+    length bytes.  None to send everything, which is also what multiple
+    ranges and invalid ones, like a last byte before the first, get.
+    (length, length) when the range cant be satisfied."""
+    header = env.get('HTTP_RANGE', '').strip()
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].partition('-')
+    try:
+        if not first:
+            #suffix range, the last bytes of the response
+            start, stop = max(length - int(last), 0), length
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            stop = min(int(last) + 1, length) if last else length
+    except ValueError:
+        return None
+    if start >= stop:
+        return (length, length)
+    return (start, stop)
+
+def range_current(env, etag):
+    """Check a Range request still applies to the response with etag.  An
+    If-Range that isnt that etag, including a date as no Last-Modified is
+    sent, means the client holds other bytes and gets them all again"""
+    if_range = env.get('HTTP_IF_RANGE')
+    return if_range is None or if_range.strip() == etag
+
+def bundle_root(cart_path):
+    """Top directory of the bundle of the cart at cart_path.  It doesnt
+    depend on the file name asked for, so every download of a cart and
+    its pre-built bundle are the same bytes"""
+    return os.path.basename(cart_path)
+
 def is_valid_uid(uid):
     """checks to see if the uid is valid before using it"""
     if not uid:
@@ -56,6 +122,11 @@ class CartGenerator(object):
             self._response = resp.invalid_uid_error_response(
                 start_response, uid)
             return self.return_response()
+        bundle_format = requested_format(env)
+        if not bundle_format:
+            self._response = resp.unsupported_format(
+                start_response, parse_qs(env['QUERY_STRING'])['format'][0])
+            return self.return_response()
         #get the bundle path if available
         cart_utils = Cartutils()
         cart_path = cart_utils.available_cart(uid)
@@ -67,44 +138,161 @@ class CartGenerator(object):
             self._response = resp.cart_not_found(start_response)
         else:
             if os.path.isdir(cart_path):
+                if requested_flag(env, 'manifest'):
+                    return self._manifest(start_response, uid, bundle_root(cart_path))
+                checksums = None
+                if requested_flag(env, 'checksums'):
+                    checksums = self._member_checksums(uid, bundle_root(cart_path))
                 #give back bundle here
-                stderr.flush()
-                try:
-                    #want to stream the tar file out
-                    (rpipe, wpipe) = os.pipe()
-                    cpid = os.fork()
-                    # the fork screws up coverage testing... :(
-                    if cpid == 0: # pragma: no cover
-                        # we are the child process
-                        #write the data to the pipe
-                        os.close(rpipe)
-                        wfd = os.fdopen(wpipe, 'wb')
-                        mytar = TarFile.open(fileobj=wfd, mode='w|')
-                        mytar.add(cart_path, arcname=rtn_name.replace('.tar', ''))
-                        mytar.close()
-                        #to exit from the fork child without killing the parent
-                        #we need to use_exit.  Disabling the pylint for this
-                        #so that it doesnt throw an error
-                        # pylint: disable=protected-access
-                        os._exit(0)
-                        # pylint: enable=protected-access
-                    # we are the parent
-                    os.close(wpipe)
-                    #open the pipe as a file
-                    rfd = os.fdopen(rpipe, 'rb')
-                    start_response('200 OK', [('Content-Type', 'application/octet-stream'),
-                                              ('Content-Disposition', 'attachment; filename=' +
-                                               str(rtn_name))])
-                    if 'wsgi.file_wrapper' in env:
-                        return env['wsgi.file_wrapper'](rfd, BLOCK_SIZE)
-                    return iter(lambda: rfd.read(BLOCK_SIZE), '')
-                except IOError:
-                    self._response = resp.bundle_doesnt_exist(start_response)
+                if bundle_format == 'zip':
+                    return self._zip(start_response, cart_path, rtn_name)
+                if bundle_format != 'tar':
+                    return self._compressed_tar(env, start_response, cart_path,
+                                                rtn_name, bundle_format, checksums)
+                if CART_DOWNLOAD_MODE == 'fork' and checksums is None:
+                    return self._fork_tar(env, start_response, cart_path, rtn_name)
+                return self._stream_tar(env, start_response, cart_path, rtn_name, checksums)
             else:
                 self._response = resp.bundle_doesnt_exist(start_response)
                 return self.return_response()
         return self.return_response()
 
+    def _manifest(self, start_response, uid, root):
+        """Send the files of the cart with the checksums taken as they were
+        pulled, named as they are in the bundle under root"""
+        resp = cart_interface_responses.Responses()
+        manifest = Cartutils.cart_manifest(uid)
+        if manifest is None:
+            self._response = resp.unready_cart(start_response)
+            return self.return_response()
+        self._response = resp.cart_manifest_response(start_response, [
+            {'path': root + '/' + bundle_path, 'size': size,
+             'hashtype': hashtype, 'hashsum': hashsum}
+            for bundle_path, size, hashtype, hashsum in manifest])
+        return self.return_response()
+
+    @staticmethod
+    def _member_checksums(uid, root):
+        """Returns the checksums of the members of the bundle under root
+        by name"""
+        return dict((root + '/' + bundle_path, (hashtype, hashsum))
+                    for bundle_path, _, hashtype, hashsum in Cartutils.cart_manifest(uid) or []
+                    if hashsum)
+
+    @staticmethod
+    def _download_headers(rtn_name):
+        """Headers for sending the bundle as rtn_name"""
+        return [('Content-Type', 'application/octet-stream'),
+                ('Content-Disposition', 'attachment; filename=' + str(rtn_name))]
+
+    @staticmethod
+    def _prebuilt(env, cart_path):
+        """Returns the pre-built bundle to send and its Content-Encoding,
+        None when the cart has no pre-built bundle"""
+        gz_path = prebuilt_path(cart_path, 'gz')
+        if 'gzip' in env.get('HTTP_ACCEPT_ENCODING', '') and os.path.isfile(gz_path):
+            return FileStream(gz_path, BLOCK_SIZE), 'gzip'
+        tar_path = prebuilt_path(cart_path, 'tar')
+        if os.path.isfile(tar_path):
+            return FileStream(tar_path, BLOCK_SIZE), None
+        return None
+
+    def _stream_tar(self, env, start_response, cart_path, rtn_name, checksums=None):
+        """Stream the tar file, or the range of it asked for.  The pre-built
+        tar has no member checksums so it isnt sent when they are asked for"""
+        headers = self._download_headers(rtn_name)
+        prebuilt = None if checksums is not None else self._prebuilt(env, cart_path)
+        if prebuilt is None:
+            stream = TarStream(cart_path, bundle_root(cart_path), BLOCK_SIZE, checksums)
+        else:
+            stream, encoding = prebuilt
+            headers.append(('Vary', 'Accept-Encoding'))
+            if encoding:
+                headers.append(('Content-Encoding', encoding))
+        return self._send_stream(env, start_response, stream, headers)
+
+    def _compressed_tar(self, env, start_response, cart_path, rtn_name, bundle_format,
+                        checksums=None):
+        """Send the tar compressed in bundle_format, from the pre-built
+        bundle when there is one and no member checksums are asked for"""
+        headers = [('Content-Type', COMPRESSED_TYPES[bundle_format]),
+                   ('Content-Disposition', 'attachment; filename=' +
+                    str(rtn_name) + PREBUILT_SUFFIXES[bundle_format][len('.tar'):])]
+        path = prebuilt_path(cart_path, bundle_format)
+        if checksums is None and os.path.isfile(path):
+            return self._send_stream(env, start_response, FileStream(path, BLOCK_SIZE), headers)
+        stream = TarStream(cart_path, bundle_root(cart_path), BLOCK_SIZE, checksums)
+        #the compressed length isnt known until it is sent, so no ranges
+        start_response('200 OK', headers)
+        return CompressedStream(stream, bundle_format)
+
+    @staticmethod
+    def _zip(start_response, cart_path, rtn_name):
+        """Send the cart as a zip file"""
+        if rtn_name.endswith('.tar'):
+            rtn_name = rtn_name[:-len('.tar')]
+        start_response('200 OK', [('Content-Type', 'application/zip'),
+                                  ('Content-Disposition', 'attachment; filename=' +
+                                   str(rtn_name) + '.zip')])
+        return ZipStream(cart_path, bundle_root(cart_path), BLOCK_SIZE)
+
+    def _send_stream(self, env, start_response, stream, headers):
+        """Send the stream, or the range of it asked for when it is still
+        the one the client has the rest of"""
+        length = stream.size()
+        etag = stream.etag()
+        headers = headers + [('Accept-Ranges', 'bytes'), ('ETag', etag)]
+        selected = byte_range(env, length)
+        if selected is None or not range_current(env, etag):
+            start_response('200 OK', headers + [('Content-Length', str(length))])
+            return stream
+        start, stop = selected
+        if start >= length:
+            resp = cart_interface_responses.Responses()
+            self._response = resp.range_not_satisfiable(start_response, length)
+            return self.return_response()
+        stream.select(start, stop)
+        start_response('206 Partial Content', headers + [
+            ('Content-Length', str(stop - start)),
+            ('Content-Range', 'bytes {0}-{1}/{2}'.format(start, stop - 1, length))
+        ])
+        return stream
+
+    def _fork_tar(self, env, start_response, cart_path, rtn_name):
+        """Stream the tar file out of a child process through a pipe"""
+        resp = cart_interface_responses.Responses()
+        stderr.flush()
+        try:
+            #want to stream the tar file out
+            (rpipe, wpipe) = os.pipe()
+            cpid = os.fork()
+            # the fork screws up coverage testing... :(
+            if cpid == 0: # pragma: no cover
+                # we are the child process
+                #write the data to the pipe
+                os.close(rpipe)
+                wfd = os.fdopen(wpipe, 'wb')
+                mytar = TarFile.open(fileobj=wfd, mode='w|')
+                mytar.add(cart_path, arcname=bundle_root(cart_path))
+                mytar.close()
+                #to exit from the fork child without killing the parent
+                #we need to use_exit.  Disabling the pylint for this
+                #so that it doesnt throw an error
+                # pylint: disable=protected-access
+                os._exit(0)
+                # pylint: enable=protected-access
+            # we are the parent
+            os.close(wpipe)
+            #open the pipe as a file
+            rfd = os.fdopen(rpipe, 'rb')
+            start_response('200 OK', self._download_headers(rtn_name))
+            if 'wsgi.file_wrapper' in env:
+                return env['wsgi.file_wrapper'](rfd, BLOCK_SIZE)
+            return iter(lambda: rfd.read(BLOCK_SIZE), '')
+        except IOError:
+            self._response = resp.bundle_doesnt_exist(start_response)
+        return self.return_response()
+
     def status(self, env, start_response):
         """Get the status of a carts tar file"""
         resp = cart_interface_responses.Responses()
@@ -115,11 +303,30 @@ class CartGenerator(object):
                 start_response, uid)
             return self.return_response()
 
-        cart_utils = Cartutils()
-        status = cart_utils.cart_status(uid)
+        wait = status_wait(env)
+        if wait:
+            status = self._wait_status(uid, wait)
+        else:
+            status = STATUS_CACHE.get(uid)
+            if status is None:
+                status = Cartutils().cart_status(uid)
+                STATUS_CACHE.put(uid, status)
         self._response = resp.cart_status_response(start_response, status)
         return self.return_response()
 
+    @staticmethod
+    def _wait_status(uid, wait):
+        """Long poll for the status of a cart.  A cart that is still
+        being worked on holds the request until the workers notify a
+        status change or wait seconds pass"""
+        #take the version before reading so a change in between isnt missed
+        version = NOTIFIER.version(uid)
+        status = Cartutils().cart_status(uid)
+        if status[0] not in TERMINAL_STATES and NOTIFIER.wait(uid, version, wait):
+            status = Cartutils().cart_status(uid)
+        STATUS_CACHE.put(uid, status)
+        return status
+
     def stage(self, env, start_response):
         """Get all the files locally and bundled"""
         resp = cart_interface_responses.Responses()
@@ -132,11 +339,13 @@ class CartGenerator(object):
             request_body = env['wsgi.input'].read(request_body_size)
             data = json.loads(request_body)
             file_ids = data['fileids']
+            #optional priority of the cart, see cart_scheduler
+            priority = min(max(int(data.get('priority', 0)), 0), CART_MAX_PRIORITY)
         except IOError:
             # is exception is probably from the read()
             self._response = resp.json_stage_error_response(start_response)
             return self.return_response()
-        except ValueError:
+        except (ValueError, TypeError):
             self._response = resp.json_stage_error_response(start_response)
             return self.return_response()
 
@@ -147,7 +356,8 @@ class CartGenerator(object):
                 start_response, uid)
             return self.return_response()
 
-        create_cart(file_ids, uid)
+        STATUS_CACHE.invalidate(uid)
+        create_cart(file_ids, uid, priority)
         self._response = resp.cart_proccessing_response(start_response)
         return self.return_response()
 
@@ -163,6 +373,7 @@ class CartGenerator(object):
 
         cart_utils = Cartutils()
         message = cart_utils.remove_cart(uid)
+        STATUS_CACHE.invalidate(uid)
         if message is False:
             self._response = resp.cart_not_found(start_response)
         else:
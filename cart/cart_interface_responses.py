@@ -44,6 +44,26 @@ class Responses(object):
         }
         return self._response
 
+    def range_not_satisfiable(self, start_response, length):
+        """Response for when the range asked for is past the end of the bundle"""
+        start_response('416 Requested Range Not Satisfiable', [
+            ('Content-Type', 'application/json'),
+            ('Content-Range', 'bytes */' + str(length))
+        ])
+        self._response = {
+            'message': 'The requested range is not satisfiable'
+        }
+        return self._response
+
+    def unsupported_format(self, start_response, bundle_format):
+        """Response for when the bundle format asked for cant be made"""
+        start_response('400 Bad Request', [('Content-Type', 'application/json')])
+        self._response = {
+            'message': 'The bundle format is not supported',
+            'format': bundle_format
+        }
+        return self._response
+
     def unknown_exception(self, start_response):
         """Response when unknown exception occurs"""
         start_response('500 Internal Server Error', [('Content-Type', 'application/json')])
@@ -99,6 +119,14 @@ class Responses(object):
         }
         return self._response
 
+    def cart_manifest_response(self, start_response, files):
+        """Response listing the files of a cart and their checksums"""
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        self._response = {
+            'files': files
+        }
+        return self._response
+
     def cart_delete_response(self, start_response, message):
         """Response For cart deletion"""
         start_response('200 OK', [('Content-Type', 'application/json')])
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+"""Notifications of cart status changes.  The workers notify after they
+change the status of a cart and the interface waits on the notifications
+to answer long polls without querying the database.
+"""
+import os
+import time
+import errno
+import hashlib
+import threading
+from cart.cart_env_globals import CART_NOTIFY, CART_NOTIFY_PATH, CART_NOTIFY_INTERVAL
+
+
+class LocalNotifier(object):
+    """Notifier for workers and interface running in the same process"""
+    def __init__(self):
+        self._versions = {}
+        self._condition = threading.Condition()
+
+    def version(self, uid):
+        """Return a token that changes every time uid is notified"""
+        with self._condition:
+            return self._versions.get(str(uid), 0)
+
+    def notify(self, uid):
+        """Wake everything waiting on uid"""
+        with self._condition:
+            self._versions[str(uid)] = self._versions.get(str(uid), 0) + 1
+            self._condition.notify_all()
+
+    def forget(self, uid):
+        """Wake everything waiting on uid and drop its state"""
+        with self._condition:
+            self._versions.pop(str(uid), None)
+            self._condition.notify_all()
+
+    def wait(self, uid, version, timeout):
+        """Wait up to timeout seconds for uid to move on from version.
+        Returns True if it was notified"""
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._versions.get(str(uid), 0) == version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+
+class FileNotifier(object):
+    """Notifier for workers and interface sharing a volume.  Each uid has a
+    file under path that is replaced on every notification.  Waiting checks
+    the file every interval seconds.
+    """
+    def __init__(self, path=CART_NOTIFY_PATH, interval=CART_NOTIFY_INTERVAL):
+        self._path = path
+        self._interval = interval
+
+    def _uid_path(self, uid):
+        """uids can have any characters so name the file by a hash"""
+        return os.path.join(self._path, hashlib.sha1(str(uid)).hexdigest())
+
+    def version(self, uid):
+        """Return a token that changes every time uid is notified"""
+        try:
+            with open(self._uid_path(uid), 'rb') as notify_file:
+                return notify_file.read()
+        except IOError:
+            return ''
+
+    def notify(self, uid):
+        """Replace the file of uid.  A failure to notify is not an error,
+        waiters fall back to their timeout"""
+        uid_path = self._uid_path(uid)
+        tmp_path = '{0}.{1}.{2}'.format(uid_path, os.getpid(), threading.current_thread().ident)
+        try:
+            try:
+                os.makedirs(self._path)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+            with open(tmp_path, 'wb') as notify_file:
+                notify_file.write('{0!r} {1}'.format(time.time(), os.getpid()))
+            os.rename(tmp_path, uid_path)
+        except (IOError, OSError):
+            pass
+
+    def forget(self, uid):
+        """Remove the file of uid, which also wakes its waiters"""
+        try:
+            os.remove(self._uid_path(uid))
+        except OSError:
+            pass
+
+    def wait(self, uid, version, timeout):
+        """Wait up to timeout seconds for uid to move on from version.
+        Returns True if it was notified"""
+        deadline = time.time() + timeout
+        while self.version(uid) == version:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self._interval, remaining))
+        return True
+
+
+def notifier(backend=CART_NOTIFY):
+    """Build the notifier for backend, file or local"""
+    if backend == 'local':
+        return LocalNotifier()
+    return FileNotifier()
+
+NOTIFIER = notifier()
@@ -10,18 +10,38 @@ Using PeeWee to implement the ORM.
 import datetime
 import time
 from peewee import MySQLDatabase, PrimaryKeyField, CharField, DateTimeField
-from peewee import ForeignKeyField, TextField
-from peewee import Model, OperationalError
+from peewee import ForeignKeyField, TextField, IntegerField, BigIntegerField
+from peewee import Model, OperationalError, fn
+from playhouse.migrate import SchemaMigrator, migrate
+from playhouse.pool import PooledMySQLDatabase
 from cart.cart_env_globals import MYSQL_USER, MYSQL_PASS, MYSQL_ADDR
 from cart.cart_env_globals import MYSQL_PORT, MYSQL_DATABASE
 from cart.cart_env_globals import DATABASE_CONNECT_ATTEMPTS, DATABASE_WAIT
+from cart.cart_env_globals import DATABASE_POOL_SIZE, DATABASE_POOL_MAX_AGE
+from cart.cart_env_globals import DATABASE_POOL_TIMEOUT
 
 
-DB = MySQLDatabase(MYSQL_DATABASE,
-                   host=MYSQL_ADDR,
-                   port=int(MYSQL_PORT),
-                   user=MYSQL_USER,
-                   passwd=MYSQL_PASS)
+def database_connection():
+    """
+    Build the database the models use.  Connections are pooled per
+    process unless DATABASE_POOL_SIZE is 0, and threads wait up to
+    DATABASE_POOL_TIMEOUT for one when they are all checked out.
+    """
+    settings = {
+        'host': MYSQL_ADDR,
+        'port': int(MYSQL_PORT),
+        'user': MYSQL_USER,
+        'passwd': MYSQL_PASS
+    }
+    if DATABASE_POOL_SIZE > 0:
+        return PooledMySQLDatabase(MYSQL_DATABASE,
+                                   max_connections=DATABASE_POOL_SIZE,
+                                   stale_timeout=DATABASE_POOL_MAX_AGE,
+                                   timeout=DATABASE_POOL_TIMEOUT,
+                                   **settings)
+    return MySQLDatabase(MYSQL_DATABASE, **settings)
+
+DB = database_connection()
 
 def database_setup(attempts=0):
     """
@@ -29,8 +49,9 @@ def database_setup(attempts=0):
     """
     try:
         Cart.database_connect()
-        for cls in [Cart, File]:
+        for cls in [Cart, File, StoreFile, ArchiveLimit, ArchiveLease]:
             cls.create_table(fail_silently=True)
+        database_migrate()
         Cart.database_close()
     except OperationalError:
         #couldnt connect, potentially wait and try again
@@ -40,6 +61,77 @@ def database_setup(attempts=0):
             attempts += 1
             database_setup(attempts)
 
+def database_migrate():
+    """
+    Bring tables created by older versions of the cart up to date.
+    Missing tables are created, missing columns are added and filled in,
+    then missing indexes are created.  Safe to run against an up to date database.
+    """
+    # pylint: disable=no-member,protected-access
+    database = Cart._meta.database
+    migrator = SchemaMigrator.from_database(database)
+    added = []
+    for cls in [Cart, File, StoreFile, ArchiveLimit, ArchiveLease]:
+        table = cls._meta.db_table
+        if not cls.table_exists():
+            cls.create_table()
+            continue
+        _mysql_text_to_varchar(cls)
+        columns = [column.name for column in database.get_columns(table)]
+        for field in cls._meta.sorted_fields:
+            if field.db_column not in columns:
+                migrate(migrator.add_column(table, field.db_column, field))
+                added.append(field.name)
+        indexed = [tuple(index.columns) for index in database.get_indexes(table)]
+        for fields, unique in cls._index_data():
+            fields = [cls._meta.fields[field] if isinstance(field, basestring) else field
+                      for field in fields]
+            if tuple(field.db_column for field in fields) not in indexed:
+                database.create_index(cls, fields, unique)
+    # pylint: enable=no-member,protected-access
+    if 'pending_count' in added:
+        _backfill_file_counts()
+    if 'accessed_date' in added:
+        Cart.update(accessed_date=Cart.updated_date).execute()
+
+def _mysql_text_to_varchar(cls):
+    """
+    MySQL cant index TEXT columns.  Convert TEXT columns left by older
+    versions to the VARCHAR the model now defines.
+    """
+    # pylint: disable=no-member
+    database = cls._meta.database
+    if not isinstance(database, MySQLDatabase):
+        return
+    table = cls._meta.db_table
+    fields = dict((field.db_column, field) for field in cls._meta.sorted_fields)
+    compiler = database.compiler()
+    for column in database.get_columns(table):
+        field = fields.get(column.name)
+        if field is None or field.get_db_field() != 'string':
+            continue
+        if column.data_type.lower() == 'text':
+            definition, _ = compiler.parse_node(compiler.field_definition(field))
+            database.execute_sql('ALTER TABLE %s MODIFY %s' % (compiler.quote(table), definition))
+    # pylint: enable=no-member
+
+def _backfill_file_counts():
+    """Count the files of carts that existed before the counters"""
+    counts = (File
+              .select(File.cart, File.status, fn.COUNT(File.id).alias('total'))
+              .join(Cart)
+              .where(Cart.deleted_date.is_null(True))
+              .group_by(File.cart, File.status)
+              .tuples())
+    totals = {}
+    for cart_id, status, total in counts:
+        counter = Cart.status_counter(status).name
+        totals.setdefault(cart_id, {})
+        totals[cart_id][counter] = totals[cart_id].get(counter, 0) + total
+    with Cart.atomic():
+        for cart_id, cart_totals in totals.items():
+            Cart.update(**cart_totals).where(Cart.id == cart_id).execute()
+
 class CartBase(Model):
     """
     Base Cart Model class.
@@ -54,7 +146,8 @@ class CartBase(Model):
 
     @classmethod
     def database_connect(cls):
-        """Makes sure database is connected.  Dont reopen connection"""
+        """Makes sure database is connected.  Dont reopen connection.
+        With a pooled database this checks a connection out of the pool"""
         # pylint: disable=no-member
         if cls._meta.database.is_closed():
             cls._meta.database.connect()
@@ -62,17 +155,30 @@ class CartBase(Model):
 
     @classmethod
     def database_close(cls):
-        """Closes the database connection. """
+        """Closes the database connection.  With a pooled database the
+        connection is returned to the pool instead"""
         # pylint: disable=no-member
         if not cls._meta.database.is_closed():
             cls._meta.database.close()
         # pylint: enable=no-member
 
+    @classmethod
+    def locking(cls, query):
+        """Lock the rows of query until the transaction ends on
+        databases that support it"""
+        # pylint: disable=no-member
+        if cls._meta.database.for_update:
+            return query.for_update()
+        # pylint: enable=no-member
+        return query
+
     class Meta(object):
         """
         Meta object containing the database connection
         """
         database = DB # This model uses the pacifica_cart database.
+        #only write changed fields so saves dont clobber the counters
+        only_save_dirty = True
 
     def reload(self):
         """reload my current state from the DB"""
@@ -90,11 +196,44 @@ class Cart(CartBase):
     cart_uid = CharField(default=1)
     bundle_path = CharField(default='')
     creation_date = DateTimeField(default=datetime.datetime.now)
-    updated_date = DateTimeField(default=datetime.datetime.now)
+    updated_date = DateTimeField(default=datetime.datetime.now, index=True)
+    #last time the cart was statused or downloaded, carts are evicted
+    #least recently accessed first
+    accessed_date = DateTimeField(default=datetime.datetime.now, index=True)
     deleted_date = DateTimeField(null=True)
     status = TextField(default='waiting')
     error = TextField(default='')
 
+    #number of the carts files in each state, see status_counter
+    pending_count = IntegerField(default=0)
+    staged_count = IntegerField(default=0)
+    error_count = IntegerField(default=0)
+
+    #weight of the cart when dispatching files, see cart_scheduler
+    priority = IntegerField(default=0)
+
+    #bytes of the volume reserved for the carts files and the bytes of
+    #them written so far, see cart_space
+    reserved_bytes = BigIntegerField(default=0)
+    used_bytes = BigIntegerField(default=0)
+
+    @staticmethod
+    def status_counter(status):
+        """Returns the counter field a file with status is counted in"""
+        if status == 'staged':
+            return Cart.staged_count
+        elif status == 'error':
+            return Cart.error_count
+        return Cart.pending_count
+
+    class Meta(object):
+        """
+        Indexes for looking up the newest live cart for a uid
+        """
+        indexes = (
+            (('cart_uid', 'deleted_date', 'creation_date'), False),
+        )
+
 class File(CartBase):
     """
     File object model to keep track of what's been downloaded for a cart
@@ -103,5 +242,51 @@ class File(CartBase):
     cart = ForeignKeyField(Cart, to_field='id')
     file_name = CharField(default='')
     bundle_path = CharField(default='')
-    status = TextField(default='waiting')
+    #VARCHAR rather than TEXT so MySQL can index it
+    status = CharField(default='waiting')
     error = TextField(default='')
+    #size the archive reported, set once the space for it is reserved
+    size = BigIntegerField(null=True)
+    #key of the stored file the file is linked to, see cart_store
+    store_key = CharField(null=True)
+    #checksum taken as the file was pulled, and its hashlib algorithm
+    hashtype = CharField(null=True)
+    hashsum = CharField(null=True)
+
+    class Meta(object):
+        """
+        Indexes for finding a carts files in a given state
+        """
+        indexes = (
+            (('cart', 'status'), False),
+        )
+
+class StoreFile(CartBase):
+    """
+    File pulled from the archive kept in the store for carts to link to
+    """
+    id = PrimaryKeyField()
+    key = CharField(unique=True)
+    size = BigIntegerField(default=0)
+    #number of live carts linked to the file
+    refs = IntegerField(default=0)
+
+class ArchiveLimit(CartBase):
+    """
+    Operation or media of the archive interface with a limit, locked
+    while its leases are counted
+    """
+    id = PrimaryKeyField()
+    key = CharField(unique=True)
+
+class ArchiveLease(CartBase):
+    """
+    Operation in flight against the archive interface, or file being
+    recalled from a media, see archive_limits
+    """
+    id = PrimaryKeyField()
+    key = CharField(index=True)
+    #file a media lease is held for across the tasks checking on it
+    owner = CharField(null=True, index=True)
+    #leases not renewed by then were left by a worker that died
+    expires = DateTimeField(index=True)
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+"""Removal of the files of deleted carts.  Deleting a cart only marks it
+deleting, the reaper removes the files afterwards from a worker.  Files
+are unlinked from a few threads at a limited rate so removing a cart of
+many small files doesnt swamp the volume.  Carts stay deleting until
+their files are gone, so a reaper that is stopped part way is picked up
+again by the next one.
+
+The bytes of a deleting cart count as available on the volume, see
+cart_space, so they are taken off the cart before its files are
+unlinked and the space they free shows up as free instead.
+"""
+import os
+import stat
+import time
+import errno
+import fcntl
+import threading
+from multiprocessing.pool import ThreadPool
+from cart.cart_orm import Cart
+from cart.cart_store import cart_keys, remove_unreferenced
+from cart.cart_env_globals import VOLUME_PATH, CART_REAPER_WORKERS, CART_REAPER_RATE
+from cart.cart_env_globals import CART_REAPER_LOCK
+
+
+class RateLimiter(object):
+    """Token bucket shared by threads allowing rate operations a second,
+    with up to a second of them at once.  A rate of 0 is unlimited"""
+    def __init__(self, rate):
+        self._rate = float(rate)
+        self._tokens = self._rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until an operation is allowed"""
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self._rate, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+def _unlink_files(directory, names, limiter):
+    """Unlink names from directory, files already gone are fine"""
+    for name in names:
+        limiter.acquire()
+        try:
+            os.unlink(os.path.join(directory, name))
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+
+def _freed_bytes(directory, names):
+    """Bytes unlinking names from directory frees.  Files with other links,
+    like those in the store, free nothing"""
+    freed = 0
+    for name in names:
+        try:
+            path_stat = os.lstat(os.path.join(directory, name))
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            continue
+        if stat.S_ISREG(path_stat.st_mode) and path_stat.st_nlink == 1:
+            freed += path_stat.st_size
+    return freed
+
+
+def remove_tree(path, workers, limiter, freeing=None):
+    """Remove path and everything under it.  The files of each directory
+    are unlinked by one of workers threads and then the directories are
+    removed deepest first.  freeing is called with the bytes the files of
+    each directory free before they are unlinked"""
+    directories = []
+    pool = ThreadPool(workers)
+    try:
+        pending = []
+        for root, dirs, files in os.walk(path):
+            directories.append(root)
+            #walk doesnt go into links to directories, they are unlinked
+            links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+            if freeing is not None:
+                freeing(_freed_bytes(root, files))
+            pending.append(pool.apply_async(_unlink_files, (root, files + links, limiter)))
+            #bound the names waiting to be unlinked
+            while len(pending) > 2 * workers:
+                pending.pop(0).get()
+        for result in pending:
+            result.get()
+    finally:
+        pool.close()
+        pool.join()
+    for directory in reversed(directories):
+        try:
+            os.rmdir(directory)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+
+def reap_cart(mycart, workers, limiter):
+    """Remove the files of a deleting cart and mark it deleted, with the
+    stored files no other cart links to.  Returns False if the files
+    couldnt be removed"""
+    def freeing(size):
+        """take the bytes about to be freed off the cart"""
+        if size <= 0:
+            return
+        if not Cart.update(used_bytes=Cart.used_bytes - size).where(
+                (Cart.id == mycart.id) & (Cart.used_bytes >= size)).execute():
+            Cart.update(used_bytes=0).where(Cart.id == mycart.id).execute()
+
+    try:
+        remove_tree(os.path.join(VOLUME_PATH, str(mycart.id)), workers, limiter, freeing)
+    except OSError:
+        return False
+    remove_unreferenced(cart_keys(mycart.id))
+    mycart.status = 'deleted'
+    mycart.used_bytes = 0
+    mycart.save()
+    return True
+
+
+def _deleting_carts(skip):
+    """The deleted carts not in skip whose files arent removed yet, the
+    longest deleted first.  Picked by their deleted date, a pull that
+    finished after the delete may have changed their status"""
+    query = Cart.select().where(
+        (Cart.deleted_date.is_null(False)) & (Cart.status != 'deleted'))
+    if skip:
+        query = query.where(~(Cart.id << list(skip)))
+    return list(query.order_by(Cart.deleted_date, Cart.id).limit(100))
+
+
+def reap(workers=CART_REAPER_WORKERS, rate=CART_REAPER_RATE, lock_path=CART_REAPER_LOCK):
+    """Remove the files of deleting carts until there are none left.  Only
+    one reaper on the volume runs at a time, the others return straight
+    away as the running one finds their carts.  Returns the number of
+    carts removed"""
+    limiter = RateLimiter(rate)
+    reaped = 0
+    failed = set()
+    with open(lock_path, 'a') as lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as ex:
+                if ex.errno in (errno.EAGAIN, errno.EACCES):
+                    return reaped
+                raise
+            try:
+                carts = _deleting_carts(failed)
+                while carts:
+                    for mycart in carts:
+                        if reap_cart(mycart, workers, limiter):
+                            reaped += 1
+                        else:
+                            failed.add(mycart.id)
+                    carts = _deleting_carts(failed)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            #carts deleted while the lock was let go had their reaper
+            #turned away, so look once more
+            if not _deleting_carts(failed):
+                return reaped
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+"""Fair share dispatch of the files of carts to the workers.  The files of
+a cart arent all put on the celery queue when it is made, a cart only has
+a window of files queued at a time and more are queued as the workers
+start on them.  The queue then takes turns between the carts, so a cart
+of a few files waits behind the windows of the other carts instead of
+every file of a large cart.
+
+Carts are grouped by owner, the start of their uid up to
+CART_SHARE_SEPARATOR.  The carts of an owner share one window, so making
+more carts doesnt get an owner more of the queue, and the priority a
+cart was made with multiplies its window.
+"""
+from cart.cart_orm import Cart, File
+from cart.cart_env_globals import CART_DISPATCH_WINDOW, CART_SHARE_SEPARATOR
+
+
+def cart_owner(cart_uid):
+    """Owner of a cart, the whole uid without a CART_SHARE_SEPARATOR"""
+    if not CART_SHARE_SEPARATOR:
+        return str(cart_uid)
+    return str(cart_uid).split(CART_SHARE_SEPARATOR, 1)[0]
+
+
+def cart_window(priority, active_carts, window):
+    """Files a cart may have queued, the owners window split between its
+    active_carts carts and weighted by priority.  At least 1"""
+    return max(1, window * (priority + 1) // max(active_carts, 1))
+
+
+def owner_carts(owner):
+    """Number of carts of owner still staging files"""
+    query = Cart.cart_uid == owner
+    if CART_SHARE_SEPARATOR:
+        query |= Cart.cart_uid.startswith(owner + CART_SHARE_SEPARATOR)
+    return (Cart
+            .select()
+            .where(query & (Cart.status == 'staging') & (Cart.deleted_date.is_null(True)))
+            .count())
+
+
+def dispatch_files(mycart, window=None):
+    """Mark the next of the carts waiting files queued, up to its window,
+    and return their ids for the caller to queue.  Nothing is queued until
+    half the window has been started on.  A window of 0 queues every file,
+    the default is CART_DISPATCH_WINDOW"""
+    if window is None:
+        window = CART_DISPATCH_WINDOW
+    if mycart.deleted_date:
+        return []
+    with Cart.atomic():
+        #one dispatcher of a cart at a time where the database can lock
+        Cart.locking(Cart.select(Cart.id).where(Cart.id == mycart.id)).get()
+        query = (File
+                 .select(File.id)
+                 .where((File.cart == mycart.id) & (File.status == 'waiting'))
+                 .order_by(File.id))
+        if window > 0:
+            window = cart_window(mycart.priority, owner_carts(cart_owner(mycart.cart_uid)),
+                                 window)
+            queued = File.select().where(
+                (File.cart == mycart.id) & (File.status == 'queued')).count()
+            if queued > window // 2:
+                return []
+            query = query.limit(window - queued)
+        file_ids = [file_id for (file_id,) in query.tuples()]
+        #waiting and queued files are both pending, so no counters change
+        if file_ids:
+            File.update(status='queued').where(File.id << file_ids).execute()
+    return file_ids
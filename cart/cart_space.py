@@ -0,0 +1,131 @@
+#!/usr/bin/python
+"""Accounting of the space carts take on the volume.  Every cart records
+the bytes reserved for its files and the bytes of them already written.
+Space is reserved before files are pulled, so the free space of the
+volume less what is reserved but not written yet is what a new
+reservation can have.  Reservations are made holding a lock file on the
+volume so workers sharing it dont promise the same bytes twice.
+
+Carts evicted to make room are marked deleting and their files removed
+in the background.  Until they are gone their bytes count as available,
+the reservation that evicted them has already been promised them.  The
+reaper takes the bytes of each file off the cart before unlinking it, so
+they are never counted as both deleting and free.
+"""
+import os
+try:
+    from os import scandir
+except ImportError: # pragma: no cover
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+import stat
+import errno
+import fcntl
+from contextlib import contextmanager
+import psutil
+from peewee import fn
+from cart.cart_orm import Cart
+from cart.cart_env_globals import CART_SPACE_LOCK
+
+
+@contextmanager
+def space_lock(path=CART_SPACE_LOCK):
+    """Hold the lock on the space of the volume"""
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def outstanding_bytes():
+    """Bytes reserved by live carts that are not written yet"""
+    outstanding = (Cart
+                   .select(fn.SUM(Cart.reserved_bytes - Cart.used_bytes))
+                   .where(
+                       (Cart.deleted_date.is_null(True)) &
+                       (Cart.reserved_bytes > Cart.used_bytes))
+                   .scalar())
+    return long(outstanding or 0)
+
+
+def deleting_bytes():
+    """Bytes of evicted carts whose files are still being removed, less
+    the files other carts link to"""
+    deleting = (Cart
+                .select(fn.SUM(Cart.used_bytes))
+                .where((Cart.deleted_date.is_null(False)) & (Cart.status != 'deleted'))
+                .scalar())
+    return long(deleting or 0)
+
+
+def available_bytes(volume_path):
+    """Bytes of the volume that can still be reserved.  Raises
+    psutil.Error when the volume cant be checked"""
+    return (long(psutil.disk_usage(volume_path).free) - outstanding_bytes() +
+            deleting_bytes())
+
+
+def cart_bytes(reserved_bytes, used_bytes):
+    """Bytes of the volume deleting a cart makes available, its files and
+    the rest of its reservation"""
+    return max(reserved_bytes, used_bytes)
+
+
+def plan_eviction(candidates, bytes_needed):
+    """Pick the carts to evict to free bytes_needed.  candidates are
+    (key, bytes) pairs, least recently accessed first.  The least recently
+    accessed carts are taken until there is enough, then the most recently
+    accessed of those that arent needed after all are left out again.
+    Returns the keys to evict, or None if all of them arent enough"""
+    if bytes_needed <= 0:
+        return []
+    chosen = []
+    freed = 0
+    for key, size in candidates:
+        chosen.append((key, size))
+        freed += size
+        if freed >= bytes_needed:
+            break
+    else:
+        return None
+    for key, size in list(reversed(chosen)):
+        if freed - size >= bytes_needed:
+            chosen.remove((key, size))
+            freed -= size
+    return [key for key, _ in chosen]
+
+
+def _entries(directory):
+    """Yields the path, lstat and if it is a directory of the entries of
+    directory"""
+    if scandir is not None:
+        for entry in scandir(directory):
+            yield entry.path, entry.stat(follow_symlinks=False), \
+                entry.is_dir(follow_symlinks=False)
+        return
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        path_stat = os.lstat(path)
+        yield path, path_stat, stat.S_ISDIR(path_stat.st_mode)
+
+
+def path_size(source):
+    """Returns the bytes taken by source and everything under it.
+    Symlinks count as themselves rather than what they point to"""
+    total_size = os.lstat(source).st_size
+    directories = [source]
+    while directories:
+        for path, path_stat, is_dir in _entries(directories.pop()):
+            total_size += path_stat.st_size
+            if is_dir:
+                directories.append(path)
+    return total_size
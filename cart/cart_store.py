@@ -0,0 +1,132 @@
+#!/usr/bin/python
+"""Store of the files pulled from the archive, shared by the carts that
+ask for the same files.  A file is stored under a key from its archive
+file name, mtime and size, and carts hardlink to it instead of pulling
+it again.  StoreFile rows count the live carts linked to each file, a
+stored file is removed once no cart is linked to it.
+
+A file is only linked to after its count has been taken up, and the
+count is only dropped to remove the file when it is 0, so a file is
+never removed from under a cart linking to it.
+"""
+import os
+import errno
+import hashlib
+from collections import Counter
+from peewee import fn, IntegrityError
+from cart.cart_orm import File, StoreFile
+from cart.cart_env_globals import CART_STORE_PATH
+
+
+def store_key(file_name, mtime, size):
+    """Key of the stored copy of an archive file"""
+    return hashlib.sha1('{0}\0{1}\0{2}'.format(file_name, mtime, size)).hexdigest()
+
+
+def store_path(key):
+    """Path of the stored file of key"""
+    return os.path.join(CART_STORE_PATH, key[:2], key[2:])
+
+
+def _replace_link(source, link_name):
+    """Hardlink source to link_name, replacing anything at link_name"""
+    try:
+        os.unlink(link_name)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+    os.link(source, link_name)
+
+
+def link_stored(key, path):
+    """Link the stored file of key to path.  Returns False if the file
+    isnt stored"""
+    if not StoreFile.update(refs=StoreFile.refs + 1).where(StoreFile.key == key).execute():
+        return False
+    try:
+        _replace_link(store_path(key), path)
+    except OSError:
+        release([key])
+        return False
+    return True
+
+
+def add_stored(key, size, path):
+    """Store the file pulled to path under key.  Returns False if it
+    couldnt be stored, the file is then only the carts"""
+    try:
+        #a savepoint, so a taken key doesnt abort the callers transaction
+        with StoreFile.atomic():
+            StoreFile.create(key=key, size=size, refs=1)
+    except IntegrityError:
+        #stored by another cart while this one was pulling it
+        return False
+    try:
+        try:
+            os.makedirs(os.path.dirname(store_path(key)))
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        _replace_link(path, store_path(key))
+    except OSError:
+        StoreFile.delete().where(StoreFile.key == key).execute()
+        return False
+    return True
+
+
+def release(keys):
+    """Drop a reference to each stored file of keys, one for each time the
+    key is given"""
+    by_count = {}
+    for key, count in Counter(keys).items():
+        by_count.setdefault(count, []).append(key)
+    for count, counted in by_count.items():
+        StoreFile.update(refs=StoreFile.refs - count).where(StoreFile.key << counted).execute()
+
+
+def cart_keys(cart_id):
+    """Keys of the stored files a cart is linked to"""
+    return [key for (key,) in File
+            .select(File.store_key)
+            .where((File.cart == cart_id) & (File.store_key.is_null(False)))
+            .tuples()]
+
+
+def shared_bytes(cart_id):
+    """Bytes of the files of a cart that other carts are also linked to,
+    which arent freed when the cart is deleted"""
+    if not cart_keys(cart_id):
+        return 0
+    shared = (File
+              .select(fn.SUM(File.size))
+              .join(StoreFile, on=(File.store_key == StoreFile.key))
+              .where((File.cart == cart_id) & (StoreFile.refs > 1))
+              .scalar())
+    return long(shared or 0)
+
+
+def carts_shared_bytes(cart_ids):
+    """The shared_bytes of each of cart_ids in one query, carts with none
+    shared are left out"""
+    if not cart_ids:
+        return {}
+    shared = (File
+              .select(File.cart, fn.SUM(File.size))
+              .join(StoreFile, on=(File.store_key == StoreFile.key))
+              .where((File.cart << list(cart_ids)) & (StoreFile.refs > 1))
+              .group_by(File.cart)
+              .tuples())
+    return dict((cart_id, long(size or 0)) for cart_id, size in shared)
+
+
+def remove_unreferenced(keys):
+    """Remove the stored files of keys no cart is linked to"""
+    if not keys:
+        return
+    for (key,) in StoreFile.select(StoreFile.key).where(
+            (StoreFile.key << list(keys)) & (StoreFile.refs <= 0)).tuples():
+        if StoreFile.delete().where((StoreFile.key == key) & (StoreFile.refs <= 0)).execute():
+            try:
+                os.unlink(store_path(key))
+            except OSError:
+                pass
@@ -6,13 +6,29 @@ import os
 import json
 import datetime
 import errno
-import shutil
+import itertools
+import random
 import psutil
 from peewee import DoesNotExist
 from cart.cart_orm import Cart, File
+from cart.cart_notify import NOTIFIER
+from cart.cart_space import space_lock, available_bytes, path_size, plan_eviction, cart_bytes
+from cart.cart_store import store_key, link_stored, add_stored, release, cart_keys
+from cart.cart_store import shared_bytes, carts_shared_bytes
+from cart.celery import CART_APP
+from cart.cart_bundle import TarStream, write_bundle, prebuilt_path, compression_available
 from cart.cart_env_globals import VOLUME_PATH, LRU_BUFFER_TIME
+from cart.cart_env_globals import STAGE_BACKOFF_BASE, STAGE_BACKOFF_MAX
+from cart.cart_env_globals import STAGE_BACKOFF_JITTER, CART_INSERT_CHUNK
+from cart.cart_env_globals import CART_PREBUILD, CART_ACCESS_RESOLUTION, CART_STORE
 
 
+def _lock_live_cart(cart_id):
+    """Lock the row of a cart until the transaction ends.  Returns False
+    once the cart is deleted, its stored files are then already released"""
+    return bool(list(Cart.locking(Cart.select(Cart.id).where(
+        (Cart.id == cart_id) & (Cart.deleted_date.is_null(True))))))
+
 
 class Cartutils(object):
     """Class used to provide utility functions for the
@@ -55,11 +71,8 @@ class Cartutils(object):
             cart_file_dirs = os.path.dirname(abs_cart_file_path)
             cls.create_bundle_directories(cart_file_dirs)
         except OSError as ex:
-            cart_file.status = 'error'
-            cart_file.error = 'Failed directory create with error: ' + str(ex)
-            cart_file.save()
-            mycart.updated_date = datetime.datetime.now()
-            mycart.save()
+            error_msg = 'Failed directory create with error: ' + str(ex)
+            cls.set_file_status(cart_file, mycart, 'error', error_msg)
             return False
 
         return True
@@ -72,8 +85,8 @@ class Cartutils(object):
     #
     ###########################################################################
 
-    @staticmethod
-    def check_file_size_needed(response, cart_file, mycart):
+    @classmethod
+    def check_file_size_needed(cls, response, cart_file, mycart):
         """Checks response (should be from Archive Interface head request)
          for file size """
         try:
@@ -81,63 +94,129 @@ class Cartutils(object):
             filesize = decoded['filesize']
             return long(filesize)
         except (ValueError, KeyError, TypeError) as ex:
-            cart_file.status = 'error'
-            cart_file.error = """Failed to decode file size
+            error_msg = """Failed to decode file size
             json with error: """ + str(ex) + """ Response received from the
             Archive is: """ + str(response)
-            cart_file.save()
-            mycart.updated_date = datetime.datetime.now()
-            mycart.save()
+            cls.set_file_status(cart_file, mycart, 'error', error_msg)
             return -1
 
 
     def check_space_requirements(
             self, cart_file, mycart, size_needed, deleted_flag):
-        """Checks to make sure there is enough space available on disk
-        for the file to be downloaded
-        Note it will recursively call itself if there isnt enough
-        space. It will delete a cart first, then call  itself
-        until either there is enough space or there is no carts to delete"""
-        try:
-            #available space is in bytes
-            available_space = long(psutil.disk_usage(self._vol_path).free)
-        except psutil.Error as ex:
-            cart_file.status = 'error'
-            cart_file.error = """Failed to get available file
-            space with error: """ + str(ex)
-            cart_file.save()
-            mycart.updated_date = datetime.datetime.now()
-            mycart.save()
+        """Reserves the space for the file to be downloaded, unless it
+        was reserved with its cart or batch, see reserve_space"""
+        if cart_file.size is not None:
+            return True
+        error_msg = self.reserve_space(mycart, size_needed, deleted_flag)
+        if error_msg:
+            self.set_file_status(cart_file, mycart, 'error', error_msg)
             return False
+        File.update(size=size_needed).where(File.id == cart_file.id).execute()
+        cart_file.size = size_needed
+        return True
 
-        if size_needed > available_space:
-            if deleted_flag:
-                cart_deleted = self.lru_cart_delete(mycart)
-                return self.check_space_requirements(cart_file, mycart,
-                                                     size_needed, cart_deleted)
-            cart_file.status = 'error'
-            cart_file.error = 'Not enough space to download file'
-            cart_file.save()
-            mycart.updated_date = datetime.datetime.now()
-            mycart.save()
+    def reserve_batch_space(self, mycart, cart_files, responses):
+        """Reserves the space for a batch of files at once from their
+        archive responses.  Returns False, with the files set to error,
+        if the volume cant take all of them"""
+        sizes = {}
+        for cart_file in cart_files:
+            size = self.check_file_reported_size(responses.get(cart_file.file_name))
+            if cart_file.size is None and size is not None:
+                sizes[cart_file] = size
+        if not sizes:
+            return True
+        error_msg = self.reserve_space(mycart, sum(sizes.values()), True)
+        if error_msg:
+            for cart_file in sizes:
+                self.set_file_status(cart_file, mycart, 'error', error_msg)
             return False
+        with Cart.atomic():
+            for cart_file, size in sizes.items():
+                File.update(size=size).where(File.id == cart_file.id).execute()
+                cart_file.size = size
+        return True
 
-        #there is enough space so return true
+    def reserve_space(self, mycart, size_needed, deleted_flag):
+        """Reserves size_needed bytes of the volume for mycart.  Returns
+        None if it was reserved, otherwise the reason it wasnt.  When
+        deleted_flag is set the least recently accessed carts are evicted
+        to make room, see evict_carts"""
+        try:
+            with space_lock():
+                while True:
+                    #available space is in bytes
+                    available_space = available_bytes(self._vol_path)
+                    if size_needed <= available_space:
+                        Cart.update(reserved_bytes=Cart.reserved_bytes + size_needed).where(
+                            Cart.id == mycart.id).execute()
+                        return None
+                    if not deleted_flag or not self.evict_carts(
+                            mycart, size_needed - available_space):
+                        return 'Not enough space to download file'
+        except psutil.Error as ex:
+            return """Failed to get available file
+            space with error: """ + str(ex)
+        except (IOError, OSError) as ex:
+            return 'Failed to lock the volume space with error: ' + str(ex)
+
+    @staticmethod
+    def link_stored_file(cart_file, mycart, size, mtime, filepath):
+        """Link the stored copy of the file to filepath.  Returns False if
+        there isnt one.  The bytes are already on the volume so they are
+        counted as reserved and used without checking the free space"""
+        key = store_key(cart_file.file_name, mtime, size)
+        reserve = size if cart_file.size is None else 0
+        with Cart.atomic():
+            if not _lock_live_cart(mycart.id) or not link_stored(key, filepath):
+                return False
+            #the checksum taken by the cart that pulled the file
+            checksums = list(File
+                             .select(File.hashtype, File.hashsum)
+                             .where((File.store_key == key) & (File.hashsum.is_null(False)))
+                             .limit(1)
+                             .tuples())
+            hashtype, hashsum = checksums[0] if checksums else (None, None)
+            Cart.update(reserved_bytes=Cart.reserved_bytes + reserve,
+                        used_bytes=Cart.used_bytes + size).where(
+                            Cart.id == mycart.id).execute()
+            File.update(size=size, store_key=key, hashtype=hashtype, hashsum=hashsum).where(
+                File.id == cart_file.id).execute()
+        cart_file.size = size
+        cart_file.store_key = key
+        cart_file.hashtype = hashtype
+        cart_file.hashsum = hashsum
         return True
 
-    @classmethod
-    def get_path_size(cls, source):
+    @staticmethod
+    def store_pulled_file(cart_file, size, mtime, filepath):
+        """Keep the file pulled to filepath in the store for other carts"""
+        key = store_key(cart_file.file_name, mtime, size)
+        with Cart.atomic():
+            if not _lock_live_cart(cart_file.cart.id) or not add_stored(key, size, filepath):
+                return
+            File.update(store_key=key).where(File.id == cart_file.id).execute()
+        cart_file.store_key = key
+
+    @staticmethod
+    def set_file_checksum(cart_file, hasher):
+        """Record the checksum hasher took of the file as it was pulled"""
+        cart_file.hashtype = hasher.name.lower()
+        cart_file.hashsum = hasher.hexdigest()
+        File.update(hashtype=cart_file.hashtype, hashsum=cart_file.hashsum).where(
+            File.id == cart_file.id).execute()
+
+    @staticmethod
+    def add_used_space(mycart, size):
+        """Counts size bytes of mycarts reservation as written"""
+        Cart.update(used_bytes=Cart.used_bytes + size).where(Cart.id == mycart.id).execute()
+
+    @staticmethod
+    def get_path_size(source):
         """Returns the size of a specific directory, including
         all subdirectories and files
         """
-        total_size = os.path.getsize(source)
-        for item in os.listdir(source):
-            itempath = os.path.join(source, item)
-            if os.path.isfile(itempath):
-                total_size += os.path.getsize(itempath)
-            elif os.path.isdir(itempath):
-                total_size += cls.get_path_size(itempath)
-        return total_size
+        return path_size(source)
 
 
     ###########################################################################
@@ -162,23 +241,27 @@ class Cartutils(object):
                 abs_cart_file_path = os.path.join(
                     VOLUME_PATH, str(mycart.id), mycart.cart_uid, cart_file.bundle_path)
                 path_created = self.create_download_path(cart_file, mycart, abs_cart_file_path)
+                #files another cart already pulled are linked from the store
+                if CART_STORE and path_created and self.link_stored_file(
+                        cart_file, mycart, size_needed, mod_time, abs_cart_file_path):
+                    return {'modtime': mod_time, 'filepath': abs_cart_file_path,
+                            'filesize': size_needed, 'path_created': path_created,
+                            'enough_space': True, 'linked': True}
                 #Check size here and make sure enough space is available.
                 enough_space = self.check_space_requirements(cart_file, mycart, size_needed, True)
                 return {'modtime': mod_time, 'filepath': abs_cart_file_path,
-                        'path_created': path_created, 'enough_space': enough_space}
+                        'filesize': size_needed, 'path_created': path_created,
+                        'enough_space': enough_space, 'linked': False}
             return False
         except (ValueError, KeyError, TypeError) as ex:
-            cart_file.status = 'error'
-            cart_file.error = """Failed to decode json for file status
+            error_msg = """Failed to decode json for file status
             with error: """ + str(ex) + """ Response received from the
             Archive is: """ + str(response)
-            cart_file.save()
-            mycart.updated_date = datetime.datetime.now()
-            mycart.save()
+            self.set_file_status(cart_file, mycart, 'error', error_msg)
             return -1
 
-    @staticmethod
-    def check_file_modified_time(response, cart_file, mycart):
+    @classmethod
+    def check_file_modified_time(cls, response, cart_file, mycart):
         """Checks response (should be from Archive Interface head request)
          for file modified time """
         try:
@@ -186,15 +269,52 @@ class Cartutils(object):
             mod_time = decoded['mtime']
             return mod_time
         except (ValueError, KeyError, TypeError) as ex:
-            cart_file.status = 'error'
-            cart_file.error = """Failed to decode file mtime
+            error_msg = """Failed to decode file mtime
             json with error: """ + str(ex) + """ Response received from the
             Archive is: """ + str(response)
-            cart_file.save()
-            mycart.updated_date = datetime.datetime.now()
-            mycart.save()
+            cls.set_file_status(cart_file, mycart, 'error', error_msg)
             return -1
 
+    @staticmethod
+    def check_file_reported_size(response):
+        """Checks response (should be from Archive Interface head request)
+        for the file size.  Returns None when the response can not be
+        parsed, pull_file records that error"""
+        try:
+            return long(json.loads(response)['filesize'])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    @staticmethod
+    def check_file_storage_media(response):
+        """Checks response (should be from Archive Interface head request)
+        for the media the file is stored on.  Returns None when the
+        response can not be parsed, pull_file records that error"""
+        try:
+            return json.loads(response)['file_storage_media']
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    @staticmethod
+    def check_file_staging_delay(response, attempt):
+        """Checks response (should be from Archive Interface head request)
+        for how much of the file is still off disk and returns the seconds
+        to wait before checking the file again.  The wait backs off
+        exponentially with the attempt, shrinks as the file reaches disk
+        and has jitter added so a carts files dont all come back at once"""
+        remaining = 1.0
+        try:
+            levels = [long(level.strip().rstrip('L')) for level in
+                      json.loads(response)['bytes_per_level'].strip('()').split(',')
+                      if level.strip()]
+            if sum(levels) > 0:
+                remaining = float(sum(levels) - levels[0]) / sum(levels)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            pass
+        backoff = min(STAGE_BACKOFF_MAX, STAGE_BACKOFF_BASE * (2 ** min(attempt, 32)))
+        delay = STAGE_BACKOFF_BASE + (backoff - STAGE_BACKOFF_BASE) * remaining
+        return delay + random.uniform(0, delay * STAGE_BACKOFF_JITTER)
+
 
 
     ###########################################################################
@@ -205,63 +325,70 @@ class Cartutils(object):
     @classmethod
     def remove_cart(cls, uid):
         """Call when a DELETE request comes in. Verifies there is a cart
-        to delete then removes it
+        to delete then marks it for the reaper to remove
         """
-        deleted_flag = True
-        iterator = 0 #used to verify at least one cart deleted
         Cart.database_connect()
-        carts = (Cart
-                 .select()
-                 .where(
-                     (Cart.cart_uid == str(uid)) &
-                     (Cart.deleted_date.is_null(True))))
-        for cart in  carts:
-            iterator += 1
-            success = cls.delete_cart_bundle(cart)
-            if not success:
-                deleted_flag = False
+        carts = list(Cart
+                     .select()
+                     .where(
+                         (Cart.cart_uid == str(uid)) &
+                         (Cart.deleted_date.is_null(True))))
+        for cart in carts:
+            cls.delete_cart_bundle(cart)
         Cart.database_close()
-        if deleted_flag and iterator > 0:
-            return 'Cart Deleted Successfully'
-        elif deleted_flag:
+        if not carts:
             return False #already deleted
-        else:
-            return None #unknown error
+        cls.queue_reaper()
+        return 'Cart Deleted Successfully'
 
     @staticmethod
     def delete_cart_bundle(cart):
-        """ Gets the path to where a carts file are and
-        attempts to delete the file tree"""
-        try:
-            path_to_files = os.path.join(VOLUME_PATH, str(cart.id))
-            shutil.rmtree(path_to_files)
-            cart.status = 'deleted'
+        """Marks the cart deleted.  Its file tree is left for the reaper,
+        see cart_reaper.  Files other carts are linked to stay, so they
+        dont count in the bytes the reaper will free"""
+        with Cart.atomic():
+            #files stored or linked by a pull are released here or not at all
+            _lock_live_cart(cart.id)
+            cart.used_bytes = max(cart.used_bytes - shared_bytes(cart.id), 0)
+            release(cart_keys(cart.id))
+            cart.status = 'deleting'
             cart.deleted_date = datetime.datetime.now()
             cart.save()
-            return True
-        except OSError:
-            return False
+        NOTIFIER.forget(cart.cart_uid)
 
     @classmethod
-    def lru_cart_delete(cls, mycart):
-        """Delete the least recently used cart that isnt this one.
-        Only delete one cart per call
-        """
-        try:
-            lru_time = datetime.datetime.now() - datetime.timedelta(
-                seconds=int(LRU_BUFFER_TIME))
-            del_cart = (Cart
-                        .select()
-                        .where(
-                            (Cart.id != mycart.id) &
-                            (Cart.deleted_date.is_null(True)) &
-                            (Cart.updated_date < lru_time))
-                        .order_by(Cart.creation_date)
-                        .get())
-            return cls.delete_cart_bundle(del_cart)
-        except DoesNotExist:
-            #case if no cart exists that can be deleted
+    def evict_carts(cls, mycart, bytes_needed):
+        """Evict the least recently accessed carts that arent this one to
+        free bytes_needed, choosing all of them at once.  The carts are
+        marked deleting and their files removed by the reaper.
+        Returns False when there arent enough carts to evict"""
+        lru_time = datetime.datetime.now() - datetime.timedelta(
+            seconds=int(LRU_BUFFER_TIME))
+        candidates = (Cart
+                      .select(Cart.id, Cart.reserved_bytes, Cart.used_bytes)
+                      .where(
+                          (Cart.id != mycart.id) &
+                          (Cart.deleted_date.is_null(True)) &
+                          (Cart.accessed_date < lru_time) &
+                          (Cart.updated_date < lru_time))
+                      .order_by(Cart.accessed_date, Cart.id)
+                      .tuples())
+        candidates = list(candidates)
+        shared = carts_shared_bytes([cart_id for cart_id, _, _ in candidates])
+        evict_ids = plan_eviction(((cart_id, cart_bytes(reserved, used) - shared.get(cart_id, 0))
+                                   for cart_id, reserved, used in candidates), bytes_needed)
+        if not evict_ids:
             return False
+        for del_cart in Cart.select().where(Cart.id << evict_ids):
+            cls.delete_cart_bundle(del_cart)
+        cls.queue_reaper()
+        return True
+
+    @staticmethod
+    def queue_reaper():
+        """Have a worker remove the files of deleted carts.  Sent by name
+        as the tasks module imports this one"""
+        CART_APP.send_task('cart.tasks.reap_carts')
 
 
 
@@ -291,10 +418,20 @@ class Cartutils(object):
         if mycart:
             #send the status and any available error text
             status = [mycart.status, mycart.error]
+            Cartutils.touch_cart(mycart)
 
         Cart.database_close()
         return status
 
+    @staticmethod
+    def touch_cart(mycart):
+        """Record the cart was accessed, at most once every
+        CART_ACCESS_RESOLUTION seconds"""
+        now = datetime.datetime.now()
+        if mycart.accessed_date < now - datetime.timedelta(seconds=CART_ACCESS_RESOLUTION):
+            Cart.update(accessed_date=now).where(Cart.id == mycart.id).execute()
+            mycart.accessed_date = now
+
     @staticmethod
     def available_cart(uid):
         """Checks if the asked for cart tar is available
@@ -316,9 +453,36 @@ class Cartutils(object):
 
         if mycart and mycart.status == 'ready':
             cart_bundle_path = mycart.bundle_path
+            Cartutils.touch_cart(mycart)
         Cart.database_close()
         return cart_bundle_path
 
+    @staticmethod
+    def cart_manifest(uid):
+        """Returns the bundle path, size and checksum of every file of the
+        ready cart, from what was recorded as they were pulled.  None if
+        there is no ready cart"""
+        Cart.database_connect()
+        try:
+            mycart = (Cart
+                      .select()
+                      .where(
+                          (Cart.cart_uid == str(uid)) &
+                          (Cart.deleted_date.is_null(True)) &
+                          (Cart.status == 'ready'))
+                      .order_by(Cart.creation_date.desc())
+                      .get())
+        except DoesNotExist:
+            Cart.database_close()
+            return None
+        manifest = list(File
+                        .select(File.bundle_path, File.size, File.hashtype, File.hashsum)
+                        .where((File.cart == mycart.id) & (File.status == 'staged'))
+                        .order_by(File.bundle_path)
+                        .tuples())
+        Cart.database_close()
+        return manifest
+
 
     ###########################################################################
     #
@@ -327,8 +491,22 @@ class Cartutils(object):
     ###########################################################################
     @staticmethod
     def set_file_status(cart_file, cart, status, error):
-        """Sets the status and/or error for a cart"""
-        cart_file.status = str(status)
+        """Sets the status and/or error for a cart file.  The file is moved
+        between the carts pending/staged/error counters in the same
+        transaction so the cart never has to count its files"""
+        status = str(status)
+        with Cart.atomic():
+            old_status = Cart.locking(
+                File.select(File.status).where(File.id == cart_file.id)).get().status
+            File.update(status=status).where(File.id == cart_file.id).execute()
+            old_counter = Cart.status_counter(old_status)
+            new_counter = Cart.status_counter(status)
+            if old_counter.name != new_counter.name:
+                Cart.update(**{
+                    old_counter.name: old_counter - 1,
+                    new_counter.name: new_counter + 1
+                }).where(Cart.id == cart.id).execute()
+        cart_file.status = status
         if error:
             cart_file.error = str(error)
         cart_file.save()
@@ -338,66 +516,141 @@ class Cartutils(object):
 
     @classmethod
     def update_cart_files(cls, cart, file_ids):
-        """Update the files associated to a cart"""
+        """Update the files associated to a cart.  The files are inserted
+        in chunks of CART_INSERT_CHUNK rows"""
+        rows = ({'cart': cart.id, 'file_name': f_id['id'],
+                 'bundle_path': cls.fix_absolute_path(f_id['path'])} for f_id in file_ids)
+        total = 0
         with Cart.atomic():
-            for f_id in file_ids:
-                filepath = cls.fix_absolute_path(f_id['path'])
-                File.create(
-                    cart=cart, file_name=f_id['id'], bundle_path=filepath)
-                cart.updated_date = datetime.datetime.now()
-                cart.save()
+            chunk = list(itertools.islice(rows, CART_INSERT_CHUNK))
+            while chunk:
+                File.insert_many(chunk).execute()
+                total += len(chunk)
+                chunk = list(itertools.islice(rows, CART_INSERT_CHUNK))
+            cart.updated_date = datetime.datetime.now()
+            Cart.update(pending_count=Cart.pending_count + total,
+                        updated_date=cart.updated_date).where(
+                            Cart.id == cart.id).execute()
 
     @classmethod
     def prepare_bundle(cls, cartid):
-        """Checks to see if all the files are staged locally
-        before calling the bundling action.  If not will call
-        itself to continue the waiting process
+        """Checks the carts file counters to see if all the files
+        are staged locally before calling the bundling action.
+        The last file to finish will call this again
         """
         Cart.database_connect()
-        bundle_flag = True
-        for c_file in File.select().where(File.cart == cartid):
-            if c_file.status == 'error':
-                #error pulling file so set cart error and return
-                try:
-                    mycart = Cart.get(Cart.id == cartid)
-                    mycart.status = 'error'
-                    mycart.error = 'Failed to pull file(s)'
-                    mycart.updated_date = datetime.datetime.now()
-                    mycart.save()
-                    Cart.database_close()
-                    return
-                except DoesNotExist: # pragma: no cover
-                    #case if record no longer exists
-                    #creating this case in unit testing requires deletion and creation
-                    #occuring nearly simultaneously, as such cant create unit test
-                    Cart.database_close()
-                    return
-
-            elif c_file.status != 'staged':
-                bundle_flag = False
-
-        cls.tar_files(cartid, bundle_flag)
+        try:
+            mycart = Cart.get(Cart.id == cartid)
+        except DoesNotExist: # pragma: no cover
+            #case if record no longer exists
+            #creating this case in unit testing requires deletion and creation
+            #occuring nearly simultaneously, as such cant create unit test
+            Cart.database_close()
+            return
+
+        if mycart.error_count > 0:
+            #error pulling file so set cart error and return.  A cart
+            #deleted while its files were pulled is left to the reaper
+            if Cart.update(status='error', error='Failed to pull file(s)',
+                           updated_date=datetime.datetime.now()).where(
+                               (Cart.id == mycart.id) & (Cart.status == 'staging')).execute():
+                NOTIFIER.notify(mycart.cart_uid)
+            #once the last pull is over the space it didnt use is let go
+            if mycart.pending_count <= 0:
+                Cart.update(reserved_bytes=Cart.used_bytes).where(
+                    (Cart.id == mycart.id) & (Cart.deleted_date.is_null(True)) &
+                    (Cart.reserved_bytes > Cart.used_bytes)).execute()
+            Cart.database_close()
+            return
+
+        cls.tar_files(cartid, mycart.pending_count <= 0)
         Cart.database_close()
 
-    @staticmethod
-    def tar_files(cartid, bundle_flag):
+    @classmethod
+    def tar_files(cls, cartid, bundle_flag):
         """Start to bundle all the files together
         Due to streaming the tar we dont need to try and bundle
-        everything together"""
+        everything together.  Only the call that moves the cart on
+        from staging goes on, so pulls finishing at the same time dont
+        both bundle it, and carts deleted while their files were pulled
+        stay deleting.  With CART_PREBUILD the cart is bundling until a
+        worker has written its bundle, see build_cart_bundle, so no
+        download starts from a stream and resumes from the bundle"""
 
         if bundle_flag:
             Cart.database_connect()
             try:
                 mycart = Cart.get(Cart.id == cartid)
-                bundle_path = os.path.join(
-                    VOLUME_PATH, str(mycart.id), (mycart.cart_uid))
-                mycart.status = 'ready'
-                mycart.bundle_path = bundle_path
-                mycart.updated_date = datetime.datetime.now()
-                mycart.save()
             except DoesNotExist:
                 #case if record no longer exists
                 Cart.database_close()
                 return
+            bundle_path = os.path.join(
+                VOLUME_PATH, str(mycart.id), (mycart.cart_uid))
+            claimed = Cart.update(
+                status='bundling' if CART_PREBUILD else 'ready', bundle_path=bundle_path,
+                updated_date=datetime.datetime.now()).where(
+                    (Cart.id == mycart.id) & (Cart.status == 'staging')).execute()
+            if claimed and CART_PREBUILD:
+                NOTIFIER.notify(mycart.cart_uid)
+                cls.queue_prebuild(mycart.id)
+            elif claimed:
+                cls.cart_ready(mycart)
+            Cart.database_close()
 
+    @classmethod
+    def build_cart_bundle(cls, cartid):
+        """Write the bundle of a bundling cart, then make it ready"""
+        Cart.database_connect()
+        try:
+            mycart = Cart.get(Cart.id == cartid)
+        except DoesNotExist:
             Cart.database_close()
+            return
+        if mycart.status == 'bundling':
+            cls.prebuild_bundle(mycart, mycart.bundle_path)
+            #a cart deleted while its bundle was written stays deleting
+            if Cart.update(status='ready', updated_date=datetime.datetime.now()).where(
+                    (Cart.id == mycart.id) & (Cart.status == 'bundling')).execute():
+                cls.cart_ready(mycart)
+        Cart.database_close()
+
+    @staticmethod
+    def cart_ready(mycart):
+        """Settle the space of a cart that just became ready and tell the
+        waiters"""
+        #the cart wont grow now, so its reservation is what it used
+        try:
+            used_bytes = path_size(os.path.join(VOLUME_PATH, str(mycart.id)))
+            Cart.update(used_bytes=used_bytes, reserved_bytes=used_bytes).where(
+                (Cart.id == mycart.id) & (Cart.deleted_date.is_null(True))).execute()
+        except OSError:
+            pass
+        NOTIFIER.notify(mycart.cart_uid)
+
+    @staticmethod
+    def queue_prebuild(cartid):
+        """Have a worker write the bundle of the cart.  Sent by name as
+        the tasks module imports this one"""
+        CART_APP.send_task('cart.tasks.prebuild_cart', args=(cartid,))
+
+    @classmethod
+    def prebuild_bundle(cls, mycart, bundle_path):
+        """Write the bundle of the cart out once, when CART_PREBUILD asks
+        for it, so downloads are served from the file.  The bundle has the
+        top directory downloads stream with.  A cart whose bundle cant be
+        written is still made ready, its downloads are streamed"""
+        if not CART_PREBUILD or not os.path.isdir(bundle_path):
+            return
+        formats = ['tar'] + [bundle_format for bundle_format in CART_PREBUILD.split('+')[1:]
+                             if compression_available(bundle_format)]
+        stream = TarStream(bundle_path, os.path.basename(bundle_path))
+        #the bundles take the space of the tar each, incompressible data
+        #is stored
+        if cls().reserve_space(mycart, stream.size() * len(formats), True):
+            return
+        for bundle_format in formats:
+            try:
+                write_bundle(stream, prebuilt_path(bundle_path, bundle_format), bundle_format)
+            except (IOError, OSError):
+                return
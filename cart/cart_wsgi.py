@@ -0,0 +1,122 @@
+#!/usr/bin/python
+"""WSGI server pieces for running the cart interface.  Bundles are sent
+with sendfile where the platform has it, so file data goes from the page
+cache to the socket without being copied through python.
+"""
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+from cart.cart_env_globals import CART_SENDFILE
+
+
+def _libc_sendfile():
+    """Returns sendfile(out_fd, in_fd, offset, count) from libc, or None
+    where it isnt available.  Python 2 has no os.sendfile."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_sendfile = getattr(libc, 'sendfile64', None) or libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                              ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        """Send count bytes of in_fd from offset, returns the bytes sent"""
+        offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+SENDFILE = getattr(os, 'sendfile', None) or _libc_sendfile()
+
+#largest count handed to one sendfile call
+SENDFILE_CHUNK = 1 << 30
+
+class SendfileServerHandler(ServerHandler):
+    """ServerHandler that sends the file data of a bundle with sendfile.
+    Bundles are the results with a segments method, yielding strings to
+    write and (path, offset, size) tuples of file data to send.
+    """
+    def result_is_file(self):
+        """Bundles are handled by sendfile"""
+        if hasattr(self.result, 'segments'):
+            return True
+        return ServerHandler.result_is_file(self)
+
+    def sendfile(self):
+        """Send the bundle, False to have it iterated instead"""
+        if not CART_SENDFILE or SENDFILE is None or not hasattr(self.result, 'segments'):
+            return False
+        try:
+            out_fd = self.stdout.fileno()
+        except (AttributeError, IOError):
+            return False
+        for segment in self.result.segments():
+            if isinstance(segment, tuple):
+                self._send_segment(out_fd, *segment)
+            else:
+                self.write(segment)
+        self.finish_content()
+        return True
+
+    def _send_segment(self, out_fd, path, offset, size):
+        """Send size bytes of path from offset.  A file that shrank is
+        filled out with NULs, the headers already promised the size"""
+        if not self.headers_sent:
+            self.write('')
+        self._flush()
+        with open(path, 'rb') as segment_file:
+            while size > 0:
+                try:
+                    sent = SENDFILE(out_fd, segment_file.fileno(), offset, min(size, SENDFILE_CHUNK))
+                except OSError as ex:
+                    if ex.errno in (errno.EINTR, errno.EAGAIN):
+                        continue
+                    raise
+                if not sent:
+                    break
+                offset += sent
+                size -= sent
+                self.bytes_sent += sent
+        while size > 0:
+            fill = min(size, 1 << 20)
+            self.write('\0' * fill)
+            size -= fill
+
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    """WSGIRequestHandler running requests through SendfileServerHandler"""
+    def handle(self):
+        """Handle a single HTTP request"""
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request(): # An error code has been sent, just exit
+            return
+
+        handler = SendfileServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ()
+        )
+        handler.request_handler = self # backpointer for logging
+        handler.run(self.server.get_app())
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """Handle every request in its own thread so long polls for a carts
+    status dont hold up other requests"""
+    daemon_threads = True
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""Bounded cache of cart statuses for the interface process.  Lets the
+HEAD polling of carts be answered without a database query.
+"""
+import time
+import threading
+from collections import OrderedDict
+from cart.cart_env_globals import STATUS_CACHE_SIZE, STATUS_CACHE_TTL
+from cart.cart_env_globals import STATUS_CACHE_TERMINAL_TTL, CART_ACCESS_RESOLUTION
+
+
+#states a cart doesnt leave on its own
+TERMINAL_STATES = ('ready', 'error', 'deleted')
+
+class StatusCache(object):
+    """LRU cache of cart uid to the cart_status of the uid.  Carts still
+    being worked on are cached for ttl seconds.  Carts in a terminal state
+    are cached for terminal_ttl seconds, or until invalidated when
+    terminal_ttl is 0.  No status is cached longer than access_ttl
+    seconds, so polled carts are read again and their access recorded,
+    None lifts that limit.
+    """
+    def __init__(self, size=STATUS_CACHE_SIZE, ttl=STATUS_CACHE_TTL,
+                 terminal_ttl=STATUS_CACHE_TERMINAL_TTL, access_ttl=CART_ACCESS_RESOLUTION):
+        self.size = size
+        self.ttl = ttl
+        self.terminal_ttl = terminal_ttl
+        self.access_ttl = access_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uid):
+        """Return the cached status of uid or None"""
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is None or entry[0] is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+            #most recently used entries are kept at the end
+            del self._entries[uid]
+            self._entries[uid] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, uid, status):
+        """Cache status for uid"""
+        if self.size <= 0:
+            return
+        now = time.time()
+        ttl = self.ttl
+        if self._terminal(status):
+            ttl = self.terminal_ttl or float('inf')
+        #reading the cart records the polls as access of it, see touch_cart
+        if self.access_ttl is not None:
+            ttl = min(ttl, self.access_ttl)
+        with self._lock:
+            entry = self._entries.pop(uid, None)
+            if entry is not None and entry[0] is None and entry[1] > now:
+                #recently invalidated, the status read may be from before the
+                #request that invalidated it so dont hold on to it
+                ttl = min(ttl, self.ttl)
+            self._entries[uid] = (status, now + ttl)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, uid):
+        """Forget the status of uid, call when a request changes the cart"""
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(uid, None)
+            self._entries[uid] = (None, time.time() + self.ttl)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Return the hit and miss counters and the number of entries"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+    def clear(self):
+        """Forget everything"""
+        with self._lock:
+            self._entries.clear()
+
+    @staticmethod
+    def _terminal(status):
+        """Check if status is a terminal state of an existing cart"""
+        if status[0] not in TERMINAL_STATES:
+            return False
+        #a missing cart may be created by another interface process
+        return not str(status[1]).startswith('No cart with uid')
+
+STATUS_CACHE = StatusCache()
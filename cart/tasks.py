@@ -4,20 +4,31 @@ cart infrastructure
 
 from __future__ import absolute_import
 import os
+import errno
+import hashlib
 import requests
+from celery.signals import worker_ready
 from peewee import DoesNotExist
 from cart.celery import CART_APP
 from cart.cart_orm import Cart, File
 from cart.cart_utils import Cartutils
+from cart.cart_notify import NOTIFIER
+from cart.cart_reaper import reap
+from cart.cart_scheduler import dispatch_files
 from cart.archive_requests import ArchiveRequests
+from cart.archive_limits import any_media_limited, hold_media, renew_media, release_media
+from cart.cart_env_globals import ARCHIVE_BATCH_SIZE, STAGE_BACKOFF_ATTEMPTS, CART_STORE
+from cart.cart_env_globals import CART_CHECKSUM, ARCHIVE_PULL_RETRIES, VOLUME_PATH
+from cart.cart_env_globals import ARCHIVE_LEASE_TIME
 
 
 @CART_APP.task(ignore_result=True)
-def create_cart(file_ids, uid):
+def create_cart(file_ids, uid, priority=0):
     """Create the cart or update previous"""
     Cart.database_connect()
-    mycart = Cart(cart_uid=uid, status='staging')
+    mycart = Cart(cart_uid=uid, status='staging', priority=priority)
     mycart.save()
+    NOTIFIER.notify(uid)
     stage_files.delay(file_ids, mycart.id)
     Cart.database_close()
 
@@ -29,84 +40,346 @@ def stage_files(file_ids, mycart_id):
     mycart = Cart.get(Cart.id == mycart_id)
     cart_utils = Cartutils()
     cart_utils.update_cart_files(mycart, file_ids)
-
-    get_files_locally.delay(mycart.id)
+    if _reserve_cart(mycart):
+        _pull_files(mycart)
+        Cart.database_close()
+        return
     Cart.database_close()
+    cart_utils.prepare_bundle(mycart.id)
+
+def _reserve_cart(mycart):
+    """Reserve the space of all the files of a new cart before any of
+    them is pulled, so carts pulled at the same time cant each get part
+    way and wait on the space the other holds.  Returns False, with the
+    files set to error, if the volume cant take them"""
+    cart_files = list(File.select().where(File.cart == mycart.id))
+    statuses = ArchiveRequests().status_files([cart_file.file_name for cart_file in cart_files])
+    return Cartutils().reserve_batch_space(mycart, cart_files, statuses)
 
 @CART_APP.task(ignore_result=True)
 def get_files_locally(cartid):
     """Pull the files to the local system from the backend """
-    #tell each file to be pulled
     Cart.database_connect()
-    for cart_file in File.select().where(File.cart == cartid):
-        pull_file.delay(cart_file.id, False)
+    _pull_files(Cart.get(Cart.id == cartid))
     Cart.database_close()
 
+def _pull_files(mycart):
+    """Queue the next window of the carts waiting files, each file to be
+    pulled or each group of files to be staged"""
+    cartid = mycart.id
+    file_ids = dispatch_files(mycart)
+    if ARCHIVE_BATCH_SIZE > 0:
+        for index in range(0, len(file_ids), ARCHIVE_BATCH_SIZE):
+            stage_file_batch.delay(cartid, file_ids[index:index + ARCHIVE_BATCH_SIZE])
+    else:
+        for file_id in file_ids:
+            pull_file.delay(file_id, False)
+
+@CART_APP.task(ignore_result=True)
+def stage_file_batch(cartid, file_ids, attempt=0):
+    """Status and stage a group of a carts files at once. Files are only
+    handed to pull_file, with their status, once the archive reports
+    they are on disk, the rest are checked again after a backoff"""
+    Cart.database_connect()
+    try:
+        mycart = Cart.get(Cart.id == cartid)
+    except DoesNotExist:
+        Cart.database_close()
+        return
+    #make sure cart wasnt deleted before staging files
+    if mycart.deleted_date:
+        for file_id in file_ids:
+            release_media(file_id)
+        Cart.database_close()
+        return
+    cart_utils = Cartutils()
+    archive_request = ArchiveRequests()
+    cart_files = list(File.select().where(
+        (File.cart == cartid) & (File.id << file_ids)))
+    failed = False
+    statuses = archive_request.status_files([cart_file.file_name for cart_file in cart_files])
 
+    #only the first pass stages, later passes are waiting on the archive
+    if not attempt:
+        #the batch is off the queue, so queue the next of the cart
+        if File.update(status='staging').where(
+                (File.id << file_ids) & (File.status == 'queued')).execute():
+            _pull_files(mycart)
+        #reserve the space of the whole batch before any of it is pulled
+        if not cart_utils.reserve_batch_space(mycart, cart_files, statuses):
+            Cart.database_close()
+            cart_utils.prepare_bundle(cartid)
+            return
+        cart_files = _hold_batch_media(cart_files, statuses)
+        #files already on disk dont need staging
+        off_disk = [cart_file.file_name for cart_file in cart_files
+                    if cart_utils.check_file_storage_media(
+                        statuses[cart_file.file_name]) not in ('disk', None)]
+        staged = archive_request.stage_files(off_disk)
+        for cart_file in list(cart_files):
+            if staged.get(cart_file.file_name) is not None:
+                error_msg = 'Failed to stage with error: ' + str(staged[cart_file.file_name])
+                release_media(cart_file.id)
+                cart_utils.set_file_status(cart_file, mycart, 'error', error_msg)
+                cart_files.remove(cart_file)
+                failed = True
+
+    pending = []
+    delays = []
+    for cart_file in cart_files:
+        response = statuses[cart_file.file_name]
+        if isinstance(response, requests.exceptions.RequestException):
+            error_msg = 'Failed to status file with error: ' + str(response)
+            release_media(cart_file.id)
+            cart_utils.set_file_status(cart_file, mycart, 'error', error_msg)
+            failed = True
+        elif cart_utils.check_file_storage_media(response) in ('disk', None):
+            #pull_file goes on from this status, and records responses
+            #that cant be parsed
+            release_media(cart_file.id)
+            pull_file.delay(cart_file.id, False, status=response)
+        elif attempt < STAGE_BACKOFF_ATTEMPTS:
+            pending.append(cart_file.id)
+            delays.append(cart_utils.check_file_staging_delay(response, attempt))
+            #the file keeps its media lease until it is checked again
+            renew_media(cart_file.id, delays[-1] + ARCHIVE_LEASE_TIME)
+        else:
+            release_media(cart_file.id)
+            error_msg = 'File was not staged to disk after ' + str(attempt) + ' checks'
+            cart_utils.set_file_status(cart_file, mycart, 'error', error_msg)
+            failed = True
+    Cart.database_close()
+
+    #come back when the file closest to disk should be there
+    if pending:
+        stage_file_batch.apply_async((cartid, pending, attempt + 1), countdown=min(delays))
+    if failed:
+        cart_utils.prepare_bundle(cartid)
+
+def _hold_batch_media(cart_files, statuses):
+    """Take the leases on the media the files of a batch are recalled
+    from before they are staged, see archive_limits.  Files whose media
+    is at its limit are left for pull_file to stage later, the rest are
+    returned"""
+    if not any_media_limited():
+        return cart_files
+    held = []
+    for cart_file in cart_files:
+        #files that cant be statused hold nothing, the batch records them
+        media = Cartutils.check_file_storage_media(statuses[cart_file.file_name])
+        if hold_media(cart_file.id, media):
+            held.append(cart_file)
+        else:
+            _wait_for_media(cart_file, media, 0)
+    return held
+
+def _wait_for_media(cart_file, media, waits):
+    """Stage the file once its media may have room, backing off with the
+    waits like a file that is not on disk yet is checked again"""
+    pull_file.apply_async((cart_file.id, False), {'media': media, 'waits': waits + 1},
+                          countdown=Cartutils.check_file_staging_delay(None, waits))
 
 @CART_APP.task(ignore_result=True)
-def pull_file(file_id, record_error):
-    """Pull a file from the archive  """
+def pull_file(file_id, record_error, attempt=0, retries=0, status=None, media=None, waits=0):
+    """Pull a file from the archive. attempt counts the checks made so
+    far on a file that is not on disk yet, retries the pulls that failed.
+    A failed pull is tried again ARCHIVE_PULL_RETRIES times, resuming from
+    where it got to, and record_error makes the next failure an error.
+    status is the archive status of a file its batch found on disk, the
+    file isnt staged or statused again.  media is the media a file
+    waiting for a lease is on and waits the times it has waited"""
     Cart.database_connect()
     try:
         cart_file = File.get(File.id == file_id)
         mycart = cart_file.cart
-        cart_utils = Cartutils()
-        cart_utils.set_file_status(cart_file, mycart, 'staging', False)
+        dispatched = cart_file.status == 'queued'
+        Cartutils().set_file_status(cart_file, mycart, 'staging', False)
         #make sure cart wasnt deleted before pulling file
         if mycart.deleted_date:
+            release_media(cart_file.id)
             return
+        #the file is off the queue, so queue the next of the cart
+        if dispatched:
+            _pull_files(mycart)
     except DoesNotExist:
         Cart.database_close()
         return
 
+    ready = _ready_to_pull(cart_file, attempt, status, media, waits)
+    if ready is None:
+        return
+    try:
+        hasher = _pull_to_cart(cart_file, ready)
+    except (IOError, OSError, requests.exceptions.RequestException) as ex:
+        _pull_failed(cart_file, ready, ex, record_error, retries)
+        return
+    _finish_file(cart_file, ready, hasher)
+
+def _ready_to_pull(cart_file, attempt, status, media, waits):
+    """Check the file is on disk from status, or from staging it on its
+    first attempt and statusing it when there isnt one.  Returns what
+    check_file_ready_pull found for a file to pull, None once the file
+    is linked from the store, in error or to be checked again after a
+    backoff"""
+    mycart = cart_file.cart
+    cart_utils = Cartutils()
+    response = status
+    if response is None:
+        response = _stage_and_status(cart_file, attempt, media, waits)
+        if response is None:
+            return None
+
+    ready = cart_utils.check_file_ready_pull(response, cart_file, mycart)
+
+    #Check to see if ready to pull.  If not schedule another check
+    #backing off until the file is on disk or the attempts run out
+    if ready is False:
+        if attempt < STAGE_BACKOFF_ATTEMPTS:
+            delay = cart_utils.check_file_staging_delay(response, attempt)
+            #the file keeps its media lease until it is checked again
+            renew_media(cart_file.id, delay + ARCHIVE_LEASE_TIME)
+            pull_file.apply_async((cart_file.id, False, attempt + 1), countdown=delay)
+            Cart.database_close()
+            return None
+        error_msg = 'File was not staged to disk after ' + str(attempt) + ' checks'
+        cart_utils.set_file_status(cart_file, mycart, 'error', error_msg)
+        ready = -1
+    #the file is on disk or failed, either way its recall is over
+    release_media(cart_file.id)
+
+    # error on less then 0.
+    if ready < 0 or not ready['path_created'] or not ready['enough_space']:
+        Cart.database_close()
+        cart_utils.prepare_bundle(mycart.id)
+        return None
+
+    #files linked from the store are already there
+    if ready['linked']:
+        cart_utils.set_file_status(cart_file, mycart, 'staged', False)
+        Cart.database_close()
+        cart_utils.prepare_bundle(mycart.id)
+        return None
+    return ready
+
+def _stage_and_status(cart_file, attempt, media, waits):
+    """Stage the file on the archive on its first attempt, later checks
+    only need the status.  Returns the status response, None if the file
+    is waiting on its media or failed to stage"""
+    mycart = cart_file.cart
+    cart_utils = Cartutils()
     archive_request = ArchiveRequests()
-    #stage the file on the archive.  True on success, False on fail
     try:
-        archive_request.stage_file(cart_file.file_name)
+        if not attempt:
+            #a file that waited already knows its media, dont status it again
+            if media is None and any_media_limited():
+                media = Cartutils.check_file_storage_media(
+                    archive_request.status_file(cart_file.file_name))
+            if not hold_media(cart_file.id, media):
+                if waits < STAGE_BACKOFF_ATTEMPTS:
+                    _wait_for_media(cart_file, media, waits)
+                    Cart.database_close()
+                    return None
+                error_msg = 'Media was not free to stage after ' + str(waits) + ' waits'
+                cart_utils.set_file_status(cart_file, mycart, 'error', error_msg)
+                Cart.database_close()
+                cart_utils.prepare_bundle(mycart.id)
+                return None
+            archive_request.stage_file(cart_file.file_name)
     except requests.exceptions.RequestException as ex:
+        release_media(cart_file.id)
         error_msg = 'Failed to stage with error: ' + str(ex)
         cart_utils.set_file_status(cart_file, mycart, 'error', error_msg)
         Cart.database_close()
         cart_utils.prepare_bundle(mycart.id)
-        return
+        return None
 
     #check to see if file is available to pull from archive interface
     try:
-        response = archive_request.status_file(cart_file.file_name)
+        return archive_request.status_file(cart_file.file_name)
     except requests.exceptions.RequestException as ex:
         error_msg = 'Failed to status file with error: ' + str(ex)
         cart_utils.set_file_status(cart_file, mycart, 'error', error_msg)
-        response = 'False'
+        return 'False'
 
-    ready = cart_utils.check_file_ready_pull(response, cart_file, mycart)
+def _pull_to_cart(cart_file, ready):
+    """Pull the file into the cart, in ranges or resuming an earlier
+    failed pull as the archive allows, and return the hasher that took
+    its checksum on the way.  A transfer cut short raises"""
+    hasher = hashlib.new(CART_CHECKSUM)
+    written = ArchiveRequests().pull_file(cart_file.file_name, ready['filepath'],
+                                          ready['filesize'], hasher, ready['modtime'])
+    #a transfer cut short is retried like any other failed pull
+    if written != ready['filesize']:
+        raise requests.exceptions.RequestException(
+            'Archive sent {0} of {1} bytes'.format(written, ready['filesize']))
+    return hasher
 
-    #Check to see if ready to pull.  If not recall this to check again
-    # error on less then 0. No coverage on recall since it just calls the method again
-    if ready < 0 or not ready['path_created'] or not ready['enough_space']:
+def _pull_failed(cart_file, ready, ex, record_error, retries):
+    """Try a failed pull again, once out of retries write the error"""
+    mycart = cart_file.cart
+    cart_utils = Cartutils()
+    #the reaper removed the files of a cart deleted during the pull
+    if not os.path.isdir(os.path.join(VOLUME_PATH, str(mycart.id))):
         Cart.database_close()
-        cart_utils.prepare_bundle(mycart.id)
         return
-    elif not ready: # pragma: no cover
-        pull_file.delay(file_id, False)
+    if record_error or retries >= ARCHIVE_PULL_RETRIES:
+        error_msg = 'Failed to pull with error: ' + str(ex)
+        cart_utils.set_file_status(cart_file, mycart, 'error', error_msg)
+        ArchiveRequests.discard_partial(ready['filepath'])
+        Cart.database_close()
+        cart_utils.prepare_bundle(mycart.id)
+    else:
+        pull_file.delay(cart_file.id, retries + 1 >= ARCHIVE_PULL_RETRIES, 0, retries + 1)
         Cart.database_close()
-        return
 
+def _finish_file(cart_file, ready, hasher):
+    """Record the checksum and space of the pulled file, keep it in the
+    store for other carts and bundle the cart if it was the last file"""
+    mycart = cart_file.cart
+    cart_utils = Cartutils()
+    cart_utils.set_file_checksum(cart_file, hasher)
+    cart_utils.add_used_space(mycart, ready['filesize'])
+    if CART_STORE:
+        cart_utils.store_pulled_file(cart_file, ready['filesize'], ready['modtime'],
+                                     ready['filepath'])
+    cart_utils.set_file_status(cart_file, mycart, 'staged', False)
+    Cart.database_close()
     try:
-        archive_request.pull_file(cart_file.file_name, ready['filepath'])
-        cart_utils.set_file_status(cart_file, mycart, 'staged', False)
-        Cart.database_close()
-    except requests.exceptions.RequestException as ex:
-        #if request fails...try a second time, if that fails write error
-        if record_error:
-            error_msg = 'Failed to pull with error: ' + str(ex)
-            cart_utils.set_file_status(cart_file, mycart, 'error', error_msg)
-            Cart.database_close()
-            cart_utils.prepare_bundle(mycart.id)
+        os.utime(ready['filepath'], (int(float(ready['modtime'])), int(float(ready['modtime']))))
+    except OSError as ex:
+        #the reaper removed the files of a cart deleted during the pull
+        if ex.errno != errno.ENOENT:
+            raise
+        return
+    cart_utils.prepare_bundle(mycart.id)
 
-        else:
-            pull_file.delay(file_id, True)
-            Cart.database_close()
+@CART_APP.task(ignore_result=True)
+def prebuild_cart(cartid):
+    """Write the bundle of a cart whose files are all pulled"""
+    Cartutils.build_cart_bundle(cartid)
 
-    os.utime(ready['filepath'], (int(float(ready['modtime'])), int(float(ready['modtime']))))
-    cart_utils.prepare_bundle(mycart.id)
+@CART_APP.task(ignore_result=True)
+def reap_carts():
+    """Remove the files of deleted carts"""
+    Cart.database_connect()
+    reap()
+    Cart.database_close()
+
+@CART_APP.task(ignore_result=True)
+def resume_bundling():
+    """Write the bundles of the carts left bundling"""
+    Cart.database_connect()
+    for (cartid,) in Cart.select(Cart.id).where(
+            (Cart.status == 'bundling') & (Cart.deleted_date.is_null(True))).tuples():
+        prebuild_cart.delay(cartid)
+    Cart.database_close()
+
+@worker_ready.connect
+def resume_reaping(**_):
+    """Pick up the carts left deleting when the workers last stopped"""
+    reap_carts.delay()
+
+@worker_ready.connect
+def resume_prebuilds(**_):
+    """Pick up the carts left bundling when the workers last stopped"""
+    resume_bundling.delay()
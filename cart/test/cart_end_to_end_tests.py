@@ -151,8 +151,7 @@ class TestCartEndToEnd(unittest.TestCase):
         cart_utils.update_cart_files(mycart, file_ids)
         get_files_locally(mycart.id)
         for cart_file in File.select().where(File.cart == mycart.id):
-            cart_file.status = 'error'
-            cart_file.save()
+            cart_utils.set_file_status(cart_file, mycart, 'error', False)
         cart_utils.prepare_bundle(mycart.id)
         status = mycart.status
         cartid = mycart.id
@@ -175,12 +174,10 @@ class TestCartEndToEnd(unittest.TestCase):
         cart_utils.update_cart_files(mycart, file_ids)
         get_files_locally(mycart.id)
         for cart_file in File.select().where(File.cart == mycart.id):
-            cart_file.status = 'staging'
-            cart_file.save()
+            cart_utils.set_file_status(cart_file, mycart, 'staging', False)
         cart_utils.prepare_bundle(mycart.id) #hitting more coverage, set files to staged
         for cart_file in File.select().where(File.cart == mycart.id):
-            cart_file.status = 'staged'
-            cart_file.save()
+            cart_utils.set_file_status(cart_file, mycart, 'staged', False)
         cart_utils.prepare_bundle(mycart.id) #call again after file update
         status = mycart.status
         cartid = mycart.id
@@ -3,12 +3,116 @@
 Add Unit Tests for archive interface.
 """
 
+import os
+import re
+import hashlib
 import unittest
+import threading
 from json import dumps, loads
 from tempfile import mkdtemp
 import httpretty
+import mock
 import requests
-from cart.archive_requests import ArchiveRequests
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError: # pragma: no cover
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+from cart.archive_requests import ArchiveRequests, FALLOCATE
+from cart.cart_env_globals import ARCHIVE_POOL_MAXSIZE
+
+class LocalArchive(object):
+    """
+    Stand-in for the archive interface.  Files start on tape, staging a
+    file moves it to disk after the next status.
+    """
+    endpoint_url = 'http://localhost:8080'
+
+    def __init__(self, files, on_disk=()):
+        self.files = dict(files)
+        self.staged = set()
+        self.on_disk = set(on_disk)
+        self.requests = []
+
+    def register(self):
+        """register the archive endpoints with httpretty"""
+        for file_name in self.files:
+            for method in [httpretty.GET, httpretty.POST, httpretty.HEAD]:
+                httpretty.register_uri(method, '%s/%s'%(self.endpoint_url, file_name),
+                                       body=self.respond)
+
+    def respond(self, request, uri, headers):
+        """answer a request like the archive interface would"""
+        file_name = uri.split('/')[-1]
+        self.requests.append((request.method, file_name))
+        if request.method == 'POST':
+            self.staged.add(file_name)
+            return (200, headers, dumps({'message': 'File was staged', 'file': file_name}))
+        body = self.files[file_name]
+        if request.method == 'HEAD':
+            media = 'disk' if file_name in self.on_disk else 'tape'
+            if file_name in self.staged:
+                self.on_disk.add(file_name)
+            headers.update({
+                'x-pacifica-messsage': 'File was found',
+                'x-pacifica-ctime': '1444938166',
+                'last-modified': '1444938166',
+                'x-pacifica-bytes-per-level': '(%dL, 0L, 0L, 0L, 0L)'%(len(body)),
+                'x-pacifica-file-storage-media': media
+            })
+        return (200, headers, body)
+
+
+class RangeArchiveHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in archive on a real socket sending files whole or in the byte
+    ranges asked for when the server supports ranges.  The server can cut
+    the connection after cut bytes of a response, and fail the ranges in
+    fail once each.
+    """
+    def do_GET(self): # pylint: disable=invalid-name
+        """send the file or the range of it asked for"""
+        body = self.server.files[self.path.lstrip('/')]
+        asked = self.headers.get('Range')
+        self.server.ranges_sent.append(asked)
+        if asked in self.server.fail:
+            self.server.fail.remove(asked)
+            self.send_error(500)
+            return
+        match = re.match(r'bytes=(\d+)-(\d+)$', asked or '')
+        if self.server.ranges and match:
+            start, end = int(match.group(1)), int(match.group(2))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d'%(start, end, len(body)))
+            body = body[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:self.server.cut])
+        if self.server.cut is not None:
+            self.close_connection = 1
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        """keep the test output quiet"""
+        pass
+
+
+class RangeArchive(ThreadingMixIn, HTTPServer):
+    """
+    Threaded server for the range archive handler
+    """
+    daemon_threads = True
+
+    def __init__(self, files, ranges=True):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), RangeArchiveHandler)
+        self.files = files
+        self.ranges = ranges
+        self.ranges_sent = []
+        self.cut = None
+        self.fail = []
+
 
 class TestArchiveRequests(unittest.TestCase):
     """
@@ -96,3 +200,237 @@ class TestArchiveRequests(unittest.TestCase):
         archreq = ArchiveRequests()
         with self.assertRaises(requests.exceptions.RequestException):
             archreq.stage_file('fakeFileName')
+
+    def test_archive_session_pooled(self):
+        """
+        Test the pooled session is shared between requests
+        """
+        first = ArchiveRequests().session()
+        second = ArchiveRequests().session()
+        self.assertTrue(first is second)
+        adapter = first.get_adapter('http://localhost:8080/')
+        self.assertEqual(adapter._pool_maxsize, ARCHIVE_POOL_MAXSIZE) # pylint: disable=protected-access
+
+    @mock.patch.object(os, 'getpid')
+    def test_archive_session_after_fork(self, mock_getpid):
+        """
+        Test a forked worker gets its own session
+        """
+        mock_getpid.return_value = -1
+        parent = ArchiveRequests().session()
+        mock_getpid.return_value = -2
+        child = ArchiveRequests().session()
+        self.assertFalse(parent is child)
+        self.assertTrue(child is ArchiveRequests().session())
+
+    @httpretty.activate
+    def test_archive_get_chunked(self):
+        """
+        Test pulling a file larger than the copy buffer
+        """
+        response_body = 'abcdefghij' * 100
+        httpretty.register_uri(httpretty.GET, '%s/1'%(self.endpoint_url),
+                               body=response_body,
+                               content_type='application/octet-stream')
+        temp_dir = mkdtemp()
+        archreq = ArchiveRequests()
+        with mock.patch('cart.archive_requests.ARCHIVE_CHUNK_SIZE', 64):
+            written = archreq.pull_file('1', '%s/1'%(temp_dir), len(response_body))
+            self.assertEqual(len(archreq._buffer()), 64) # pylint: disable=protected-access
+        self.assertEqual(written, len(response_body))
+        with open('%s/1'%(temp_dir), 'r') as testfd:
+            self.assertEqual(testfd.read(), response_body)
+
+    @httpretty.activate
+    def test_archive_get_short(self):
+        """
+        Test a pull the archive sends less of is kept to be resumed
+        """
+        response_body = 'short file'
+        httpretty.register_uri(httpretty.GET, '%s/1'%(self.endpoint_url),
+                               body=response_body,
+                               content_type='application/octet-stream')
+        temp_dir = mkdtemp()
+        archreq = ArchiveRequests()
+        fallocate = mock.Mock(wraps=FALLOCATE)
+        with mock.patch('cart.archive_requests.FALLOCATE', fallocate):
+            with self.assertRaises(requests.exceptions.RequestException):
+                archreq.pull_file('1', '%s/1'%(temp_dir), 4096, mtime='1444938166')
+        self.assertTrue(fallocate.called)
+        #preallocated space past what was received is dropped
+        self.assertFalse(os.path.exists('%s/1'%(temp_dir)))
+        self.assertEqual(os.path.getsize('%s/1.partial'%(temp_dir)), len(response_body))
+        with open('%s/1.partial.json'%(temp_dir)) as state_file:
+            self.assertEqual(loads(state_file.read()),
+                             {'mtime': '1444938166', 'offset': len(response_body)})
+        ArchiveRequests.discard_partial('%s/1'%(temp_dir))
+        self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_archive_preallocate(self):
+        """
+        Test the blocks of a pulled file are allocated through libc
+        """
+        self.assertTrue(FALLOCATE is not None)
+        temp_dir = mkdtemp()
+        with open('%s/1'%(temp_dir), 'wb') as testfd:
+            ArchiveRequests._preallocate(testfd.fileno(), 1 << 20) # pylint: disable=protected-access
+            file_stat = os.fstat(testfd.fileno())
+        self.assertEqual(file_stat.st_size, 1 << 20)
+        self.assertTrue(file_stat.st_blocks * 512 >= 1 << 20)
+        self.assertRaises(OSError, FALLOCATE, -1, 0, 1)
+
+    @httpretty.activate
+    def test_archive_stage_status_batch(self):
+        """
+        Test staging and statusing a group of files at once
+        """
+        archive = LocalArchive({'1': 'one', '2': 'two', '3': 'three'})
+        archive.register()
+        archreq = ArchiveRequests()
+        staged = archreq.stage_files(['1', '2', '3', '3'])
+        self.assertEqual(staged, {'1': None, '2': None, '3': None})
+        self.assertEqual(archive.staged, set(['1', '2', '3']))
+        statuses = archreq.status_files(['1', '2', '3'])
+        self.assertEqual(sorted(statuses.keys()), ['1', '2', '3'])
+        self.assertEqual(loads(statuses['3'])['filesize'], '5')
+        self.assertEqual(archreq.status_files([]), {})
+
+    @httpretty.activate
+    def test_archive_stage_batch_fail(self):
+        """
+        Test one failure in a batch does not fail the others
+        """
+        archive = LocalArchive({'1': 'one'})
+        archive.register()
+        httpretty.register_uri(httpretty.POST, '%s/2'%(self.endpoint_url),
+                               status=500, body='error')
+        staged = ArchiveRequests().stage_files(['1', '2'])
+        self.assertEqual(staged['1'], None)
+        self.assertTrue(isinstance(staged['2'], requests.exceptions.RequestException))
+
+    def start_archive(self, body, ranges=True):
+        """start a local range archive serving body as the file 1"""
+        server = RangeArchive({'1': body}, ranges)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    @staticmethod
+    def pull_local(server, cart_filepath, filesize, mtime=None):
+        """pull the file 1 from a local range archive in 128 byte ranges
+        from 500 bytes, returning the bytes written and the hasher"""
+        archreq = ArchiveRequests()
+        archreq._url = 'http://127.0.0.1:%d/'%(server.server_address[1]) # pylint: disable=protected-access
+        hasher = hashlib.sha1()
+        with mock.patch('cart.archive_requests.ARCHIVE_RANGE_THRESHOLD', 500), \
+             mock.patch('cart.archive_requests.ARCHIVE_RANGE_SIZE', 128), \
+             mock.patch('cart.archive_requests.ARCHIVE_RANGE_WORKERS', 3), \
+             mock.patch('cart.archive_requests.ARCHIVE_CHUNK_SIZE', 50):
+            written = archreq.pull_file('1', cart_filepath, filesize, hasher, mtime)
+        return written, hasher
+
+    def pull_ranges(self, ranges):
+        """pull a file through a local range archive"""
+        body = ''.join(chr(index % 251) for index in range(1000))
+        server = self.start_archive(body, ranges)
+        temp_dir = mkdtemp()
+        written, hasher = self.pull_local(server, '%s/1'%(temp_dir), len(body))
+        self.assertEqual(written, len(body))
+        #the ranges are hashed in order
+        self.assertEqual(hasher.hexdigest(), hashlib.sha1(body).hexdigest())
+        with open('%s/1'%(temp_dir), 'rb') as testfd:
+            self.assertEqual(testfd.read(), body)
+        self.assertEqual(os.listdir(temp_dir), ['1'])
+        return server.ranges_sent
+
+    def test_archive_get_ranges(self):
+        """
+        Test a large file is pulled in ranges written in place
+        """
+        ranges_sent = self.pull_ranges(True)
+        self.assertEqual(sorted(ranges_sent),
+                         sorted(['bytes=%d-%d'%(start, min(start + 128, 1000) - 1)
+                                 for start in range(0, 1000, 128)]))
+
+    def test_archive_get_ranges_unsupported(self):
+        """
+        Test the whole file is taken when the archive ignores ranges
+        """
+        self.assertEqual(self.pull_ranges(False), ['bytes=0-127'])
+
+    def test_archive_get_resume(self):
+        """
+        Test a pull cut off part way resumes from where it got to
+        """
+        body = ''.join(chr(index % 251) for index in range(400))
+        server = self.start_archive(body)
+        server.cut = 300
+        temp_dir = mkdtemp()
+        with mock.patch('cart.archive_requests.ARCHIVE_RESUME_CHECKPOINT', 100):
+            with self.assertRaises(requests.exceptions.RequestException):
+                self.pull_local(server, '%s/1'%(temp_dir), len(body), '1')
+            server.cut = None
+            written, hasher = self.pull_local(server, '%s/1'%(temp_dir), len(body), '1')
+        self.assertEqual(server.ranges_sent, [None, 'bytes=300-399'])
+        self.assertEqual(written, len(body))
+        self.assertEqual(hasher.hexdigest(), hashlib.sha1(body).hexdigest())
+        with open('%s/1'%(temp_dir), 'rb') as testfd:
+            self.assertEqual(testfd.read(), body)
+        self.assertEqual(os.listdir(temp_dir), ['1'])
+
+    def test_archive_get_resume_changed(self):
+        """
+        Test a pull starts over when the file changed in the archive
+        """
+        body = 'x' * 400
+        server = self.start_archive(body)
+        server.cut = 300
+        temp_dir = mkdtemp()
+        with self.assertRaises(requests.exceptions.RequestException):
+            self.pull_local(server, '%s/1'%(temp_dir), len(body), '1')
+        server.cut = None
+        self.pull_local(server, '%s/1'%(temp_dir), len(body), '2')
+        self.assertEqual(server.ranges_sent, [None, None])
+        self.assertEqual(os.listdir(temp_dir), ['1'])
+
+    def test_archive_get_ranges_resume(self):
+        """
+        Test a ranged pull resumes after the ranges it finished in order
+        """
+        body = ''.join(chr(index % 251) for index in range(1000))
+        server = self.start_archive(body)
+        server.fail = ['bytes=256-383']
+        temp_dir = mkdtemp()
+        with self.assertRaises(requests.exceptions.RequestException):
+            self.pull_local(server, '%s/1'%(temp_dir), len(body), '1')
+        with open('%s/1.partial.json'%(temp_dir)) as state_file:
+            self.assertEqual(loads(state_file.read())['offset'], 256)
+        del server.ranges_sent[:]
+        written, hasher = self.pull_local(server, '%s/1'%(temp_dir), len(body), '1')
+        self.assertEqual(sorted(server.ranges_sent),
+                         sorted(['bytes=%d-%d'%(start, min(start + 128, 1000) - 1)
+                                 for start in range(256, 1000, 128)]))
+        self.assertEqual(written, len(body))
+        self.assertEqual(hasher.hexdigest(), hashlib.sha1(body).hexdigest())
+        with open('%s/1'%(temp_dir), 'rb') as testfd:
+            self.assertEqual(testfd.read(), body)
+
+    @httpretty.activate
+    def test_archive_get_range_short(self):
+        """
+        Test a range the archive sends short of fails the pull
+        """
+        def respond(request, uri, headers):
+            """send the first range right and the rest short"""
+            start, end = [int(part) for part in request.headers['Range'][6:].split('-')]
+            headers['content-range'] = 'bytes %d-%d/1000'%(start, end)
+            return (206, headers, 'x' * (end + 1 - start if start == 0 else 10))
+        httpretty.register_uri(httpretty.GET, '%s/1'%(self.endpoint_url), body=respond)
+        temp_dir = mkdtemp()
+        with mock.patch('cart.archive_requests.ARCHIVE_RANGE_THRESHOLD', 500), \
+             mock.patch('cart.archive_requests.ARCHIVE_RANGE_SIZE', 500):
+            with self.assertRaises(requests.exceptions.RequestException):
+                ArchiveRequests().pull_file('1', '%s/1'%(temp_dir), 1000)
@@ -0,0 +1,131 @@
+"""
+Test the limits on requests in flight to the archive interface
+"""
+import os
+import datetime
+import tempfile
+import threading
+import unittest
+import mock
+from playhouse.test_utils import test_database
+from peewee import SqliteDatabase
+from cart.cart_orm import Cart, File, ArchiveLimit, ArchiveLease
+from cart.archive_limits import parse_limits, acquire_all, release, renew, archive_slot
+from cart.archive_limits import hold_media, renew_media, release_media
+
+MODELS = (Cart, File, ArchiveLimit, ArchiveLease)
+
+
+class TestArchiveLimits(unittest.TestCase):
+    """
+    Test the archive limits
+    """
+    def setUp(self):
+        #a file so the threads holding slots see the same database
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.patch = mock.patch('cart.archive_limits.LIMITS', {'stage': 1, 'tape': 2})
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        os.remove(self.db_path)
+
+    def database(self):
+        """The test database"""
+        return test_database(SqliteDatabase(self.db_path), MODELS)
+
+    def test_parse_limits(self):
+        """test limits are parsed and ones never held refused"""
+        self.assertEqual(parse_limits(''), {})
+        self.assertEqual(parse_limits('stage=5, tape=2,'), {'stage': 5, 'tape': 2})
+        self.assertRaises(ValueError, parse_limits, 'disk=5')
+        self.assertRaises(ValueError, parse_limits, '=5')
+        self.assertRaises(ValueError, parse_limits, 'stage=many')
+
+    def test_acquire_all(self):
+        """test leases stop at the limit and are all or nothing"""
+        with self.database():
+            first = acquire_all(['stage', 'tape', 'status'])
+            self.assertEqual(len(first), 2)
+            #stage is full, the tape lease taken on the way is given back
+            self.assertEqual(acquire_all(['stage', 'tape']), None)
+            self.assertEqual(ArchiveLease.select().count(), 2)
+            self.assertEqual(len(acquire_all(['tape'])), 1)
+            self.assertEqual(acquire_all(['tape']), None)
+            release(first)
+            self.assertEqual(len(acquire_all(['stage'])), 1)
+
+    def test_expired_leases(self):
+        """test leases left by a dead worker are taken back once expired"""
+        with self.database():
+            acquire_all(['stage'])
+            self.assertEqual(acquire_all(['stage']), None)
+            ArchiveLease.update(
+                expires=datetime.datetime.now() - datetime.timedelta(seconds=1)).execute()
+            renewed = acquire_all(['stage'])
+            self.assertEqual(len(renewed), 1)
+            self.assertEqual(ArchiveLease.select().count(), 1)
+            before = ArchiveLease.get(ArchiveLease.id == renewed[0]).expires
+            renew(renewed)
+            self.assertTrue(ArchiveLease.get(ArchiveLease.id == renewed[0]).expires >= before)
+
+    def test_media_leases(self):
+        """test files hold a media lease across checks until released"""
+        with self.database():
+            self.assertTrue(hold_media(1, 'tape'))
+            self.assertTrue(hold_media(2, 'tape'))
+            self.assertFalse(hold_media(3, 'tape'))
+            #a file holding a lease keeps it, other media arent limited
+            self.assertTrue(hold_media(1, 'tape'))
+            self.assertTrue(hold_media(3, 'disk'))
+            self.assertTrue(hold_media(3, 'stage'))
+            self.assertEqual(ArchiveLease.select().where(ArchiveLease.key == 'tape').count(), 2)
+            ArchiveLease.update(
+                expires=datetime.datetime.now() - datetime.timedelta(seconds=1)).where(
+                    ArchiveLease.owner == '2').execute()
+            self.assertTrue(renew_media(1, 600))
+            self.assertTrue(ArchiveLease.get(ArchiveLease.owner == '1').expires >
+                            datetime.datetime.now() + datetime.timedelta(seconds=500))
+            self.assertFalse(renew_media(3))
+            #the expired lease is taken back for the waiting file
+            self.assertTrue(hold_media(3, 'tape'))
+            release_media(1)
+            release_media(2)
+            self.assertEqual([lease.owner for lease in ArchiveLease.select()], ['3'])
+            with mock.patch('cart.archive_limits.LIMITS', {'stage': 1}):
+                self.assertFalse(renew_media(3))
+                release_media(3)
+            self.assertEqual(ArchiveLease.select().count(), 1)
+
+    def test_archive_slot_unlimited(self):
+        """test operations without limits dont touch the database"""
+        with mock.patch('cart.archive_limits.acquire_all') as acquire:
+            with archive_slot('pull'):
+                pass
+            self.assertFalse(acquire.called)
+
+    def test_archive_slot_waits(self):
+        """test a slot waits for the one holding the limit"""
+        with self.database():
+            with mock.patch('cart.archive_limits.ARCHIVE_LIMIT_POLL', 0.01):
+                started = threading.Event()
+                order = []
+
+                def second():
+                    """take the slot once the first holds it"""
+                    started.wait()
+                    with archive_slot('stage'):
+                        order.append('second')
+
+                waiter = threading.Thread(target=second)
+                waiter.start()
+                with archive_slot('stage'):
+                    started.set()
+                    waiter.join(0.2)
+                    self.assertTrue(waiter.is_alive())
+                    order.append('first')
+                waiter.join(5)
+                self.assertFalse(waiter.is_alive())
+                self.assertEqual(order, ['first', 'second'])
+                self.assertEqual(ArchiveLease.select().count(), 0)
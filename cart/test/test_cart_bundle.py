@@ -0,0 +1,207 @@
+"""
+File used to unit test the cart bundle streams
+"""
+import os
+import unittest
+import gzip
+import zipfile
+import mock
+from io import BytesIO
+from shutil import rmtree
+from tarfile import TarFile
+from tempfile import mkdtemp
+from cart.cart_bundle import TarStream, FileStream, CompressedStream, ZipStream, write_bundle
+from cart.cart_bundle import is_compressible, compression_available
+import cart.cart_bundle
+
+
+class TestCartBundle(unittest.TestCase):
+    """
+    Contains the bundle stream tests
+    """
+    def setUp(self):
+        """Make a cart directory with a bit of everything in it"""
+        self.cart_path = mkdtemp()
+        long_dir = os.path.join(self.cart_path, 'b' * 120)
+        os.makedirs(long_dir)
+        self.contents = {
+            'a.txt': 'a' * 513,
+            'empty.txt': '',
+            os.path.join('b' * 120, 'nested.txt'): 'nested\n' * 1000
+        }
+        for name, data in self.contents.items():
+            with open(os.path.join(self.cart_path, name), 'wb') as cart_file:
+                cart_file.write(data)
+        os.symlink('a.txt', os.path.join(self.cart_path, 'link.txt'))
+        os.mkfifo(os.path.join(self.cart_path, 'fifo'))
+
+    def tearDown(self):
+        """Remove the cart directory"""
+        rmtree(self.cart_path)
+
+    def test_tar_stream(self):
+        """check the stream is a tar of the cart directory"""
+        stream = ''.join(TarStream(self.cart_path, 'mycart', block_size=100))
+        self.assertEqual(len(stream) % 10240, 0)
+        mytar = TarFile.open(fileobj=BytesIO(stream), mode='r')
+        #python 2 tarfile keeps the slash on long directory names
+        names = [name.rstrip('/') for name in mytar.getnames()]
+        self.assertEqual(names, ['mycart', 'mycart/a.txt', 'mycart/' + 'b' * 120,
+                                 'mycart/' + 'b' * 120 + '/nested.txt',
+                                 'mycart/empty.txt', 'mycart/link.txt'])
+        for name, data in self.contents.items():
+            self.assertEqual(mytar.extractfile('mycart/' + name).read(), data)
+        self.assertEqual(mytar.getmember('mycart/link.txt').linkname, 'a.txt')
+
+    def test_tar_stream_shrunk_file(self):
+        """check a file that shrinks while streaming is padded out"""
+        stream = TarStream(self.cart_path, 'mycart')
+        blocks = iter(stream)
+        data = [next(blocks), next(blocks)]
+        with open(os.path.join(self.cart_path, 'a.txt'), 'wb') as cart_file:
+            cart_file.write('a' * 10)
+        data.extend(blocks)
+        mytar = TarFile.open(fileobj=BytesIO(''.join(data)), mode='r')
+        self.assertEqual(mytar.extractfile('mycart/a.txt').read(), 'a' * 10 + '\0' * 503)
+        self.assertEqual(len(mytar.getnames()), 6)
+
+    def test_tar_stream_size(self):
+        """check the size is known without reading the files"""
+        stream = TarStream(self.cart_path, 'mycart', block_size=100)
+        with mock.patch('cart.cart_bundle.open', create=True) as mock_open:
+            size = stream.size()
+        self.assertFalse(mock_open.called)
+        self.assertEqual(size, len(''.join(stream)))
+
+    def test_tar_stream_etag(self):
+        """check the entity tag follows the files of the tar"""
+        etag = TarStream(self.cart_path, 'mycart').etag()
+        self.assertEqual(TarStream(self.cart_path, 'mycart').etag(), etag)
+        self.assertNotEqual(TarStream(self.cart_path, 'other').etag(), etag)
+        with open(os.path.join(self.cart_path, 'a.txt'), 'ab') as cart_file:
+            cart_file.write('a')
+        self.assertNotEqual(TarStream(self.cart_path, 'mycart').etag(), etag)
+
+    def test_tar_stream_select(self):
+        """check any range of the tar can be streamed on its own"""
+        whole = ''.join(TarStream(self.cart_path, 'mycart', block_size=100))
+        for start, stop in [(0, 1), (0, len(whole)), (511, 1537), (1000, 9000),
+                            (len(whole) - 1, len(whole)), (5, 5)]:
+            stream = TarStream(self.cart_path, 'mycart', block_size=100)
+            stream.select(start, stop)
+            self.assertEqual(''.join(stream), whole[start:stop])
+
+    def test_tar_stream_select_skips(self):
+        """check members before the range arent read"""
+        whole = ''.join(TarStream(self.cart_path, 'mycart'))
+        stream = TarStream(self.cart_path, 'mycart')
+        stream.select(whole.index('nested\n') + 10, len(whole))
+        segments = list(stream.segments())
+        nested = os.path.join(self.cart_path, 'b' * 120, 'nested.txt')
+        self.assertEqual(segments[0], (nested, 10, 6990))
+        self.assertEqual([segment for segment in segments if isinstance(segment, tuple)],
+                         [segments[0]])
+
+    def test_file_stream(self):
+        """check a file is streamed whole or in part"""
+        path = os.path.join(self.cart_path, 'a.txt')
+        stream = FileStream(path, block_size=100)
+        self.assertEqual(stream.size(), 513)
+        self.assertTrue(stream.etag().startswith('"'))
+        self.assertEqual(''.join(stream), 'a' * 513)
+        stream.select(500, 510)
+        self.assertEqual(list(stream.segments()), [(path, 500, 10)])
+        self.assertEqual(''.join(stream), 'a' * 10)
+        stream.select(10, 10)
+        self.assertEqual(''.join(stream), '')
+
+    def test_write_bundle_error(self):
+        """check a bundle that fails to write leaves nothing behind"""
+        def failing():
+            """fail part way through"""
+            yield 'data'
+            raise IOError('disk full')
+        path = os.path.join(self.cart_path, 'bundle.tar')
+        self.assertRaises(IOError, write_bundle, failing(), path)
+        self.assertFalse([name for name in os.listdir(self.cart_path) if 'bundle' in name])
+
+    def test_compressed_stream(self):
+        """check gzip bundles are whole gzip streams of the tar"""
+        with open(os.path.join(self.cart_path, 'random.bin'), 'wb') as cart_file:
+            cart_file.write(os.urandom(100000))
+        whole = ''.join(TarStream(self.cart_path, 'mycart'))
+        for workers in [1, 3]:
+            stream = CompressedStream(TarStream(self.cart_path, 'mycart'), 'gz',
+                                      workers=workers, block_size=4096)
+            data = ''.join(stream)
+            self.assertEqual(gzip.GzipFile(fileobj=BytesIO(data)).read(), whole)
+
+    def test_compressed_stream_incompressible(self):
+        """check files that dont compress are stored"""
+        with open(os.path.join(self.cart_path, 'random.bin'), 'wb') as cart_file:
+            cart_file.write(os.urandom(100000))
+        blocks = []
+        compress_block = cart.cart_bundle.compress_block
+        def saving_compress(bundle_format, data, compressible):
+            """save the blocks and their compressibility"""
+            blocks.append((len(data), compressible))
+            return compress_block(bundle_format, data, compressible)
+        with mock.patch('cart.cart_bundle.compress_block', saving_compress):
+            ''.join(CompressedStream(TarStream(self.cart_path, 'mycart'), 'gz',
+                                     workers=1, block_size=65536))
+        self.assertEqual(sum(size for size, compressible in blocks if not compressible), 100000)
+        self.assertEqual([size for size, compressible in blocks if not compressible],
+                         [65536, 34464])
+        self.assertFalse(is_compressible(os.urandom(65536)))
+        self.assertTrue(is_compressible('a' * 65536))
+        self.assertTrue(is_compressible(''))
+
+    def test_compressed_stream_zstd(self):
+        """check zstd bundles are frames of the tar"""
+        class FakeCompressor(object):
+            """stand in for zstandard.ZstdCompressor"""
+            def __init__(self, level):
+                self.level = level
+
+            def compress(self, data):
+                """frame the data with its level"""
+                return '[{0}:{1}]'.format(self.level, len(data))
+        fake_zstandard = mock.Mock(ZstdCompressor=FakeCompressor)
+        with mock.patch('cart.cart_bundle.zstandard', None):
+            self.assertFalse(compression_available('zstd'))
+        with mock.patch('cart.cart_bundle.zstandard', fake_zstandard):
+            self.assertTrue(compression_available('zstd'))
+            data = ''.join(CompressedStream(FileStream(os.path.join(self.cart_path, 'a.txt')),
+                                            'zstd', workers=2, block_size=500))
+        self.assertEqual(data, '[3:500][3:13]')
+        self.assertFalse(compression_available('bz2'))
+
+    def test_zip_stream(self):
+        """check the zip stream is a zip of the cart directory"""
+        with open(os.path.join(self.cart_path, 'random.bin'), 'wb') as cart_file:
+            cart_file.write(os.urandom(70000))
+        data = ''.join(ZipStream(self.cart_path, 'mycart', block_size=1000))
+        myzip = zipfile.ZipFile(BytesIO(data))
+        self.assertEqual(myzip.testzip(), None)
+        infos = dict((info.filename, info) for info in myzip.infolist())
+        self.assertEqual(sorted(infos), ['mycart/', 'mycart/a.txt', 'mycart/' + 'b' * 120 + '/',
+                                         'mycart/' + 'b' * 120 + '/nested.txt',
+                                         'mycart/empty.txt', 'mycart/link.txt', 'mycart/random.bin'])
+        for name, contents in self.contents.items():
+            self.assertEqual(myzip.read('mycart/' + name), contents)
+        self.assertEqual(infos['mycart/a.txt'].compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(infos['mycart/random.bin'].compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(myzip.read('mycart/link.txt'), 'a.txt')
+        self.assertEqual(infos['mycart/link.txt'].external_attr >> 28, 0xA)
+
+    def test_zip_stream_zip64(self):
+        """check the zip64 records are used past the limits"""
+        with mock.patch('cart.cart_bundle.ZIP64_LIMIT', 100):
+            with mock.patch('cart.cart_bundle.ZIP_ENTRIES_LIMIT', 2):
+                data = ''.join(ZipStream(self.cart_path, 'mycart'))
+        self.assertTrue('PK\x06\x06' in data[-200:])
+        myzip = zipfile.ZipFile(BytesIO(data))
+        self.assertEqual(myzip.testzip(), None)
+        self.assertEqual(myzip.getinfo('mycart/a.txt').file_size, 513)
+        for name, contents in self.contents.items():
+            self.assertEqual(myzip.read('mycart/' + name), contents)
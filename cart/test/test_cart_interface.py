@@ -2,15 +2,24 @@
 File used to unit test the pacifica_cart
 """
 import os
+import shutil
 from types import MethodType
 import unittest
+from io import BytesIO
+from tarfile import TarFile
+from zipfile import ZipFile
+import mock
 from json import loads, dumps
 from tempfile import mkstemp, mkdtemp
 from playhouse.test_utils import test_database
 from peewee import SqliteDatabase
 from cart.cart_orm import Cart, File
 from cart.cart_interface import fix_cart_uid, is_valid_uid, CartGenerator, CartInterfaceError
+from cart.cart_interface import status_wait, byte_range
+from cart.cart_notify import LocalNotifier
+from cart.cart_utils import Cartutils
 from cart.cart_env_globals import VOLUME_PATH
+from cart.status_cache import STATUS_CACHE
 from cart.celery import CART_APP
 
 CART_APP.conf.CELERY_ALWAYS_EAGER = True
@@ -26,6 +35,8 @@ class TestCartInterface(unittest.TestCase):
         """Create a new sqlite3 db"""
         self.sqlite_db_path = mkstemp(suffix='.sqlite3')[1]
         self.sqlite_db = SqliteDatabase(self.sqlite_db_path)
+        #every test starts with its own database so forget cached statuses
+        STATUS_CACHE.clear()
     def tearDown(self):
         """Delete the sqlite3 db"""
         os.unlink(self.sqlite_db_path)
@@ -52,6 +63,7 @@ class TestCartInterface(unittest.TestCase):
             for buf in tarfile_read:
                 self.assertTrue(len(buf) > 0)
 
+    @mock.patch('cart.cart_interface.CART_DOWNLOAD_MODE', 'fork')
     def test_cart_int_get(self):
         """Testing the cart interface get method"""
         saved_state = {}
@@ -84,6 +96,179 @@ class TestCartInterface(unittest.TestCase):
                 self.assertTrue(len(buf) > 0)
             saved_state['fd'].close()
 
+    def test_byte_range(self):
+        """Testing the Range header is parsed"""
+        self.assertEqual(byte_range({}, 100), None)
+        self.assertEqual(byte_range({'HTTP_RANGE': 'bytes=10-19'}, 100), (10, 20))
+        self.assertEqual(byte_range({'HTTP_RANGE': 'bytes=10-'}, 100), (10, 100))
+        self.assertEqual(byte_range({'HTTP_RANGE': 'bytes=10-1000'}, 100), (10, 100))
+        self.assertEqual(byte_range({'HTTP_RANGE': 'bytes=-30'}, 100), (70, 100))
+        self.assertEqual(byte_range({'HTTP_RANGE': 'bytes=-300'}, 100), (0, 100))
+        self.assertEqual(byte_range({'HTTP_RANGE': 'bytes=100-'}, 100), (100, 100))
+        self.assertEqual(byte_range({'HTTP_RANGE': 'bytes=0-1,5-6'}, 100), None)
+        self.assertEqual(byte_range({'HTTP_RANGE': 'bytes=a-b'}, 100), None)
+        self.assertEqual(byte_range({'HTTP_RANGE': 'bytes=5-3'}, 100), None)
+        self.assertEqual(byte_range({'HTTP_RANGE': 'lines=1-2'}, 100), None)
+
+    def test_cart_int_get_range(self):
+        """Testing the cart interface get method resumes a download"""
+        responses = []
+        def start_response(*args):
+            """stub for start_response to save the response"""
+            responses.append((args[0], dict(args[1])))
+        env = {
+            'PATH_INFO': '/123',
+            'QUERY_STRING' : 'filename=my_file.tar'
+        }
+        with test_database(self.sqlite_db, (Cart, File)):
+            bundle_path = os.path.join(mkdtemp(), '123')
+            os.makedirs(bundle_path)
+            with open(os.path.join(bundle_path, 'data.txt'), 'wb') as cart_file:
+                cart_file.write('0123456789' * 1000)
+            Cart.create(cart_uid='123', bundle_path=bundle_path, status='ready')
+            self.sqlite_db.close()
+            whole = ''.join(CartGenerator().get(env, start_response))
+            self.assertEqual(responses[0][0], '200 OK')
+            self.assertEqual(responses[0][1]['Content-Length'], str(len(whole)))
+            self.assertEqual(responses[0][1]['Accept-Ranges'], 'bytes')
+            #the tar doesnt depend on the name it is downloaded as
+            self.assertEqual(TarFile.open(fileobj=BytesIO(whole)).getnames(),
+                             ['123', '123/data.txt'])
+            env['QUERY_STRING'] = ''
+            self.assertEqual(''.join(CartGenerator().get(env, start_response)), whole)
+            etag = responses[0][1]['ETag']
+            self.assertEqual(responses[1][1]['ETag'], etag)
+            #a range of other bytes than the client has gets them all
+            env['HTTP_RANGE'] = 'bytes=1000-'
+            env['HTTP_IF_RANGE'] = '"other"'
+            self.assertEqual(''.join(CartGenerator().get(env, start_response)), whole)
+            self.assertEqual(responses[2][0], '200 OK')
+            env['HTTP_IF_RANGE'] = etag
+            part = ''.join(CartGenerator().get(env, start_response))
+            self.assertEqual(part, whole[1000:])
+            self.assertEqual(responses[3][0], '206 Partial Content')
+            self.assertEqual(responses[3][1]['Content-Length'], str(len(whole) - 1000))
+            self.assertEqual(responses[3][1]['Content-Range'],
+                             'bytes 1000-{0}/{1}'.format(len(whole) - 1, len(whole)))
+            env['HTTP_RANGE'] = 'bytes={0}-'.format(len(whole))
+            data = CartGenerator().get(env, start_response)
+            self.assertEqual(responses[4][0], '416 Requested Range Not Satisfiable')
+            self.assertEqual(responses[4][1]['Content-Range'], 'bytes */' + str(len(whole)))
+            self.assertEqual(loads(data)['message'], 'The requested range is not satisfiable')
+
+    def test_cart_int_get_prebuilt(self):
+        """Testing the cart interface get method sends pre-built bundles"""
+        responses = []
+        def start_response(*args):
+            """stub for start_response to save the response"""
+            responses.append((args[0], dict(args[1])))
+        env = {
+            'PATH_INFO': '/123',
+            'QUERY_STRING' : ''
+        }
+        with test_database(self.sqlite_db, (Cart, File)):
+            bundle_path = os.path.join(mkdtemp(), '123')
+            os.makedirs(bundle_path)
+            for suffix, data in [('.tar', 'the tar'), ('.tar.gz', 'the gzip')]:
+                with open(bundle_path + suffix, 'wb') as bundle_file:
+                    bundle_file.write(data)
+            Cart.create(cart_uid='123', bundle_path=bundle_path, status='ready')
+            self.sqlite_db.close()
+            self.assertEqual(''.join(CartGenerator().get(env, start_response)), 'the tar')
+            self.assertFalse('Content-Encoding' in responses[0][1])
+            env['HTTP_ACCEPT_ENCODING'] = 'gzip, deflate'
+            env['HTTP_RANGE'] = 'bytes=4-'
+            self.assertEqual(''.join(CartGenerator().get(env, start_response)), 'gzip')
+            self.assertEqual(responses[1][0], '206 Partial Content')
+            self.assertEqual(responses[1][1]['Content-Encoding'], 'gzip')
+            self.assertEqual(responses[1][1]['Content-Range'], 'bytes 4-7/8')
+
+    def test_cart_int_get_manifest(self):
+        """Testing the cart interface get method sends the manifest and checksums"""
+        responses = []
+        def start_response(*args):
+            """stub for start_response to save the response"""
+            responses.append((args[0], dict(args[1])))
+        env = {
+            'PATH_INFO': '/123',
+            'QUERY_STRING' : 'filename=my.tar&manifest=true'
+        }
+        with test_database(self.sqlite_db, (Cart, File)):
+            bundle_path = os.path.join(mkdtemp(), '123')
+            os.makedirs(os.path.join(bundle_path, 'a'))
+            for name in ['1.txt', '2.txt']:
+                with open(os.path.join(bundle_path, 'a', name), 'wb') as cart_file:
+                    cart_file.write(name)
+            with open(bundle_path + '.tar', 'wb') as bundle_file:
+                bundle_file.write('the tar')
+            mycart = Cart.create(cart_uid='123', bundle_path=bundle_path, status='ready')
+            File.create(cart=mycart, file_name='1', bundle_path='a/1.txt', status='staged',
+                        size=5, hashtype='sha1', hashsum='abc')
+            File.create(cart=mycart, file_name='2', bundle_path='a/2.txt', status='staged',
+                        size=5)
+            self.sqlite_db.close()
+            data = loads(CartGenerator().get(env, start_response))
+            self.assertEqual(responses[0][0], '200 OK')
+            self.assertEqual(data['files'], [
+                {'path': '123/a/1.txt', 'size': 5, 'hashtype': 'sha1', 'hashsum': 'abc'},
+                {'path': '123/a/2.txt', 'size': 5, 'hashtype': None, 'hashsum': None}])
+            #member checksums skip the pre-built tar
+            env['QUERY_STRING'] = 'filename=my.tar&checksums=true'
+            data = ''.join(CartGenerator().get(env, start_response))
+            mytar = TarFile.open(fileobj=BytesIO(data))
+            self.assertEqual(mytar.getmember('123/a/1.txt').pax_headers['PACIFICA.hashsum'], 'abc')
+            self.assertFalse(mytar.getmember('123/a/2.txt').pax_headers)
+            self.assertEqual(mytar.extractfile('123/a/1.txt').read(), '1.txt')
+            self.assertEqual(responses[1][1]['Content-Length'], str(len(data)))
+            Cart.update(status='staging').execute()
+            self.sqlite_db.close()
+            env['QUERY_STRING'] = 'manifest=true'
+            with mock.patch.object(Cartutils, 'available_cart', return_value=bundle_path):
+                data = loads(CartGenerator().get(env, start_response))
+            self.assertEqual(responses[2][0], '202 Accepted')
+
+    def test_cart_int_get_compressed(self):
+        """Testing the cart interface get method compresses on request"""
+        responses = []
+        def start_response(*args):
+            """stub for start_response to save the response"""
+            responses.append((args[0], dict(args[1])))
+        env = {
+            'PATH_INFO': '/123',
+            'QUERY_STRING' : 'filename=my.tar&format=gz'
+        }
+        with test_database(self.sqlite_db, (Cart, File)):
+            bundle_path = os.path.join(mkdtemp(), '123')
+            os.makedirs(bundle_path)
+            with open(os.path.join(bundle_path, 'data.txt'), 'wb') as cart_file:
+                cart_file.write('0123456789' * 1000)
+            Cart.create(cart_uid='123', bundle_path=bundle_path, status='ready')
+            self.sqlite_db.close()
+            data = ''.join(CartGenerator().get(env, start_response))
+            self.assertEqual(responses[0][0], '200 OK')
+            self.assertEqual(responses[0][1]['Content-Type'], 'application/gzip')
+            self.assertEqual(responses[0][1]['Content-Disposition'], 'attachment; filename=my.tar.gz')
+            mytar = TarFile.open(fileobj=BytesIO(data), mode='r:gz')
+            self.assertEqual(mytar.extractfile('123/data.txt').read(), '0123456789' * 1000)
+            #pre-built bundles are sent with their length
+            with open(bundle_path + '.tar.gz', 'wb') as bundle_file:
+                bundle_file.write('pre-built')
+            self.assertEqual(''.join(CartGenerator().get(env, start_response)), 'pre-built')
+            self.assertEqual(responses[1][1]['Content-Length'], '9')
+            env['QUERY_STRING'] = 'filename=my.tar&format=zip'
+            data = ''.join(CartGenerator().get(env, start_response))
+            self.assertEqual(responses[2][1]['Content-Type'], 'application/zip')
+            self.assertEqual(responses[2][1]['Content-Disposition'], 'attachment; filename=my.zip')
+            self.assertEqual(ZipFile(BytesIO(data)).read('123/data.txt'), '0123456789' * 1000)
+            env['QUERY_STRING'] = 'format=rar'
+            data = CartGenerator().get(env, start_response)
+            self.assertEqual(responses[3][0], '400 Bad Request')
+            self.assertEqual(loads(data)['format'], 'rar')
+            env['QUERY_STRING'] = 'format=zstd'
+            with mock.patch('cart.cart_bundle.zstandard', None):
+                data = CartGenerator().get(env, start_response)
+            self.assertEqual(responses[4][0], '400 Bad Request')
+
     def test_invalid_cart_uid(self):
         """Testing the cart interface get against not valid cart uid"""
         def start_response(*args):
@@ -144,6 +329,7 @@ class TestCartInterface(unittest.TestCase):
             data = cgen.get(env, start_response)
             self.assertEqual(loads(data)['message'], 'The cart is not ready for download')
 
+    @mock.patch('cart.cart_interface.CART_DOWNLOAD_MODE', 'fork')
     def test_read_cart_ioerrror(self):
         """Testing the cart interface get against not ready cart"""
         def start_response(*args):
@@ -190,6 +376,105 @@ class TestCartInterface(unittest.TestCase):
             data = cgen.status(env, start_response)
             self.assertEqual(loads(data)['message'], 'The uid was not valid')
 
+    def test_cart_int_status_cached(self):
+        """Testing repeated status polls are answered from the cache"""
+        statuses = []
+        def start_response(*args):
+            """stub for start_response to save the status"""
+            statuses.append(dict(args[1])['X-Pacifica-Status'])
+        env = {
+            'PATH_INFO': '/123',
+            'QUERY_STRING' : ''
+        }
+        with test_database(self.sqlite_db, (Cart, File)):
+            sample_cart = Cart.create(cart_uid='123', status='ready')
+            self.sqlite_db.close()
+            cgen = CartGenerator()
+            stats = STATUS_CACHE.stats()
+            for _ in range(5):
+                cgen.status(env, start_response)
+            self.assertEqual(STATUS_CACHE.hits - stats['hits'], 4)
+            self.assertEqual(STATUS_CACHE.misses - stats['misses'], 1)
+            #a change made outside the interface isnt seen until invalidated
+            Cart.update(status='error').where(Cart.id == sample_cart.id).execute()
+            cgen.status(env, start_response)
+            STATUS_CACHE.invalidate('123')
+            cgen.status(env, start_response)
+            self.assertEqual(statuses, ['ready'] * 6 + ['error'])
+
+    def test_status_wait(self):
+        """Testing the wait query parameter is parsed and capped"""
+        self.assertEqual(status_wait({'QUERY_STRING': 'wait=5'}), 5)
+        self.assertEqual(status_wait({'QUERY_STRING': 'wait=100000'}), 60)
+        self.assertEqual(status_wait({'QUERY_STRING': 'wait=-1'}), 0)
+        self.assertEqual(status_wait({'QUERY_STRING': 'wait=soon'}), 0)
+        self.assertEqual(status_wait({}), 0)
+
+    def test_cart_int_status_wait(self):
+        """Testing a status request is held until the cart changes"""
+        statuses = []
+        def start_response(*args):
+            """stub for start_response to save the status"""
+            statuses.append(dict(args[1])['X-Pacifica-Status'])
+        env = {
+            'PATH_INFO': '/123',
+            'QUERY_STRING' : 'wait=10'
+        }
+        notifier = LocalNotifier()
+        with test_database(self.sqlite_db, (Cart, File)):
+            sample_cart = Cart.create(cart_uid='123', status='staging')
+            self.sqlite_db.close()
+            def ready():
+                """what the worker does when the cart is bundled"""
+                Cart.update(status='ready').where(Cart.id == sample_cart.id).execute()
+                notifier.notify('123')
+            with mock.patch('cart.cart_interface.NOTIFIER', notifier):
+                with mock.patch.object(notifier, 'wait', side_effect=lambda *args: ready() or True):
+                    CartGenerator().status(env, start_response)
+                    #ready carts dont wait
+                    CartGenerator().status(env, start_response)
+                    self.assertEqual(notifier.wait.call_count, 1)
+                    self.assertEqual(notifier.wait.call_args[0], ('123', 0, 10))
+            self.assertEqual(statuses, ['ready', 'ready'])
+            self.assertEqual(STATUS_CACHE.get('123'), ['ready', ''])
+
+    def test_cart_int_status_wait_timeout(self):
+        """Testing a held status request gives up after the wait"""
+        statuses = []
+        def start_response(*args):
+            """stub for start_response to save the status"""
+            statuses.append(dict(args[1])['X-Pacifica-Status'])
+        env = {
+            'PATH_INFO': '/123',
+            'QUERY_STRING' : 'wait=0.05'
+        }
+        with test_database(self.sqlite_db, (Cart, File)):
+            Cart.create(cart_uid='123', status='staging')
+            self.sqlite_db.close()
+            with mock.patch('cart.cart_interface.NOTIFIER', LocalNotifier()):
+                CartGenerator().status(env, start_response)
+            self.assertEqual(statuses, ['staging'])
+
+    @mock.patch('cart.cart_interface.create_cart')
+    def test_cart_int_stage_priority(self, mock_create_cart):
+        """Testing the cart interface stage takes a priority"""
+        responses = []
+        def start_response(*args):
+            """stub for start_response to save the response"""
+            responses.append(args[0])
+        for priority, status in [(3, '201 Created'), (50, '201 Created'), (-1, '201 Created'),
+                                 ('high', '400 Bad Request'), (None, '400 Bad Request')]:
+            body = dumps({'fileids': [], 'priority': priority})
+            env = {
+                'PATH_INFO': '/123',
+                'CONTENT_LENGTH': str(len(body)),
+                'QUERY_STRING' : '',
+                'wsgi.input': BytesIO(body)
+            }
+            CartGenerator().stage(env, start_response)
+            self.assertEqual(responses[-1], status)
+        self.assertEqual([call[0][2] for call in mock_create_cart.call_args_list], [3, 9, 0])
+
     def test_cart_int_stage_nojson(self):
         """Testing the cart interface stage bad json input"""
         def start_response(*args):
@@ -301,8 +586,14 @@ class TestCartInterface(unittest.TestCase):
             os.makedirs(path_to_files)
             self.sqlite_db.close()
             cgen = CartGenerator()
-            data = cgen.delete_cart(env, start_response)
+            with mock.patch.object(Cartutils, 'queue_reaper') as mock_reaper:
+                data = cgen.delete_cart(env, start_response)
             self.assertEqual(loads(data)['message'], 'Cart Deleted Successfully')
+            #the files are left for the reaper
+            mock_reaper.assert_called_once_with()
+            self.assertEqual(Cart.get(Cart.id == sample_cart.id).status, 'deleting')
+            self.assertTrue(os.path.isdir(path_to_files))
+            shutil.rmtree(path_to_files)
 
     def test_delete_invalid_uid(self):
         """Testing the cart interface delete with invalid uid"""
@@ -0,0 +1,69 @@
+"""
+File used to unit test the cart status notifications
+"""
+import unittest
+import threading
+import time
+from shutil import rmtree
+from tempfile import mkdtemp
+from cart.cart_notify import LocalNotifier, FileNotifier, notifier
+
+
+class TestCartNotify(unittest.TestCase):
+    """
+    Contains the notifier tests, run against every notifier
+    """
+    def setUp(self):
+        """Make a directory for the file notifier"""
+        self.notify_path = mkdtemp()
+        self.notifiers = [LocalNotifier(), FileNotifier(self.notify_path + '/notify', 0.01)]
+
+    def tearDown(self):
+        """Remove the file notifier directory"""
+        rmtree(self.notify_path)
+
+    def test_notify_wakes_waiter(self):
+        """check a notification from another thread ends the wait"""
+        for cart_notifier in self.notifiers:
+            version = cart_notifier.version('my/uid')
+            timer = threading.Timer(0.05, cart_notifier.notify, ['my/uid'])
+            timer.start()
+            start = time.time()
+            self.assertTrue(cart_notifier.wait('my/uid', version, 10))
+            self.assertTrue(time.time() - start < 5)
+            timer.join()
+            self.assertNotEqual(cart_notifier.version('my/uid'), version)
+
+    def test_notify_timeout(self):
+        """check the wait gives up after the timeout"""
+        for cart_notifier in self.notifiers:
+            cart_notifier.notify('other')
+            version = cart_notifier.version('uid')
+            self.assertFalse(cart_notifier.wait('uid', version, 0.05))
+
+    def test_notify_before_wait(self):
+        """check a notification between version and wait isnt missed"""
+        for cart_notifier in self.notifiers:
+            version = cart_notifier.version('uid')
+            cart_notifier.notify('uid')
+            self.assertTrue(cart_notifier.wait('uid', version, 0))
+
+    def test_notify_forget(self):
+        """check forgetting a uid wakes its waiters"""
+        for cart_notifier in self.notifiers:
+            cart_notifier.notify('uid')
+            version = cart_notifier.version('uid')
+            cart_notifier.forget('uid')
+            self.assertTrue(cart_notifier.wait('uid', version, 0))
+            cart_notifier.forget('uid')
+
+    def test_notify_file_error(self):
+        """check failing to write the notification is ignored"""
+        cart_notifier = FileNotifier('/dev/null/notify', 0.01)
+        cart_notifier.notify('uid')
+        self.assertEqual(cart_notifier.version('uid'), '')
+
+    def test_notifier_backend(self):
+        """check the notifier is built for the backend"""
+        self.assertTrue(isinstance(notifier('local'), LocalNotifier))
+        self.assertTrue(isinstance(notifier('file'), FileNotifier))
@@ -4,11 +4,16 @@ This tests some of the cart orm class
 """
 import unittest
 import os
+import threading
 from tempfile import mkstemp
 from types import MethodType
 from playhouse.test_utils import test_database
-from peewee import SqliteDatabase, OperationalError
-from cart.cart_orm import database_setup, Cart, File
+import mock
+from peewee import SqliteDatabase, OperationalError, MySQLDatabase, ColumnMetadata
+from playhouse.pool import PooledMySQLDatabase, MaxConnectionsExceeded
+from cart.cart_orm import database_setup, database_migrate, database_connection, Cart, File
+from cart.cart_orm import StoreFile, ArchiveLimit, ArchiveLease
+from cart.cart_orm import _mysql_text_to_varchar
 import cart.cart_orm
 
 class TestCartOrm(unittest.TestCase):
@@ -26,11 +31,121 @@ class TestCartOrm(unittest.TestCase):
 
     def test_cart_orm_db_setup(self):
         """call database_setup"""
-        with test_database(self.sqlite_db, (Cart, File), create_tables=False):
+        with test_database(self.sqlite_db, (Cart, File, StoreFile, ArchiveLimit, ArchiveLease), create_tables=False):
             database_setup(2)
             self.assertTrue(Cart.table_exists())
             self.assertTrue(File.table_exists())
 
+    def test_cart_orm_db_migrate(self):
+        """call database_migrate on tables from before the file counters"""
+        with test_database(self.sqlite_db, (Cart, File, StoreFile, ArchiveLimit, ArchiveLease), create_tables=False):
+            self.sqlite_db.execute_sql(
+                'CREATE TABLE "cart" ("id" INTEGER NOT NULL PRIMARY KEY, '
+                '"cart_uid" VARCHAR(255) NOT NULL, "bundle_path" VARCHAR(255) NOT NULL, '
+                '"creation_date" DATETIME NOT NULL, "updated_date" DATETIME NOT NULL, '
+                '"deleted_date" DATETIME, "status" TEXT NOT NULL, "error" TEXT NOT NULL)')
+            self.sqlite_db.execute_sql(
+                'CREATE TABLE "file" ("id" INTEGER NOT NULL PRIMARY KEY, '
+                '"cart_id" INTEGER NOT NULL REFERENCES "cart" ("id"), '
+                '"file_name" VARCHAR(255) NOT NULL, "bundle_path" VARCHAR(255) NOT NULL, '
+                '"status" TEXT NOT NULL, "error" TEXT NOT NULL)')
+            self.sqlite_db.execute_sql(
+                'INSERT INTO "cart" VALUES (1, \'1\', \'\', \'2016-01-01\', '
+                '\'2016-01-01\', NULL, \'staging\', \'\')')
+            for index, status in enumerate(['staged', 'staged', 'staging', 'error']):
+                self.sqlite_db.execute_sql(
+                    'INSERT INTO "file" VALUES (?, 1, \'\', \'\', ?, \'\')', (index, status))
+            database_migrate()
+            mycart = Cart.get(Cart.id == 1)
+            self.assertEqual((mycart.pending_count, mycart.staged_count, mycart.error_count),
+                             (1, 2, 1))
+            #running again leaves everything as it is
+            database_migrate()
+            self.assertEqual(Cart.get(Cart.id == 1).staged_count, 2)
+            self.assertEqual(mycart.accessed_date, mycart.updated_date)
+            indexes = dict((table, sorted(tuple(index.columns) for index in
+                                          self.sqlite_db.get_indexes(table)))
+                           for table in ['cart', 'file'])
+            self.assertEqual(indexes['cart'], [('accessed_date',),
+                                               ('cart_uid', 'deleted_date', 'creation_date'),
+                                               ('updated_date',)])
+            self.assertEqual(indexes['file'], [('cart_id',), ('cart_id', 'status')])
+            self.assertTrue(StoreFile.table_exists())
+            self.assertTrue(ArchiveLease.table_exists())
+
+    def test_cart_orm_db_mysql_text(self):
+        """older MySQL tables get TEXT columns converted before indexing"""
+        database = mock.MagicMock(spec=MySQLDatabase)
+        database.compiler.return_value = MySQLDatabase('pacifica_cart').compiler()
+        database.get_columns.return_value = [
+            ColumnMetadata('status', 'text', False, False, 'file'),
+            ColumnMetadata('error', 'text', False, False, 'file'),
+            ColumnMetadata('file_name', 'varchar', False, False, 'file')
+        ]
+        with mock.patch.object(File._meta, 'database', database):
+            _mysql_text_to_varchar(File)
+        database.execute_sql.assert_called_once_with(
+            'ALTER TABLE `file` MODIFY `status` VARCHAR(255) NOT NULL')
+
+    def test_cart_orm_db_pool(self):
+        """check the database is pooled from the settings"""
+        with mock.patch('cart.cart_orm.DATABASE_POOL_SIZE', 4):
+            with mock.patch('cart.cart_orm.DATABASE_POOL_MAX_AGE', 60):
+                database = database_connection()
+        self.assertTrue(isinstance(database, PooledMySQLDatabase))
+        self.assertEqual(database.max_connections, 4)
+        self.assertEqual(database.stale_timeout, 60)
+        with mock.patch('cart.cart_orm.DATABASE_POOL_SIZE', 0):
+            database = database_connection()
+        self.assertFalse(isinstance(database, PooledMySQLDatabase))
+        self.assertTrue(isinstance(database, MySQLDatabase))
+
+    def test_cart_orm_db_pool_exhausted(self):
+        """check threads wait for a pooled connection instead of failing"""
+        with mock.patch('cart.cart_orm.DATABASE_POOL_SIZE', 1):
+            with mock.patch('cart.cart_orm.DATABASE_POOL_TIMEOUT', 5):
+                database = database_connection()
+        connected = []
+
+        def waiter():
+            """check out the connection once the other thread gives it back"""
+            database.connect()
+            connected.append(True)
+            database.close()
+
+        with mock.patch.object(MySQLDatabase, '_connect', side_effect=lambda *_, **__: mock.Mock()):
+            database.connect()
+            thread = threading.Thread(target=waiter)
+            thread.start()
+            thread.join(0.3)
+            self.assertTrue(thread.is_alive())
+            database.close()
+            thread.join(5)
+            self.assertEqual(connected, [True])
+            #giving up once the timeout passes
+            database.timeout = 0.2
+            database.connect()
+            self.assertRaises(MaxConnectionsExceeded, self.connect_in_thread, database)
+            database.close()
+
+    @staticmethod
+    def connect_in_thread(database):
+        """Connect to database from another thread, raising what it raised"""
+        errors = []
+
+        def connect():
+            """keep the error for the calling thread"""
+            try:
+                database.connect()
+            except MaxConnectionsExceeded as ex:
+                errors.append(ex)
+
+        thread = threading.Thread(target=connect)
+        thread.start()
+        thread.join(5)
+        if errors:
+            raise errors[0]
+
     def test_cart_orm_db_setup_error(self):
         """call database_setup"""
         def fake_database_connect(cls):
@@ -41,6 +156,6 @@ class TestCartOrm(unittest.TestCase):
         cart.cart_orm.CartBase.database_connect = \
             MethodType(fake_database_connect, cart.cart_orm.CartBase)
         cart.cart_orm.CartBase.throw_error = False
-        with test_database(self.sqlite_db, (Cart, File), create_tables=False):
+        with test_database(self.sqlite_db, (Cart, File, StoreFile, ArchiveLimit, ArchiveLease), create_tables=False):
             database_setup(2)
         self.assertTrue(cart.cart_orm.CartBase.throw_error)
@@ -0,0 +1,115 @@
+"""
+Test the removal of the files of deleted carts
+"""
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+import unittest
+import mock
+from playhouse.test_utils import test_database
+from peewee import SqliteDatabase
+from cart.cart_orm import Cart, File
+from cart.cart_reaper import RateLimiter, remove_tree, reap
+
+
+class TestCartReaper(unittest.TestCase):
+    """
+    Test the reaper
+    """
+    def setUp(self):
+        self.volume = tempfile.mkdtemp()
+        self.lock_path = os.path.join(self.volume, '.reaper.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.volume)
+
+    def make_cart_files(self, cart_id, files=10):
+        """Make the file tree of a cart"""
+        cart_path = os.path.join(self.volume, str(cart_id))
+        os.makedirs(os.path.join(cart_path, 'a', 'b'))
+        for index in range(files):
+            with open(os.path.join(cart_path, 'a', 'b' if index % 2 else '', str(index)),
+                      'wb') as cart_file:
+                cart_file.write('data')
+        os.symlink(os.path.join(cart_path, 'a', 'b'), os.path.join(cart_path, 'link'))
+        return cart_path
+
+    def test_rate_limiter(self):
+        """test operations are spread out to the rate"""
+        limiter = RateLimiter(100)
+        start = time.time()
+        for _ in range(150):
+            limiter.acquire()
+        self.assertTrue(time.time() - start >= 0.45)
+        #unlimited doesnt wait
+        limiter = RateLimiter(0)
+        start = time.time()
+        for _ in range(10000):
+            limiter.acquire()
+        self.assertTrue(time.time() - start < 0.45)
+
+    def test_remove_tree(self):
+        """test the tree is removed without following links"""
+        cart_path = self.make_cart_files(1)
+        outside = os.path.join(self.volume, 'outside')
+        os.makedirs(outside)
+        os.symlink(outside, os.path.join(cart_path, 'a', 'outside'))
+        limiter = mock.Mock()
+        remove_tree(cart_path, 3, limiter)
+        self.assertFalse(os.path.lexists(cart_path))
+        self.assertTrue(os.path.isdir(outside))
+        #every file and link was limited
+        self.assertEqual(limiter.acquire.call_count, 12)
+        #trees already gone are fine
+        remove_tree(cart_path, 3, limiter)
+
+    def test_remove_tree_freeing(self):
+        """test the bytes freed are given before the files are unlinked"""
+        cart_path = self.make_cart_files(1)
+        #a file linked from elsewhere frees nothing
+        os.link(os.path.join(cart_path, 'a', '0'), os.path.join(self.volume, 'stored'))
+        freed = []
+
+        def freeing(size):
+            """check the files are still there"""
+            self.assertTrue(os.path.exists(os.path.join(cart_path, 'a', '2')))
+            freed.append(size)
+        remove_tree(cart_path, 1, mock.Mock(), freeing)
+        self.assertEqual(sum(freed), 9 * 4)
+
+    def test_reap(self):
+        """test deleting carts are removed and the rest are left"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            deleting = [Cart.create(cart_uid=str(index), status='deleting', used_bytes=10,
+                                    deleted_date=index) for index in range(3)]
+            #a pull that finished after the delete made it ready again
+            deleting.append(Cart.create(cart_uid='late', status='ready', deleted_date=3))
+            ready = Cart.create(cart_uid='ready', status='ready')
+            for mycart in deleting + [ready]:
+                self.make_cart_files(mycart.id)
+            with mock.patch('cart.cart_reaper.VOLUME_PATH', self.volume):
+                with mock.patch('cart.cart_reaper.os.rmdir', side_effect=OSError(13, 'denied')):
+                    self.assertEqual(reap(2, 0, self.lock_path), 0)
+            #unlinked files came off the carts even though they werent reaped
+            self.assertEqual(Cart.get(Cart.id == deleting[0].id).used_bytes, 0)
+            with mock.patch('cart.cart_reaper.VOLUME_PATH', self.volume):
+                self.assertEqual(reap(2, 0, self.lock_path), 4)
+            for mycart in deleting:
+                mycart = Cart.get(Cart.id == mycart.id)
+                self.assertEqual((mycart.status, mycart.used_bytes), ('deleted', 0))
+                self.assertFalse(os.path.exists(os.path.join(self.volume, str(mycart.id))))
+            self.assertEqual(Cart.get(Cart.id == ready.id).status, 'ready')
+            self.assertTrue(os.path.isdir(os.path.join(self.volume, str(ready.id))))
+
+    def test_reap_locked(self):
+        """test only one reaper runs at a time"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            mycart = Cart.create(cart_uid='1', status='deleting', deleted_date=1)
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                self.assertEqual(reap(1, 0, self.lock_path), 0)
+            self.assertEqual(Cart.get(Cart.id == mycart.id).status, 'deleting')
+            with mock.patch('cart.cart_reaper.VOLUME_PATH', self.volume):
+                self.assertEqual(reap(1, 0, self.lock_path), 1)
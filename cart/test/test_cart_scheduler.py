@@ -0,0 +1,93 @@
+"""
+Test the fair share dispatch of the files of carts
+"""
+import datetime
+import unittest
+import mock
+from playhouse.test_utils import test_database
+from peewee import SqliteDatabase
+from cart.cart_orm import Cart, File
+from cart.cart_scheduler import cart_owner, cart_window, owner_carts, dispatch_files
+
+
+class TestCartScheduler(unittest.TestCase):
+    """
+    Test the scheduler
+    """
+    @staticmethod
+    def make_cart(cart_uid, files, **kwargs):
+        """Make a staging cart of waiting files"""
+        mycart = Cart.create(cart_uid=cart_uid, status='staging', **kwargs)
+        for index in range(files):
+            File.create(cart=mycart, file_name=str(index))
+        return mycart
+
+    @staticmethod
+    def statuses(mycart):
+        """The number of the carts files in each status"""
+        counts = {}
+        for cart_file in File.select().where(File.cart == mycart.id):
+            counts[cart_file.status] = counts.get(cart_file.status, 0) + 1
+        return counts
+
+    def test_cart_owner(self):
+        """test carts are owned by the start of their uid"""
+        self.assertEqual(cart_owner('alice.1'), 'alice.1')
+        with mock.patch('cart.cart_scheduler.CART_SHARE_SEPARATOR', '.'):
+            self.assertEqual(cart_owner('alice.1'), 'alice')
+            self.assertEqual(cart_owner('bob'), 'bob')
+
+    def test_cart_window(self):
+        """test windows are split between an owners carts and weighted"""
+        self.assertEqual(cart_window(0, 1, 100), 100)
+        self.assertEqual(cart_window(0, 4, 100), 25)
+        self.assertEqual(cart_window(2, 4, 100), 75)
+        self.assertEqual(cart_window(0, 1000, 100), 1)
+
+    def test_owner_carts(self):
+        """test the staging carts of an owner are counted"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            self.make_cart('alice.1', 0)
+            self.make_cart('alice.2', 0)
+            self.make_cart('alice.3', 0, deleted_date=datetime.datetime.now())
+            Cart.create(cart_uid='alice.4', status='ready')
+            self.make_cart('alicex', 0)
+            self.assertEqual(owner_carts('alice.1'), 1)
+            with mock.patch('cart.cart_scheduler.CART_SHARE_SEPARATOR', '.'):
+                self.assertEqual(owner_carts('alice'), 2)
+
+    def test_dispatch_files(self):
+        """test files are queued a window at a time"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            mycart = self.make_cart('1', 10)
+            file_ids = dispatch_files(mycart, 4)
+            self.assertEqual(len(file_ids), 4)
+            self.assertEqual(self.statuses(mycart), {'queued': 4, 'waiting': 6})
+            #nothing more until half the window is started
+            File.update(status='staging').where(File.id == file_ids[0]).execute()
+            self.assertEqual(dispatch_files(mycart, 4), [])
+            File.update(status='staging').where(File.id == file_ids[1]).execute()
+            self.assertEqual(len(dispatch_files(mycart, 4)), 2)
+            self.assertEqual(self.statuses(mycart), {'queued': 4, 'staging': 2, 'waiting': 4})
+            #the counters dont change
+            self.assertEqual(Cart.get(Cart.id == mycart.id).pending_count, 0)
+
+    def test_dispatch_files_shared(self):
+        """test an owners carts share the window and priority widens it"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            with mock.patch('cart.cart_scheduler.CART_SHARE_SEPARATOR', '.'):
+                first = self.make_cart('alice.1', 10)
+                second = self.make_cart('alice.2', 10, priority=1)
+                other = self.make_cart('bob.1', 10)
+                self.assertEqual(len(dispatch_files(first, 4)), 2)
+                self.assertEqual(len(dispatch_files(second, 4)), 4)
+                self.assertEqual(len(dispatch_files(other, 4)), 4)
+
+    def test_dispatch_files_all(self):
+        """test a window of 0 queues every file and deleted carts none"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            mycart = self.make_cart('1', 10)
+            deleted = self.make_cart('2', 10, deleted_date=datetime.datetime.now())
+            self.assertEqual(len(dispatch_files(mycart, 0)), 10)
+            self.assertEqual(dispatch_files(deleted, 0), [])
+            self.assertEqual(self.statuses(deleted), {'waiting': 10})
@@ -0,0 +1,86 @@
+"""
+Test the accounting of the space carts take on the volume
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import mock
+from playhouse.test_utils import test_database
+from peewee import SqliteDatabase
+from cart.cart_orm import Cart, File
+from cart.cart_space import space_lock, outstanding_bytes, available_bytes, path_size
+from cart.cart_space import plan_eviction
+import cart.cart_space
+
+
+class TestCartSpace(unittest.TestCase):
+    """
+    Test the space accounting helpers
+    """
+    def setUp(self):
+        self.volume = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.volume)
+
+    def test_outstanding_bytes(self):
+        """test only the unwritten reservations of live carts count"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            self.assertEqual(outstanding_bytes(), 0)
+            Cart.create(cart_uid='1', reserved_bytes=100, used_bytes=40)
+            Cart.create(cart_uid='2', reserved_bytes=10, used_bytes=30)
+            Cart.create(cart_uid='3', reserved_bytes=50, deleted_date=1)
+            Cart.create(cart_uid='4', status='deleting', reserved_bytes=50, used_bytes=20,
+                        deleted_date=1)
+            self.assertEqual(outstanding_bytes(), 60)
+            #the files of deleting carts are as good as free
+            with mock.patch('cart.cart_space.psutil.disk_usage', return_value=mock.Mock(free=1000)):
+                self.assertEqual(available_bytes(self.volume), 960)
+
+    def test_plan_eviction(self):
+        """test the fewest least recently accessed carts are picked"""
+        candidates = [('a', 10), ('b', 50), ('c', 5), ('d', 40), ('e', 100)]
+        self.assertEqual(plan_eviction(candidates, 0), [])
+        self.assertEqual(plan_eviction(candidates, 10), ['a'])
+        self.assertEqual(plan_eviction(candidates, 55), ['a', 'b'])
+        #a, b, c and d are needed to reach 95 but c isnt once d is in
+        self.assertEqual(plan_eviction(candidates, 95), ['a', 'b', 'd'])
+        self.assertEqual(plan_eviction(candidates, 140), ['b', 'e'])
+        self.assertEqual(plan_eviction(candidates, 1000), None)
+        self.assertEqual(plan_eviction(iter(candidates), 60), ['a', 'b'])
+
+    def test_space_lock(self):
+        """test the lock is only held by one thread at a time"""
+        lock_path = os.path.join(self.volume, 'locks', '.space.lock')
+        held = []
+
+        def hold():
+            """hold the lock a while"""
+            with space_lock(lock_path):
+                held.append('start')
+                time.sleep(0.1)
+                held.append('end')
+        threads = [threading.Thread(target=hold) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(held, ['start', 'end'] * 3)
+
+    def test_path_size(self):
+        """test the size of a tree, with and without scandir"""
+        os.makedirs(os.path.join(self.volume, 'a', 'b'))
+        with open(os.path.join(self.volume, 'a', 'b', '1.txt'), 'wb') as cart_file:
+            cart_file.write('x' * 5000)
+        with open(os.path.join(self.volume, '2.txt'), 'wb') as cart_file:
+            cart_file.write('y' * 300)
+        os.symlink('/', os.path.join(self.volume, 'a', 'link'))
+        expected = sum(os.lstat(os.path.join(root, name)).st_size
+                       for root, dirs, files in os.walk(self.volume)
+                       for name in dirs + files) + os.lstat(self.volume).st_size
+        self.assertEqual(path_size(self.volume), expected)
+        with mock.patch.object(cart.cart_space, 'scandir', None):
+            self.assertEqual(path_size(self.volume), expected)
@@ -0,0 +1,124 @@
+"""
+Test the store of files shared by carts
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+from playhouse.test_utils import test_database
+from peewee import SqliteDatabase
+from cart.cart_orm import Cart, File, StoreFile
+from cart.cart_store import store_key, store_path, link_stored, add_stored, release
+from cart.cart_store import shared_bytes, carts_shared_bytes, remove_unreferenced
+from cart.cart_utils import Cartutils
+
+
+class TestCartStore(unittest.TestCase):
+    """
+    Test the store helpers
+    """
+    def setUp(self):
+        self.volume = tempfile.mkdtemp()
+        self.patch = mock.patch('cart.cart_store.CART_STORE_PATH', os.path.join(self.volume, 'store'))
+        self.patch.start()
+        self.pulled = os.path.join(self.volume, 'pulled.txt')
+        with open(self.pulled, 'wb') as pulled_file:
+            pulled_file.write('data')
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.volume)
+
+    def test_store_key(self):
+        """test the key changes with the name, mtime and size"""
+        key = store_key('1.txt', '1444938166', 4)
+        self.assertEqual(len(key), 40)
+        self.assertNotEqual(key, store_key('1.txt', '1444938167', 4))
+        self.assertNotEqual(key, store_key('1.txt', '1444938166', 5))
+        self.assertNotEqual(key, store_key('2.txt', '1444938166', 4))
+        self.assertTrue(store_path(key).endswith(os.path.join(key[:2], key[2:])))
+
+    def test_add_and_link(self):
+        """test a stored file is linked and counted"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File, StoreFile)):
+            key = store_key('1.txt', '1', 4)
+            linked = os.path.join(self.volume, 'linked.txt')
+            self.assertFalse(link_stored(key, linked))
+            self.assertTrue(add_stored(key, 4, self.pulled))
+            #a second cart pulling the file at the same time keeps its own
+            self.assertFalse(add_stored(key, 4, self.pulled))
+            self.assertTrue(link_stored(key, linked))
+            self.assertEqual(os.stat(linked).st_ino, os.stat(self.pulled).st_ino)
+            self.assertEqual(StoreFile.get(StoreFile.key == key).refs, 2)
+            #links replace what a failed pull left
+            self.assertTrue(link_stored(key, linked))
+            self.assertEqual(StoreFile.get(StoreFile.key == key).refs, 3)
+
+    def test_link_failures(self):
+        """test failed links leave the counts as they were"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File, StoreFile)):
+            key = store_key('1.txt', '1', 4)
+            with mock.patch('cart.cart_store.os.link', side_effect=OSError(18, 'cross device')):
+                self.assertFalse(add_stored(key, 4, self.pulled))
+            self.assertEqual(StoreFile.select().count(), 0)
+            self.assertTrue(add_stored(key, 4, self.pulled))
+            with mock.patch('cart.cart_store.os.link', side_effect=OSError(18, 'cross device')):
+                self.assertFalse(link_stored(key, os.path.join(self.volume, 'linked.txt')))
+            self.assertEqual(StoreFile.get(StoreFile.key == key).refs, 1)
+
+    def test_shared_and_removed(self):
+        """test shared bytes and removing files no cart is linked to"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File, StoreFile)):
+            carts = [Cart.create(cart_uid=str(index)) for index in range(2)]
+            key = store_key('1.txt', '1', 4)
+            self.assertTrue(add_stored(key, 4, self.pulled))
+            for mycart in carts:
+                File.create(cart=mycart, file_name='1.txt', size=4, store_key=key)
+                File.create(cart=mycart, file_name='2.txt', size=10)
+            StoreFile.update(refs=2).execute()
+            self.assertEqual([shared_bytes(mycart.id) for mycart in carts], [4, 4])
+            self.assertEqual(shared_bytes(carts[1].id + 1), 0)
+            self.assertEqual(carts_shared_bytes([mycart.id for mycart in carts] + [carts[1].id + 1]),
+                             dict((mycart.id, 4) for mycart in carts))
+            self.assertEqual(carts_shared_bytes([]), {})
+            release([key])
+            self.assertEqual([shared_bytes(mycart.id) for mycart in carts], [0, 0])
+            remove_unreferenced([key])
+            self.assertTrue(os.path.exists(store_path(key)))
+            release([key])
+            remove_unreferenced([key])
+            self.assertFalse(os.path.exists(store_path(key)))
+            self.assertEqual(StoreFile.select().count(), 0)
+            self.assertTrue(os.path.exists(self.pulled))
+
+    def test_release_counted(self):
+        """test a key given more than once is released that many times"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File, StoreFile)):
+            keys = [store_key(name, '1', 4) for name in ('1.txt', '2.txt')]
+            for key in keys:
+                self.assertTrue(add_stored(key, 4, self.pulled))
+            StoreFile.update(refs=3).execute()
+            release([keys[0], keys[1], keys[0]])
+            self.assertEqual([StoreFile.get(StoreFile.key == key).refs for key in keys], [1, 2])
+            release([])
+            self.assertEqual([StoreFile.get(StoreFile.key == key).refs for key in keys], [1, 2])
+
+    def test_deleted_cart_not_stored(self):
+        """test a pull finishing after its cart was deleted isnt stored"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File, StoreFile)):
+            mycart = Cart.create(cart_uid='1', status='staging')
+            cart_file = File.create(cart=mycart, file_name='1.txt', bundle_path='1.txt')
+            other = File.create(cart=mycart, file_name='1.txt', bundle_path='2.txt')
+            with mock.patch('cart.cart_utils.NOTIFIER'):
+                Cartutils.delete_cart_bundle(mycart)
+            Cartutils.store_pulled_file(cart_file, 4, '1', self.pulled)
+            self.assertEqual(StoreFile.select().count(), 0)
+            self.assertEqual(File.get(File.id == cart_file.id).store_key, None)
+            #nor is a stored file linked to it
+            key = store_key('1.txt', '1', 4)
+            self.assertTrue(add_stored(key, 4, self.pulled))
+            linked = os.path.join(self.volume, 'linked.txt')
+            self.assertFalse(Cartutils.link_stored_file(other, mycart, 4, '1', linked))
+            self.assertEqual(StoreFile.get(StoreFile.key == key).refs, 1)
+            self.assertFalse(os.path.exists(linked))
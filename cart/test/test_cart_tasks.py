@@ -2,17 +2,25 @@
 File used to unit test the pacifica_cart tasks.
 """
 import os
+import hashlib
+from json import dumps, loads
+import shutil
+import tempfile
 import unittest
 from types import MethodType
 import mock
 import requests
 from playhouse.test_utils import test_database
 from peewee import SqliteDatabase
-from cart.cart_orm import Cart, File
-from cart.tasks import pull_file
+from cart.cart_orm import Cart, File, StoreFile, ArchiveLimit, ArchiveLease
+from cart.cart_reaper import reap
+import httpretty
+from cart.tasks import pull_file, stage_file_batch, get_files_locally, reap_carts, resume_reaping
+from cart.tasks import prebuild_cart, resume_bundling, resume_prebuilds, stage_files
 from cart.archive_requests import ArchiveRequests
 from cart.cart_utils import Cartutils
 import cart.cart_orm
+from cart.test.test_archive import LocalArchive
 
 class TestCartTasks(unittest.TestCase):
     """
@@ -106,6 +114,92 @@ class TestCartTasks(unittest.TestCase):
             status = cart_file.status
             self.assertEqual(status, 'error')
 
+    @mock.patch.object(os, 'utime')
+    @mock.patch.object(ArchiveRequests, 'pull_file')
+    @mock.patch.object(ArchiveRequests, 'status_file')
+    @mock.patch.object(ArchiveRequests, 'stage_file')
+    def test_short_pull(self, mock_stage_file, mock_status_file, mock_pull_file, mock_utime):
+        """test a pull the archive cut short is an error"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            test_file = File.create(cart=test_cart, file_name='1.txt',
+                                    bundle_path='/tmp/1/1.txt')
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.throw_error = False
+            mock_stage_file.return_value = True
+            mock_status_file.return_value = """{
+                            "bytes_per_level": "(10L, 0L)",
+                            "ctime": "1444629567",
+                            "file": "1.txt",
+                            "file_storage_media": "disk",
+                            "filesize": "10",
+                            "message": "File was found",
+                            "mtime": "1444937154"
+                            }"""
+            mock_pull_file.return_value = 4
+            mock_utime.return_value = True
+            file_id = test_file.id
+            pull_file(file_id, False)
+            cart_file = File.get(File.id == file_id)
+            status = cart_file.status
+            self.assertEqual(status, 'error')
+            self.assertTrue('Archive sent 4 of 10 bytes' in cart_file.error)
+            self.assertEqual(mock_pull_file.call_count, 2)
+            self.assertEqual(cart_file.hashsum, None)
+
+    @mock.patch.object(os, 'utime')
+    @mock.patch.object(ArchiveRequests, 'pull_file')
+    @mock.patch.object(ArchiveRequests, 'status_file')
+    @mock.patch.object(ArchiveRequests, 'stage_file')
+    def test_pull_retries(self, mock_stage_file, mock_status_file, mock_pull_file, mock_utime):
+        """test failed pulls are retried ARCHIVE_PULL_RETRIES times"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            test_file = File.create(cart=test_cart, file_name='1.txt',
+                                    bundle_path='/tmp/1/1.txt')
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.throw_error = False
+            mock_stage_file.return_value = True
+            mock_status_file.return_value = """{
+                            "bytes_per_level": "(10L, 0L)",
+                            "ctime": "1444629567",
+                            "file": "1.txt",
+                            "file_storage_media": "disk",
+                            "filesize": "10",
+                            "message": "File was found",
+                            "mtime": "1444937154"
+                            }"""
+            mock_pull_file.side_effect = requests.exceptions.RequestException('cut off')
+            mock_utime.return_value = True
+            file_id = test_file.id
+            with mock.patch('cart.tasks.ARCHIVE_PULL_RETRIES', 3), \
+                 mock.patch.object(ArchiveRequests, 'discard_partial') as mock_discard:
+                pull_file(file_id, False)
+            cart_file = File.get(File.id == file_id)
+            status = cart_file.status
+            self.assertEqual(status, 'error')
+            self.assertTrue('cut off' in cart_file.error)
+            self.assertEqual(mock_pull_file.call_count, 4)
+            #the pulls resume from the mtime the archive reported
+            self.assertEqual(mock_pull_file.call_args[0][4], '1444937154')
+            mock_discard.assert_called_once_with('/tmp/1/1.txt')
+
     @mock.patch.object(Cartutils, 'check_file_size_needed')
     @mock.patch.object(ArchiveRequests, 'status_file')
     @mock.patch.object(ArchiveRequests, 'stage_file')
@@ -177,3 +271,482 @@ class TestCartTasks(unittest.TestCase):
             cart_file = File.get(File.id == file_id)
             status = cart_file.status
             self.assertEqual(status, 'staging')
+
+    @httpretty.activate
+    @mock.patch.object(stage_file_batch, 'apply_async')
+    @mock.patch.object(pull_file, 'delay')
+    def test_stage_file_batch(self, mock_pull_delay, mock_batch_async):
+        """test a batch only stages the files off disk and pulls those on it"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            disk_file = File.create(cart=test_cart, file_name='1.txt',
+                                    bundle_path='/tmp/1/1.txt')
+            tape_file = File.create(cart=test_cart, file_name='2.txt',
+                                    bundle_path='/tmp/1/2.txt')
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            archive = LocalArchive({'1.txt': 'one', '2.txt': 'two'}, on_disk=['1.txt'])
+            archive.register()
+            stage_file_batch(test_cart.id, [disk_file.id, tape_file.id])
+            #the disk file is handed on with its status, so it isnt statused again
+            self.assertEqual(mock_pull_delay.call_count, 1)
+            self.assertEqual(mock_pull_delay.call_args[0], (disk_file.id, False))
+            self.assertEqual(loads(mock_pull_delay.call_args[1]['status'])['file_storage_media'],
+                             'disk')
+            self.assertEqual(mock_batch_async.call_count, 1)
+            self.assertEqual(mock_batch_async.call_args[0][0], (test_cart.id, [tape_file.id], 1))
+            self.assertTrue(mock_batch_async.call_args[1]['countdown'] > 0)
+            self.assertEqual(archive.staged, set(['2.txt']))
+            self.assertEqual(len(archive.requests), 3)
+            #the tape file is on disk by the next batch, which doesnt stage again
+            archive.on_disk.add('2.txt')
+            stage_file_batch(test_cart.id, [tape_file.id], 1)
+            self.assertEqual(mock_pull_delay.call_args[0], (tape_file.id, False))
+            self.assertEqual(mock_batch_async.call_count, 1)
+            self.assertEqual(len([req for req in archive.requests if req[0] == 'POST']), 1)
+            #and pulling it from that status makes no more archive requests
+            with mock.patch.object(ArchiveRequests, 'pull_file', return_value=3), \
+                 mock.patch.object(Cartutils, 'prepare_bundle'), \
+                 mock.patch('os.utime'):
+                pull_file(tape_file.id, False, **mock_pull_delay.call_args[1])
+            self.assertEqual(len(archive.requests), 4)
+            self.assertEqual(File.get(File.id == tape_file.id).status, 'staged')
+            #files still on tape when the attempts run out are errors
+            archive.on_disk.clear()
+            archive.staged.clear()
+            with mock.patch('cart.tasks.STAGE_BACKOFF_ATTEMPTS', 1):
+                stage_file_batch(test_cart.id, [tape_file.id], 1)
+            self.assertEqual(File.get(File.id == tape_file.id).status, 'error')
+
+    @mock.patch.object(Cartutils, 'prepare_bundle')
+    @mock.patch.object(ArchiveRequests, 'status_files')
+    @mock.patch.object(ArchiveRequests, 'stage_files')
+    def test_stage_file_batch_errors(self, mock_stage_files, mock_status_files, mock_prepare):
+        """test a batch records stage and status failures"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            bad_stage = File.create(cart=test_cart, file_name='1.txt',
+                                    bundle_path='/tmp/1/1.txt')
+            bad_status = File.create(cart=test_cart, file_name='2.txt',
+                                     bundle_path='/tmp/1/2.txt')
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            error = requests.exceptions.RequestException(mock.Mock(status=500), 'Error')
+            mock_stage_files.return_value = {'1.txt': error}
+            mock_status_files.return_value = {'1.txt': dumps({
+                'filesize': '1', 'mtime': '1', 'bytes_per_level': '(0L, 1L)',
+                'file_storage_media': 'tape'}), '2.txt': error}
+            stage_file_batch(test_cart.id, [bad_stage.id, bad_status.id])
+            mock_stage_files.assert_called_once_with(['1.txt'])
+            self.assertEqual(File.get(File.id == bad_stage.id).status, 'error')
+            self.assertEqual(File.get(File.id == bad_status.id).status, 'error')
+            mock_prepare.assert_called_once_with(test_cart.id)
+            #deleted and missing carts are skipped
+            test_cart.deleted_date = test_cart.creation_date
+            test_cart.save()
+            stage_file_batch(test_cart.id, [bad_stage.id])
+            stage_file_batch(test_cart.id + 1, [bad_stage.id])
+            self.assertEqual(mock_stage_files.call_count, 1)
+
+    @httpretty.activate
+    @mock.patch.object(Cartutils, 'prepare_bundle')
+    @mock.patch.object(pull_file, 'delay')
+    def test_stage_file_batch_no_space(self, mock_pull_delay, mock_prepare):
+        """test a batch that doesnt fit on the volume isnt pulled"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            cart_files = [File.create(cart=test_cart, file_name=name, bundle_path='/tmp/1/' + name)
+                          for name in ['1.txt', '2.txt']]
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            LocalArchive({'1.txt': 'one', '2.txt': 'two'}).register()
+            with mock.patch.object(Cartutils, 'reserve_space',
+                                   return_value='Not enough space to download file') as mock_reserve:
+                stage_file_batch(test_cart.id, [cart_file.id for cart_file in cart_files])
+            mock_reserve.assert_called_once_with(test_cart, 6, True)
+            self.assertEqual(mock_pull_delay.call_count, 0)
+            self.assertEqual([File.get(File.id == cart_file.id).status for cart_file in cart_files],
+                             ['error', 'error'])
+            mock_prepare.assert_called_once_with(test_cart.id)
+
+    @httpretty.activate
+    @mock.patch.object(Cartutils, 'prepare_bundle')
+    def test_pull_file_stored(self, _mock_prepare):
+        """test carts asking for the same file share the stored copy"""
+        volume = tempfile.mkdtemp()
+        with test_database(SqliteDatabase(':memory:'), (Cart, File, StoreFile)):
+            carts = [Cart.create(cart_uid=str(index), status='staging') for index in range(2)]
+            cart_files = [File.create(cart=mycart, file_name='1.txt', bundle_path='a/1.txt')
+                          for mycart in carts]
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            archive = LocalArchive({'1.txt': 'one'}, on_disk=['1.txt'])
+            archive.register()
+            paths = [os.path.join(volume, str(mycart.id), mycart.cart_uid, 'a', '1.txt')
+                     for mycart in carts]
+            with mock.patch('cart.cart_utils.VOLUME_PATH', volume), \
+                 mock.patch('cart.cart_reaper.VOLUME_PATH', volume), \
+                 mock.patch('cart.cart_store.CART_STORE_PATH', os.path.join(volume, '.store')), \
+                 mock.patch('cart.cart_utils.CART_STORE', True), \
+                 mock.patch('cart.tasks.CART_STORE', True):
+                for cart_file in cart_files:
+                    pull_file(cart_file.id, False)
+                self.assertEqual([req for req in archive.requests if req[0] == 'GET'],
+                                 [('GET', '1.txt')])
+                self.assertEqual([File.get(File.id == cart_file.id).status
+                                  for cart_file in cart_files], ['staged', 'staged'])
+                self.assertEqual(os.stat(paths[0]).st_ino, os.stat(paths[1]).st_ino)
+                #the checksum taken pulling the file goes with the link
+                self.assertEqual([(File.get(File.id == cart_file.id).hashtype,
+                                   File.get(File.id == cart_file.id).hashsum)
+                                  for cart_file in cart_files],
+                                 [('sha1', hashlib.sha1('one').hexdigest())] * 2)
+                self.assertEqual(open(paths[1]).read(), 'one')
+                self.assertEqual(StoreFile.get().refs, 2)
+                self.assertEqual([Cart.get(Cart.id == mycart.id).used_bytes for mycart in carts],
+                                 [3, 3])
+                #the stored file stays while a cart is linked to it
+                Cartutils.delete_cart_bundle(Cart.get(Cart.id == carts[0].id))
+                self.assertEqual(Cart.get(Cart.id == carts[0].id).used_bytes, 0)
+                self.assertEqual(reap(1, 0, os.path.join(volume, '.reaper.lock')), 1)
+                self.assertFalse(os.path.exists(paths[0]))
+                self.assertEqual(StoreFile.get().refs, 1)
+                self.assertEqual(os.stat(paths[1]).st_nlink, 2)
+                Cartutils.delete_cart_bundle(Cart.get(Cart.id == carts[1].id))
+                self.assertEqual(Cart.get(Cart.id == carts[1].id).used_bytes, 3)
+                self.assertEqual(reap(1, 0, os.path.join(volume, '.reaper.lock')), 1)
+                self.assertEqual(StoreFile.select().count(), 0)
+                self.assertEqual([name for _, _, names in os.walk(os.path.join(volume, '.store'))
+                                  for name in names], [])
+        shutil.rmtree(volume)
+
+    @httpretty.activate
+    @mock.patch.object(Cartutils, 'queue_reaper')
+    def test_pull_file_cart_deleted(self, _mock_reaper):
+        """test a cart deleted and reaped during a pull isnt an error"""
+        volume = tempfile.mkdtemp()
+        with test_database(SqliteDatabase(':memory:'), (Cart, File, StoreFile)):
+            mycart = Cart.create(cart_uid='1', status='staging')
+            cart_file = File.create(cart=mycart, file_name='1.txt', bundle_path='a/1.txt')
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            archive = LocalArchive({'1.txt': 'one'}, on_disk=['1.txt'])
+            archive.register()
+
+            def deleted_pull(*_):
+                """the cart is deleted and reaped before the pull finishes"""
+                Cartutils.remove_cart('1')
+                reap(1, 0, os.path.join(volume, '.reaper.lock'))
+                raise OSError(2, 'No such file or directory')
+
+            with mock.patch('cart.cart_utils.VOLUME_PATH', volume), \
+                 mock.patch('cart.cart_reaper.VOLUME_PATH', volume), \
+                 mock.patch('cart.tasks.VOLUME_PATH', volume), \
+                 mock.patch.object(ArchiveRequests, 'pull_file', side_effect=deleted_pull):
+                pull_file(cart_file.id, False)
+            self.assertEqual(File.get(File.id == cart_file.id).status, 'staging')
+            self.assertEqual(Cart.get(Cart.id == mycart.id).status, 'deleted')
+            self.assertFalse(os.path.exists(os.path.join(volume, str(mycart.id))))
+
+            #or once the file is pulled but before its time is set
+            mycart = Cart.create(cart_uid='2', status='staging')
+            cart_file = File.create(cart=mycart, file_name='1.txt', bundle_path='a/1.txt')
+            set_file_status = Cartutils.set_file_status
+
+            def deleted_staged(*args):
+                """the cart is deleted and reaped once the file is staged"""
+                set_file_status(*args)
+                if args[2] == 'staged':
+                    Cartutils.remove_cart('2')
+                    reap(1, 0, os.path.join(volume, '.reaper.lock'))
+
+            with mock.patch('cart.cart_utils.VOLUME_PATH', volume), \
+                 mock.patch('cart.cart_reaper.VOLUME_PATH', volume), \
+                 mock.patch('cart.tasks.VOLUME_PATH', volume), \
+                 mock.patch.object(Cartutils, 'prepare_bundle') as mock_prepare, \
+                 mock.patch.object(Cartutils, 'set_file_status', side_effect=deleted_staged):
+                pull_file(cart_file.id, False)
+            self.assertEqual(Cart.get(Cart.id == mycart.id).status, 'deleted')
+            self.assertFalse(mock_prepare.called)
+        shutil.rmtree(volume)
+
+    @httpretty.activate
+    @mock.patch.object(Cartutils, 'prepare_bundle')
+    @mock.patch.object(pull_file, 'delay')
+    def test_stage_files_reserves_cart(self, mock_pull_delay, mock_prepare):
+        """test the space of a whole cart is reserved before a file is pulled"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            LocalArchive({'1.txt': 'one', '2.txt': 'three'}).register()
+            file_ids = [{'id': '1.txt', 'path': '1.txt'}, {'id': '2.txt', 'path': '2.txt'}]
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            with mock.patch('cart.tasks.ARCHIVE_BATCH_SIZE', 0):
+                stage_files(file_ids, test_cart.id)
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).reserved_bytes, 8)
+            self.assertEqual(mock_pull_delay.call_count, 2)
+            self.assertFalse(mock_prepare.called)
+            #a cart the volume cant take isnt pulled at all
+            other_cart = Cart.create(cart_uid='2', status='staging')
+            with mock.patch.object(Cartutils, 'reserve_space',
+                                   return_value='Not enough space to download file'):
+                stage_files(file_ids, other_cart.id)
+            self.assertEqual(mock_pull_delay.call_count, 2)
+            self.assertEqual([cart_file.status for cart_file in
+                              File.select().where(File.cart == other_cart.id)],
+                             ['error', 'error'])
+            mock_prepare.assert_called_once_with(other_cart.id)
+
+    @mock.patch('cart.tasks.reap')
+    @mock.patch.object(reap_carts, 'delay')
+    def test_reap_carts(self, mock_reap_delay, mock_reap):
+        """test the reaper runs and is resumed when a worker starts"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            reap_carts()
+            mock_reap.assert_called_once_with()
+            resume_reaping(sender=None)
+            mock_reap_delay.assert_called_once_with()
+
+    @mock.patch.object(Cartutils, 'build_cart_bundle')
+    @mock.patch.object(prebuild_cart, 'delay')
+    @mock.patch.object(resume_bundling, 'delay')
+    def test_resume_bundling(self, mock_resume_delay, mock_prebuild_delay, mock_build):
+        """test carts left bundling are bundled again when a worker starts"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            bundling = Cart.create(cart_uid='1', status='bundling')
+            Cart.create(cart_uid='2', status='ready')
+            Cart.create(cart_uid='3', status='bundling', deleted_date=bundling.creation_date)
+            resume_prebuilds(sender=None)
+            mock_resume_delay.assert_called_once_with()
+            resume_bundling()
+            mock_prebuild_delay.assert_called_once_with(bundling.id)
+            prebuild_cart(bundling.id)
+            mock_build.assert_called_once_with(bundling.id)
+
+    @mock.patch.object(stage_file_batch, 'delay')
+    def test_get_files_locally_batched(self, mock_batch_delay):
+        """test the files of a cart are split into batches"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            file_ids = [File.create(cart=test_cart, file_name=str(index)).id
+                        for index in range(5)]
+            with mock.patch('cart.tasks.ARCHIVE_BATCH_SIZE', 2):
+                get_files_locally(test_cart.id)
+            self.assertEqual(mock_batch_delay.call_args_list, [
+                mock.call(test_cart.id, file_ids[0:2]),
+                mock.call(test_cart.id, file_ids[2:4]),
+                mock.call(test_cart.id, file_ids[4:5])
+            ])
+
+    @mock.patch.object(pull_file, 'delay')
+    def test_get_files_locally_window(self, mock_pull_delay):
+        """test a cart only has a window of files queued at a time"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            file_ids = [File.create(cart=test_cart, file_name=str(index)).id
+                        for index in range(5)]
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            with mock.patch('cart.cart_scheduler.CART_DISPATCH_WINDOW', 2):
+                get_files_locally(test_cart.id)
+                self.assertEqual(mock_pull_delay.call_args_list,
+                                 [mock.call(file_ids[0], False), mock.call(file_ids[1], False)])
+                #starting on a queued file queues the next ones
+                with mock.patch.object(ArchiveRequests, 'stage_file',
+                                       side_effect=requests.exceptions.RequestException('down')), \
+                     mock.patch.object(Cartutils, 'prepare_bundle'):
+                    pull_file(file_ids[0], False)
+                self.assertEqual(mock_pull_delay.call_args_list[2:],
+                                 [mock.call(file_ids[2], False)])
+            self.assertEqual([File.get(File.id == file_id).status for file_id in file_ids],
+                             ['error', 'queued', 'queued', 'waiting', 'waiting'])
+
+    @mock.patch.object(pull_file, 'apply_async')
+    @mock.patch.object(ArchiveRequests, 'status_file')
+    @mock.patch.object(ArchiveRequests, 'stage_file')
+    def test_pull_file_backoff(self, mock_stage_file, mock_status_file, mock_pull_async):
+        """test a file on tape is checked again later instead of right away"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            test_file = File.create(cart=test_cart, file_name='1.txt',
+                                    bundle_path='/tmp/1/1.txt')
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            mock_status_file.return_value = """{
+                            "bytes_per_level": "(0L, 10L)",
+                            "ctime": "1444629567",
+                            "file": "1.txt",
+                            "file_storage_media": "tape",
+                            "filesize": "10",
+                            "message": "File was found",
+                            "mtime": "1444937154"
+                            }"""
+            pull_file(test_file.id, False)
+            self.assertEqual(mock_stage_file.call_count, 1)
+            self.assertEqual(mock_pull_async.call_args[0][0], (test_file.id, False, 1))
+            self.assertTrue(mock_pull_async.call_args[1]['countdown'] > 0)
+            #checks after the first dont stage the file again
+            pull_file(test_file.id, False, 1)
+            self.assertEqual(mock_stage_file.call_count, 1)
+            self.assertEqual(mock_pull_async.call_args[0][0], (test_file.id, False, 2))
+            with mock.patch('cart.tasks.STAGE_BACKOFF_ATTEMPTS', 2):
+                pull_file(test_file.id, False, 2)
+            self.assertEqual(mock_pull_async.call_count, 2)
+            self.assertEqual(File.get(File.id == test_file.id).status, 'error')
+
+    @mock.patch.object(Cartutils, 'prepare_bundle')
+    @mock.patch.object(pull_file, 'apply_async')
+    @mock.patch.object(ArchiveRequests, 'status_file')
+    @mock.patch.object(ArchiveRequests, 'stage_file')
+    def test_pull_file_media_limit(self, mock_stage_file, mock_status_file, mock_pull_async,
+                                   _mock_prepare):
+        """test files on tape hold a tape lease from staging until done"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File, ArchiveLimit, ArchiveLease)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            first, second = [File.create(cart=test_cart, file_name=name, bundle_path=name)
+                             for name in ('1.txt', '2.txt')]
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            mock_status_file.return_value = """{
+                            "bytes_per_level": "(0L, 10L)",
+                            "ctime": "1444629567",
+                            "file": "1.txt",
+                            "file_storage_media": "tape",
+                            "filesize": "10",
+                            "message": "File was found",
+                            "mtime": "1444937154"
+                            }"""
+            with mock.patch('cart.archive_limits.LIMITS', {'tape': 1}):
+                pull_file(first.id, False)
+                self.assertEqual(mock_pull_async.call_args[0][0], (first.id, False, 1))
+                #the tape is busy with the first file, the second isnt staged yet
+                with mock.patch.object(Cartutils, 'check_file_staging_delay',
+                                       return_value=2) as mock_delay:
+                    pull_file(second.id, False)
+                    self.assertEqual(mock_stage_file.call_count, 1)
+                    self.assertEqual(mock_pull_async.call_args[0],
+                                     ((second.id, False), {'media': 'tape', 'waits': 1}))
+                    #waiting again backs off and doesnt status the file
+                    statuses = mock_status_file.call_count
+                    pull_file(second.id, False, media='tape', waits=1)
+                    self.assertEqual(mock_status_file.call_count, statuses)
+                    self.assertEqual(mock_delay.call_args[0], (None, 1))
+                    self.assertEqual(mock_pull_async.call_args[0][1], {'media': 'tape', 'waits': 2})
+                #the lease is held across the checks on the first file
+                pull_file(first.id, False, 1)
+                self.assertEqual([lease.owner for lease in ArchiveLease.select()], [str(first.id)])
+                with mock.patch('cart.tasks.STAGE_BACKOFF_ATTEMPTS', 2):
+                    pull_file(first.id, False, 2)
+                self.assertEqual(File.get(File.id == first.id).status, 'error')
+                self.assertEqual(ArchiveLease.select().count(), 0)
+                pull_file(second.id, False, media='tape', waits=2)
+                self.assertEqual(mock_stage_file.call_count, 2)
+                self.assertEqual([lease.owner for lease in ArchiveLease.select()], [str(second.id)])
+                #a file that waits too long for its media is an error
+                third = File.create(cart=test_cart, file_name='3.txt', bundle_path='3.txt')
+                with mock.patch('cart.tasks.STAGE_BACKOFF_ATTEMPTS', 2):
+                    pull_file(third.id, False, media='tape', waits=2)
+                self.assertEqual(File.get(File.id == third.id).status, 'error')
+                self.assertEqual(mock_stage_file.call_count, 2)
+
+    @httpretty.activate
+    @mock.patch.object(pull_file, 'apply_async')
+    @mock.patch.object(stage_file_batch, 'apply_async')
+    @mock.patch.object(pull_file, 'delay')
+    def test_stage_file_batch_media_limit(self, mock_pull_delay, mock_batch_async, mock_pull_async):
+        """test a batch only stages the tape files the tape limit has room for"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File, ArchiveLimit, ArchiveLease)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            cart_files = [File.create(cart=test_cart, file_name=name, bundle_path='/tmp/1/' + name)
+                          for name in ('1.txt', '2.txt', '3.txt')]
+            def fake_database_connect(cls):
+                """dont error with connect"""
+                return cls
+
+            def fake_database_close(cls):
+                """dont actually close"""
+                return cls
+            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
+            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
+            archive = LocalArchive({'1.txt': 'one', '2.txt': 'two', '3.txt': 'three'},
+                                   on_disk=['1.txt'])
+            archive.register()
+            with mock.patch('cart.archive_limits.LIMITS', {'tape': 1}):
+                stage_file_batch(test_cart.id, [cart_file.id for cart_file in cart_files])
+                #files on disk hold nothing, the third file waits for the tape
+                self.assertEqual(archive.staged, set(['2.txt']))
+                self.assertEqual(mock_pull_delay.call_args[0], (cart_files[0].id, False))
+                self.assertEqual(len([req for req in archive.requests if req[0] == 'HEAD']), 3)
+                self.assertEqual(mock_batch_async.call_args[0][0], (test_cart.id, [cart_files[1].id], 1))
+                self.assertEqual(mock_pull_async.call_args[0],
+                                 ((cart_files[2].id, False), {'media': 'tape', 'waits': 1}))
+                self.assertEqual([lease.owner for lease in ArchiveLease.select()],
+                                 [str(cart_files[1].id)])
+                #the lease is given back once the file is on disk
+                archive.on_disk.add('2.txt')
+                stage_file_batch(test_cart.id, [cart_files[1].id], 1)
+                self.assertEqual(mock_pull_delay.call_args[0], (cart_files[1].id, False))
+                self.assertEqual(ArchiveLease.select().count(), 0)
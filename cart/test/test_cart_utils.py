@@ -3,16 +3,33 @@ File used to unit test the pacifica_cart
 """
 import unittest
 import os
+import datetime
 from types import MethodType
 import shutil
+import random
+import gzip
+import tempfile
+import tarfile
 import mock
 import psutil
 from playhouse.test_utils import test_database
 from peewee import SqliteDatabase
-from cart.cart_orm import Cart, File
+from cart.cart_orm import Cart, File, StoreFile
 from cart.cart_utils import Cartutils
+from cart.cart_env_globals import STAGE_BACKOFF_MAX
 import cart.cart_orm
 
+class CountingDatabase(SqliteDatabase):
+    """
+    Sqlite database that counts the queries run against it
+    """
+    queries = 0
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        """count then run the query"""
+        self.queries += 1
+        return super(CountingDatabase, self).execute_sql(sql, params, require_commit)
+
 class TestCartUtils(unittest.TestCase):
     """
     Contains all the tests for the CartUtils class
@@ -113,12 +130,86 @@ class TestCartUtils(unittest.TestCase):
                                                       10, False)
             self.assertEqual(rtn, True)
             self.assertNotEqual(test_file.status, 'error')
+            self.assertEqual(File.get(File.id == test_file.id).size, 10)
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).reserved_bytes, 10)
 
-            #now check for an error by sending a way to large size needed number
+            #the file is only reserved once
             rtn = cart_utils.check_space_requirements(test_file, test_cart,
+                                                      10, False)
+            self.assertEqual(rtn, True)
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).reserved_bytes, 10)
+
+            #now check for an error by sending a way to large size needed number
+            big_file = File.create(cart=test_cart, file_name='2.txt',
+                                   bundle_path='/tmp/1/2.txt')
+            rtn = cart_utils.check_space_requirements(big_file, test_cart,
                                                       9999999999999999999999, True)
             self.assertEqual(rtn, False)
-            self.assertEqual(test_file.status, 'error')
+            self.assertEqual(big_file.status, 'error')
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).reserved_bytes, 10)
+
+    @mock.patch.object(psutil, 'disk_usage')
+    def test_reserve_space(self, mock_disk_usage):
+        """test reservations count against the free space until written"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            mock_disk_usage.return_value = mock.Mock(free=100)
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            other_cart = Cart.create(cart_uid='2', status='staging')
+            cart_utils = Cartutils()
+            self.assertEqual(cart_utils.reserve_space(test_cart, 60, False), None)
+            self.assertEqual(cart_utils.reserve_space(other_cart, 60, False),
+                             'Not enough space to download file')
+            #written bytes are already out of the free space
+            cart_utils.add_used_space(test_cart, 50)
+            self.assertEqual(cart_utils.reserve_space(other_cart, 60, False), None)
+            other_cart = Cart.get(Cart.id == other_cart.id)
+            self.assertEqual((other_cart.reserved_bytes, other_cart.used_bytes), (60, 0))
+
+    @mock.patch.object(psutil, 'disk_usage')
+    def test_reserve_space_evicts(self, mock_disk_usage):
+        """test carts are deleted until the reservation fits"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File, StoreFile)):
+            mock_disk_usage.return_value = mock.Mock(free=100)
+            old_carts = [Cart.create(cart_uid=str(index), status='ready', updated_date=1,
+                                     accessed_date=index, reserved_bytes=50, used_bytes=50)
+                         for index in range(3)]
+            test_cart = Cart.create(cart_uid='new', status='staging')
+            cart_utils = Cartutils()
+            with mock.patch.object(Cartutils, 'queue_reaper') as mock_queue:
+                #the files of the evicted carts are still there
+                mock_disk_usage.return_value = mock.Mock(free=0)
+                self.assertEqual(cart_utils.reserve_space(test_cart, 60, True), None)
+                self.assertEqual([Cart.get(Cart.id == cart.id).status for cart in old_carts],
+                                 ['deleting', 'deleting', 'ready'])
+                mock_queue.assert_called_once_with()
+                self.assertEqual(cart_utils.reserve_space(test_cart, 100, True),
+                                 'Not enough space to download file')
+                self.assertEqual(Cart.get(Cart.id == old_carts[2].id).status, 'ready')
+
+    @mock.patch.object(psutil, 'disk_usage')
+    def test_reserve_batch_space(self, mock_disk_usage):
+        """test a batch is reserved all together or not at all"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            mock_disk_usage.return_value = mock.Mock(free=100)
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            cart_files = [File.create(cart=test_cart, file_name=str(index),
+                                      bundle_path=str(index)) for index in range(3)]
+            cart_utils = Cartutils()
+            responses = {'0': '{"filesize": "30"}', '1': '{"filesize": "40"}', '2': 'bad'}
+            self.assertEqual(cart_utils.reserve_batch_space(test_cart, cart_files, responses), True)
+            self.assertEqual([File.get(File.id == cart_file.id).size for cart_file in cart_files],
+                             [30, 40, None])
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).reserved_bytes, 70)
+            #reserved files arent reserved again
+            self.assertEqual(cart_utils.reserve_batch_space(test_cart, cart_files, responses), True)
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).reserved_bytes, 70)
+            more_files = [File.create(cart=test_cart, file_name=str(index),
+                                      bundle_path=str(index)) for index in range(3, 5)]
+            responses = {'3': '{"filesize": "20"}', '4': '{"filesize": "20"}'}
+            self.assertEqual(cart_utils.reserve_batch_space(test_cart, more_files, responses), False)
+            self.assertEqual([File.get(File.id == cart_file.id).status for cart_file in more_files],
+                             ['error', 'error'])
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).reserved_bytes, 70)
 
     @mock.patch.object(psutil, 'disk_usage')
     def test_check_space_bad_path(self, mock_disk_usage):
@@ -205,32 +296,32 @@ class TestCartUtils(unittest.TestCase):
             self.assertNotEqual(test_file.status, 'error')
 
     def test_delete_cart_bundle(self):
-        """test that trys to delete a cart bundle"""
+        """test that a deleted cart is left for the reaper"""
         with test_database(SqliteDatabase(':memory:'), (Cart, File)):
 
             test_cart = Cart.create(cart_uid='1', status='staging',
                                     bundle_path='/tmp/1/')
             cart_utils = Cartutils()
             os.makedirs(test_cart.bundle_path, 0o777)
-            deleted = cart_utils.delete_cart_bundle(test_cart)
-            self.assertEqual(test_cart.status, 'deleted')
-            self.assertEqual(deleted, True)
-            self.assertEqual(os.path.isdir(test_cart.bundle_path), False)
-
-    @mock.patch.object(shutil, 'rmtree')
-    def test_delete_cart_bundle_fail(self, mock_rmtree):
-        """test that trys to delete a cart bundle but fails"""
-        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            cart_utils.delete_cart_bundle(test_cart)
+            test_cart = Cart.get(Cart.id == test_cart.id)
+            self.assertEqual(test_cart.status, 'deleting')
+            self.assertNotEqual(test_cart.deleted_date, None)
+            self.assertEqual(os.path.isdir(test_cart.bundle_path), True)
+            shutil.rmtree(test_cart.bundle_path)
 
-            test_cart = Cart.create(cart_uid='1', status='staging',
-                                    bundle_path='/tmp/1/')
+    @mock.patch.object(Cartutils, 'queue_reaper')
+    def test_remove_cart(self, mock_reaper):
+        """test removing the carts of a uid starts the reaper once"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            for _ in range(2):
+                Cart.create(cart_uid='1', status='ready')
             cart_utils = Cartutils()
-            os.makedirs(test_cart.bundle_path, 0o777)
-            mock_rmtree.side_effect = OSError(mock.Mock(), 'Error')
-            deleted = cart_utils.delete_cart_bundle(test_cart)
-            self.assertNotEqual(test_cart.status, 'deleted')
-            self.assertEqual(deleted, False)
-            self.assertEqual(os.path.isdir(test_cart.bundle_path), True)
+            self.assertEqual(cart_utils.remove_cart('1'), 'Cart Deleted Successfully')
+            mock_reaper.assert_called_once_with()
+            self.assertEqual([mycart.status for mycart in Cart.select()], ['deleting'] * 2)
+            self.assertEqual(cart_utils.remove_cart('1'), False)
+            self.assertEqual(mock_reaper.call_count, 1)
 
     def test_set_file_status(self):
         """test that trys to set a specific files status"""
@@ -246,23 +337,40 @@ class TestCartUtils(unittest.TestCase):
             self.assertEqual(test_file.status, 'error')
             self.assertEqual(test_file.error, 'fake error')
 
-    def test_lru_cart_delete(self):
-        """test that trys to delete a cart"""
-        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
-
-            test_cart = Cart.create(cart_uid='1', status='staging',
-                                    bundle_path='/tmp/1/')
-            test_cart2 = Cart.create(cart_uid='2', status='staging',
-                                     bundle_path='/tmp/2/', updated_date=1)
+    @mock.patch.object(Cartutils, 'queue_reaper')
+    def test_evict_carts(self, mock_queue):
+        """test the least recently accessed carts are evicted together"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File, StoreFile)):
+            test_cart = Cart.create(cart_uid='1', status='staging', accessed_date=0)
+            #accessed in the order 3, 2, 4, created in the order 2, 3, 4
+            cart2 = Cart.create(cart_uid='2', status='ready', updated_date=1,
+                                accessed_date=20, used_bytes=30, reserved_bytes=30)
+            cart3 = Cart.create(cart_uid='3', status='ready', updated_date=1,
+                                accessed_date=10, used_bytes=10, reserved_bytes=10)
+            cart4 = Cart.create(cart_uid='4', status='staging', updated_date=1,
+                                accessed_date=30, used_bytes=5, reserved_bytes=50)
             cart_utils = Cartutils()
-            os.makedirs(test_cart2.bundle_path, 0o777)
-            retval = cart_utils.lru_cart_delete(test_cart)
-            self.assertEqual(retval, True)
-            test_c2 = Cart.get(Cart.id == test_cart2.id)
-            self.assertEqual(test_c2.status, 'deleted')
-            #also hit error block when nothing to delete
-            retval = cart_utils.lru_cart_delete(test_cart)
-            self.assertEqual(retval, False)
+            self.assertEqual(cart_utils.evict_carts(test_cart, 70), True)
+            #3 and 2 arent enough and 3 isnt needed with 4
+            self.assertEqual([Cart.get(Cart.id == cart.id).status for cart in [cart2, cart3, cart4]],
+                             ['deleting', 'ready', 'deleting'])
+            mock_queue.assert_called_once_with()
+            self.assertNotEqual(Cart.get(Cart.id == cart2.id).deleted_date, None)
+            #nothing is evicted if it wouldnt be enough
+            self.assertEqual(cart_utils.evict_carts(test_cart, 11), False)
+            self.assertEqual(Cart.get(Cart.id == cart3.id).status, 'ready')
+
+    def test_touch_cart(self):
+        """test the access of a cart is recorded"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='ready', bundle_path='/tmp/1',
+                                    accessed_date=datetime.datetime(2016, 1, 1))
+            Cartutils.cart_status('1')
+            accessed = Cart.get(Cart.id == test_cart.id).accessed_date
+            self.assertTrue(accessed > datetime.datetime(2016, 1, 1))
+            #accesses close together are only recorded once
+            Cartutils.available_cart('1')
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).accessed_date, accessed)
 
     def test_bad_cart_status(self):
         """test getting a status of a cart that doesnt exist"""
@@ -278,22 +386,195 @@ class TestCartUtils(unittest.TestCase):
             retval = cart_utils.available_cart('2')
             self.assertEqual(retval, None)
 
-    @mock.patch.object(Cartutils, 'delete_cart_bundle')
-    def test_bad_stage(self, mock_delete_cart):
-        """test the bad stage of a archive file"""
+    def test_check_file_staging_delay(self):
+        """test the wait between checks backs off and follows the staging"""
+        on_tape = '{"bytes_per_level": "(0L, 24L, 0L, 0L, 0L)"}'
+        half_staged = '{"bytes_per_level": "(12L, 12L, 0L, 0L, 0L)"}'
+        cart_utils = Cartutils()
+        with mock.patch.object(random, 'uniform', lambda low, high: 0):
+            first = cart_utils.check_file_staging_delay(on_tape, 0)
+            second = cart_utils.check_file_staging_delay(on_tape, 1)
+            self.assertEqual(second, first * 2)
+            self.assertTrue(cart_utils.check_file_staging_delay(half_staged, 4) <
+                            cart_utils.check_file_staging_delay(on_tape, 4))
+            self.assertTrue(cart_utils.check_file_staging_delay(on_tape, 1000) <= STAGE_BACKOFF_MAX)
+            #bad responses wait like the file is all on tape
+            self.assertEqual(cart_utils.check_file_staging_delay('', 1), second)
+        self.assertTrue(cart_utils.check_file_staging_delay(on_tape, 0) >= first)
+
+    def test_set_file_status_counters(self):
+        """test file status changes move the file between cart counters"""
         with test_database(SqliteDatabase(':memory:'), (Cart, File)):
             test_cart = Cart.create(cart_uid='1', status='staging')
-            def fake_database_connect(cls_name):
-                """no error"""
-                return cls_name
-
-            def fake_database_close(cls_name):
-                """no error"""
-                return cls_name
-            cart.cart_orm.CartBase.database_connect = MethodType(fake_database_connect, cart.cart_orm.CartBase)
-            cart.cart_orm.CartBase.database_close = MethodType(fake_database_close, cart.cart_orm.CartBase)
-            cart.cart_orm.CartBase.throw_error = False
-            mock_delete_cart.return_value = False
-            cart_util = Cartutils()
-            return_val = cart_util.remove_cart(test_cart.id)
-            self.assertEqual(return_val, None)
+            cart_utils = Cartutils()
+            cart_utils.update_cart_files(test_cart, [{'id': '1.txt', 'path': '1.txt'},
+                                                     {'id': '2.txt', 'path': '2.txt'}])
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).pending_count, 2)
+            first, second = File.select().where(File.cart == test_cart.id).order_by(File.id)
+            cart_utils.set_file_status(first, test_cart, 'staging', False)
+            cart_utils.set_file_status(first, test_cart, 'staged', False)
+            cart_utils.set_file_status(first, test_cart, 'staged', False)
+            cart_utils.set_file_status(second, test_cart, 'error', 'fake error')
+            counted = Cart.get(Cart.id == test_cart.id)
+            self.assertEqual((counted.pending_count, counted.staged_count, counted.error_count),
+                             (0, 1, 1))
+            #saving a stale cart object doesnt overwrite the counters
+            test_cart.status = 'error'
+            test_cart.save()
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).staged_count, 1)
+
+    def test_prepare_bundle_query_count(self):
+        """test prepare_bundle costs the same however big the cart is"""
+        database = CountingDatabase(':memory:')
+        with test_database(database, (Cart, File)):
+            queries = []
+            for size in [10, 1000]:
+                test_cart = Cart.create(cart_uid=str(size), status='staging')
+                cart_utils = Cartutils()
+                cart_utils.update_cart_files(
+                    test_cart, [{'id': str(index), 'path': str(index)} for index in range(size)])
+                for cart_file in File.select().where(File.cart == test_cart.id):
+                    cart_utils.set_file_status(cart_file, test_cart, 'staged', False)
+                database.queries = 0
+                cart_utils.prepare_bundle(test_cart.id)
+                queries.append(database.queries)
+                self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'ready')
+            self.assertEqual(queries[0], queries[1])
+
+    def test_prepare_bundle_states(self):
+        """test prepare_bundle waits on pending files and fails on errors"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            cart_utils = Cartutils()
+            cart_utils.update_cart_files(test_cart, [{'id': '1.txt', 'path': '1.txt'},
+                                                     {'id': '2.txt', 'path': '2.txt'}])
+            Cart.update(reserved_bytes=30, used_bytes=10).execute()
+            first, second = File.select().where(File.cart == test_cart.id).order_by(File.id)
+            cart_utils.set_file_status(first, test_cart, 'staged', False)
+            cart_utils.prepare_bundle(test_cart.id)
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'staging')
+            cart_utils.set_file_status(second, test_cart, 'error', 'fake error')
+            with mock.patch('cart.cart_utils.NOTIFIER') as notifier:
+                cart_utils.prepare_bundle(test_cart.id)
+            test_cart = Cart.get(Cart.id == test_cart.id)
+            self.assertEqual(test_cart.status, 'error')
+            notifier.notify.assert_called_once_with('1')
+            #the space reserved for the files that failed is let go
+            self.assertEqual(test_cart.reserved_bytes, 10)
+
+    def test_update_cart_files_chunks(self):
+        """test cart files are inserted in chunks"""
+        database = CountingDatabase(':memory:')
+        with test_database(database, (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            cart_utils = Cartutils()
+            database.queries = 0
+            with mock.patch('cart.cart_utils.CART_INSERT_CHUNK', 2):
+                cart_utils.update_cart_files(
+                    test_cart, [{'id': str(index), 'path': '/a/' + str(index)} for index in range(5)])
+            #begin, three inserts and the cart update
+            self.assertEqual(database.queries, 5)
+            cart_files = list(File.select().where(File.cart == test_cart.id).order_by(File.id))
+            self.assertEqual(len(cart_files), 5)
+            self.assertEqual([cart_file.bundle_path for cart_file in cart_files][0], 'a/0')
+            self.assertEqual(cart_files[0].status, 'waiting')
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).pending_count, 5)
+
+    def test_prebuild_bundle(self):
+        """test the bundle is written out when the cart becomes ready"""
+        volume = tempfile.mkdtemp()
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='mycart', status='staging')
+            cart_path = os.path.join(volume, str(test_cart.id), 'mycart')
+            os.makedirs(os.path.join(cart_path, 'a'))
+            with open(os.path.join(cart_path, 'a', '1.txt'), 'wb') as cart_file:
+                cart_file.write('data' * 1000)
+            with mock.patch('cart.cart_utils.VOLUME_PATH', volume):
+                with mock.patch('cart.cart_utils.CART_PREBUILD', 'tar+gz'):
+                    with mock.patch.object(Cartutils, 'queue_prebuild') as queue:
+                        Cartutils.tar_files(test_cart.id, True)
+                    #the cart isnt ready until its bundle is written
+                    queue.assert_called_once_with(test_cart.id)
+                    self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'bundling')
+                    Cartutils.build_cart_bundle(test_cart.id)
+            test_cart = Cart.get(Cart.id == test_cart.id)
+            self.assertEqual(test_cart.status, 'ready')
+            self.assertEqual(test_cart.used_bytes, Cartutils.get_path_size(
+                os.path.dirname(cart_path)))
+            self.assertEqual(test_cart.reserved_bytes, test_cart.used_bytes)
+            mytar = tarfile.open(cart_path + '.tar')
+            self.assertEqual(mytar.extractfile('mycart/a/1.txt').read(), 'data' * 1000)
+            with open(cart_path + '.tar', 'rb') as tar_file:
+                self.assertEqual(gzip.open(cart_path + '.tar.gz').read(), tar_file.read())
+            self.assertEqual(sorted(os.listdir(os.path.dirname(cart_path))),
+                             ['mycart', 'mycart.tar', 'mycart.tar.gz'])
+        shutil.rmtree(volume)
+
+    def test_prepare_bundle_deleted(self):
+        """test a cart deleted while its files were pulled stays deleting"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='1', status='staging')
+            cart_utils = Cartutils()
+            cart_utils.update_cart_files(test_cart, [{'id': '1.txt', 'path': '1.txt'},
+                                                     {'id': '2.txt', 'path': '2.txt'}])
+            first, second = File.select().where(File.cart == test_cart.id).order_by(File.id)
+            cart_utils.set_file_status(first, test_cart, 'staged', False)
+            Cartutils.delete_cart_bundle(Cart.get(Cart.id == test_cart.id))
+            cart_utils.set_file_status(second, test_cart, 'staged', False)
+            with mock.patch('cart.cart_utils.NOTIFIER') as notifier:
+                cart_utils.prepare_bundle(test_cart.id)
+                cart_utils.set_file_status(second, test_cart, 'error', 'fake error')
+                cart_utils.prepare_bundle(test_cart.id)
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'deleting')
+            self.assertFalse(notifier.notify.called)
+
+    def test_tar_files_claimed(self):
+        """test only the call that moves the cart on from staging bundles it"""
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='mycart', status='staging')
+            with mock.patch.object(Cartutils, 'prebuild_bundle') as prebuild, \
+                 mock.patch.object(Cartutils, 'queue_prebuild') as queue, \
+                 mock.patch('cart.cart_utils.NOTIFIER') as notifier:
+                Cartutils.tar_files(test_cart.id, True)
+                with mock.patch('cart.cart_utils.CART_PREBUILD', 'tar'):
+                    Cartutils.tar_files(test_cart.id, True)
+                self.assertFalse(prebuild.called)
+                self.assertFalse(queue.called)
+                notifier.notify.assert_called_once_with('mycart')
+                test_cart = Cart.get(Cart.id == test_cart.id)
+                self.assertEqual(test_cart.status, 'ready')
+                self.assertTrue(test_cart.bundle_path.endswith('mycart'))
+                #a cart deleted while bundling isnt made ready
+                Cart.update(status='staging').execute()
+                with mock.patch('cart.cart_utils.CART_PREBUILD', 'tar'):
+                    Cartutils.tar_files(test_cart.id, True)
+                    Cartutils.tar_files(test_cart.id, True)
+                    self.assertEqual(queue.call_count, 1)
+                    Cartutils.delete_cart_bundle(Cart.get(Cart.id == test_cart.id))
+                    Cartutils.build_cart_bundle(test_cart.id)
+                self.assertFalse(prebuild.called)
+                self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'deleting')
+                self.assertEqual(notifier.notify.call_count, 2)
+
+    def test_prebuild_bundle_skipped(self):
+        """test carts are ready without a bundle when it cant be written"""
+        volume = tempfile.mkdtemp()
+        with test_database(SqliteDatabase(':memory:'), (Cart, File)):
+            test_cart = Cart.create(cart_uid='mycart', status='staging')
+            cart_path = os.path.join(volume, str(test_cart.id), 'mycart')
+            os.makedirs(cart_path)
+            with open(os.path.join(cart_path, '1.txt'), 'wb') as cart_file:
+                cart_file.write('data')
+            with mock.patch('cart.cart_utils.VOLUME_PATH', volume):
+                with mock.patch('cart.cart_utils.CART_PREBUILD', 'tar'), \
+                     mock.patch.object(Cartutils, 'queue_prebuild', Cartutils.build_cart_bundle):
+                    with mock.patch.object(Cartutils, 'reserve_space',
+                                           return_value='Not enough space to download file'):
+                        Cartutils.tar_files(test_cart.id, True)
+                    self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'ready')
+                    Cart.update(status='staging').execute()
+                    with mock.patch('cart.cart_bundle.os.rename', side_effect=OSError('fake')):
+                        Cartutils.tar_files(test_cart.id, True)
+            self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'ready')
+            self.assertEqual(os.listdir(os.path.dirname(cart_path)), ['mycart'])
+        shutil.rmtree(volume)
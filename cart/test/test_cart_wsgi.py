@@ -0,0 +1,96 @@
+"""
+File used to unit test the cart WSGI server pieces
+"""
+import os
+import threading
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from wsgiref.simple_server import make_server
+import mock
+import requests
+import cart.cart_wsgi
+from cart.cart_wsgi import ThreadingWSGIServer, SendfileRequestHandler
+from cart.cart_bundle import TarStream
+
+
+class FakeBundle(object):
+    """Bundle with a file segment past the end of the file"""
+    def __init__(self, path):
+        self.path = path
+
+    def segments(self):
+        """header, the file and 4 bytes the file doesnt have"""
+        yield 'head'
+        yield (self.path, 2, 6)
+
+    def __iter__(self): # pragma: no cover
+        raise AssertionError('bundle should have been sent with sendfile')
+
+
+class TestCartWsgi(unittest.TestCase):
+    """
+    Contains the WSGI server tests
+    """
+    def setUp(self):
+        """Start a server for the app the test sets"""
+        self.cart_path = mkdtemp()
+        for index in range(3):
+            with open(os.path.join(self.cart_path, 'file.' + str(index)), 'wb') as cart_file:
+                cart_file.write(os.urandom(100000 * index + 7))
+        self.result = None
+        def app(env, start_response):
+            """return what the test asked for"""
+            start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+            return self.result
+        self.server = make_server('127.0.0.1', 0, app, server_class=ThreadingWSGIServer,
+                                  handler_class=SendfileRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        """Stop the server"""
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.cart_path)
+
+    def test_sendfile_bundle(self):
+        """check a bundle is sent with sendfile"""
+        self.result = TarStream(self.cart_path, 'mycart')
+        sends = []
+        sendfile = cart.cart_wsgi.SENDFILE
+        def counting_sendfile(*args):
+            """count the calls"""
+            sends.append(args[2:])
+            return sendfile(*args)
+        with mock.patch('cart.cart_wsgi.SENDFILE', counting_sendfile):
+            resp = requests.get(self.url)
+        self.assertEqual(resp.content, ''.join(TarStream(self.cart_path, 'mycart')))
+        self.assertEqual(sends, [(0, 7), (0, 100007), (0, 200007)])
+
+    def test_sendfile_range(self):
+        """check a selected part of a bundle is sent with sendfile"""
+        whole = ''.join(TarStream(self.cart_path, 'mycart'))
+        self.result = TarStream(self.cart_path, 'mycart')
+        self.result.select(1000, 150000)
+        self.assertEqual(requests.get(self.url).content, whole[1000:150000])
+
+    def test_sendfile_shrunk(self):
+        """check missing file data is sent as NULs"""
+        path = os.path.join(self.cart_path, 'short')
+        with open(path, 'wb') as cart_file:
+            cart_file.write('abcd')
+        self.result = FakeBundle(path)
+        resp = requests.get(self.url)
+        self.assertEqual(resp.content, 'headcd\0\0\0\0')
+
+    def test_sendfile_disabled(self):
+        """check bundles and other results are iterated without sendfile"""
+        self.result = TarStream(self.cart_path, 'mycart')
+        with mock.patch('cart.cart_wsgi.CART_SENDFILE', False):
+            resp = requests.get(self.url)
+        self.assertEqual(resp.content, ''.join(TarStream(self.cart_path, 'mycart')))
+        self.result = ['plain ', 'response']
+        self.assertEqual(requests.get(self.url).content, 'plain response')
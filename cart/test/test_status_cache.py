@@ -0,0 +1,87 @@
+"""
+File used to unit test the cart status cache
+"""
+import unittest
+import mock
+from cart.status_cache import StatusCache
+
+
+class TestStatusCache(unittest.TestCase):
+    """
+    Contains the status cache tests
+    """
+    def test_status_cache_hits(self):
+        """check hits and misses are counted"""
+        cache = StatusCache(size=10, ttl=2, terminal_ttl=0)
+        self.assertEqual(cache.get('1'), None)
+        cache.put('1', ['staging', ''])
+        self.assertEqual(cache.get('1'), ['staging', ''])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1})
+
+    def test_status_cache_ttl(self):
+        """check staging carts expire and terminal carts dont"""
+        cache = StatusCache(size=10, ttl=2, terminal_ttl=0, access_ttl=None)
+        with mock.patch('cart.status_cache.time.time', return_value=100):
+            cache.put('1', ['staging', ''])
+            cache.put('2', ['ready', ''])
+            cache.put('3', ['error', 'No cart with uid 3 found'])
+        with mock.patch('cart.status_cache.time.time', return_value=1000000):
+            self.assertEqual(cache.get('1'), None)
+            self.assertEqual(cache.get('2'), ['ready', ''])
+            self.assertEqual(cache.get('3'), None)
+
+    def test_status_cache_terminal_ttl(self):
+        """check terminal carts expire when given a ttl"""
+        cache = StatusCache(size=10, ttl=2, terminal_ttl=60)
+        with mock.patch('cart.status_cache.time.time', return_value=100):
+            cache.put('1', ['ready', ''])
+        with mock.patch('cart.status_cache.time.time', return_value=150):
+            self.assertEqual(cache.get('1'), ['ready', ''])
+        with mock.patch('cart.status_cache.time.time', return_value=161):
+            self.assertEqual(cache.get('1'), None)
+
+    def test_status_cache_access_ttl(self):
+        """check statuses are read again to record the access of the cart"""
+        cache = StatusCache(size=10, ttl=2, terminal_ttl=0, access_ttl=60)
+        with mock.patch('cart.status_cache.time.time', return_value=100):
+            cache.put('1', ['ready', ''])
+            cache.put('2', ['staging', ''])
+        with mock.patch('cart.status_cache.time.time', return_value=150):
+            self.assertEqual(cache.get('1'), ['ready', ''])
+            self.assertEqual(cache.get('2'), None)
+        with mock.patch('cart.status_cache.time.time', return_value=161):
+            self.assertEqual(cache.get('1'), None)
+
+    def test_status_cache_invalidate(self):
+        """check invalidating forgets the status and doesnt trust the next read"""
+        cache = StatusCache(size=10, ttl=2, terminal_ttl=0, access_ttl=None)
+        with mock.patch('cart.status_cache.time.time', return_value=100):
+            cache.put('1', ['ready', ''])
+            cache.invalidate('1')
+            self.assertEqual(cache.get('1'), None)
+            #read of the old cart racing the new POST
+            cache.put('1', ['ready', ''])
+            self.assertEqual(cache.get('1'), ['ready', ''])
+        with mock.patch('cart.status_cache.time.time', return_value=103):
+            self.assertEqual(cache.get('1'), None)
+            cache.put('1', ['ready', ''])
+        with mock.patch('cart.status_cache.time.time', return_value=1000000):
+            self.assertEqual(cache.get('1'), ['ready', ''])
+
+    def test_status_cache_lru(self):
+        """check the least recently used status is dropped"""
+        cache = StatusCache(size=2, ttl=2, terminal_ttl=0)
+        cache.put('1', ['ready', ''])
+        cache.put('2', ['ready', ''])
+        cache.get('1')
+        cache.put('3', ['ready', ''])
+        self.assertEqual(cache.get('2'), None)
+        self.assertEqual(cache.get('1'), ['ready', ''])
+        self.assertEqual(cache.get('3'), ['ready', ''])
+
+    def test_status_cache_disabled(self):
+        """check a size of 0 caches nothing"""
+        cache = StatusCache(size=0)
+        cache.put('1', ['ready', ''])
+        cache.invalidate('1')
+        self.assertEqual(cache.get('1'), None)